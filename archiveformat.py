@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read and write indexed archive files.
+
+An indexed archive stores response bodies as raw bytes followed by a pickled
+index. A fixed-size header at the start of the file points to the index, so
+opening an archive only needs to read the header and the index.
+
+Readers memory-map the file. Chunks are handed out as read-only buffers into
+the map, so bodies are only copied when they are written out (e.g. to a
+socket), and processes that replay the same archive share the page cache.
+
+File layout:
+  header:  MAGIC, index offset, index length  (see HEADER_FORMAT)
+  bodies:  raw chunk bytes, back to back
+  index:   cPickle of an arbitrary object (e.g. a list of entries that
+           reference chunks by (offset, length) extents)
+
+A journal is the append-only counterpart, written while recording. Each
+record is written (and flushed) as soon as it is appended, so a crash only
+loses the record that was being written.
+
+Journal layout:
+  header:  JOURNAL_MAGIC
+  records: record length (see RECORD_HEADER_FORMAT),
+           cPickle of (record object, chunk lengths),
+           raw chunk bytes, back to back
+
+This module does not know about requests or responses. See
+httparchive.HttpArchive.Load/Persist for how the index is structured, and
+httparchive.HttpArchive.StartJournal for the journal records.
+"""
+
+import collections
+import cPickle
+import mmap
+import os
+import struct
+import weakref
+
+MAGIC = 'WPRIDX01'
+HEADER_FORMAT = '<8sQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+JOURNAL_MAGIC = 'WPRJNL01'
+RECORD_HEADER_FORMAT = '<Q'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+# The open readers of each file (by real path), so that they can release it
+# before it is replaced on Windows (see _replace_file).
+_readers_by_path = collections.defaultdict(weakref.WeakSet)
+
+
+class ArchiveFormatError(Exception):
+  """Raised for files that are not valid indexed archives."""
+  pass
+
+
+def is_indexed_archive(filename):
+  """Return True iff |filename| starts with the indexed archive magic."""
+  with open(filename, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+def is_journal(filename):
+  """Return True iff |filename| starts with the journal magic."""
+  with open(filename, 'rb') as f:
+    return f.read(len(JOURNAL_MAGIC)) == JOURNAL_MAGIC
+
+
+def _scan_journal(data):
+  """Parse the records of the journal contents |data|.
+
+  A partially written record at the end (e.g. after a crash) is ignored.
+
+  Args:
+    data: a string or mmap of the whole journal.
+  Returns:
+    ([(record, extents), ...], end offset of the last complete record)
+  """
+  if data[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+    raise ArchiveFormatError('Not a journal')
+  records = []
+  offset = len(JOURNAL_MAGIC)
+  while offset + RECORD_HEADER_SIZE <= len(data):
+    record_length, = struct.unpack(
+        RECORD_HEADER_FORMAT,
+        data[offset:offset + RECORD_HEADER_SIZE])
+    record_start = offset + RECORD_HEADER_SIZE
+    if record_start + record_length > len(data):
+      break
+    record, chunk_lengths = cPickle.loads(
+        data[record_start:record_start + record_length])
+    chunk_offset = record_start + record_length
+    if chunk_offset + sum(chunk_lengths) > len(data):
+      break
+    extents = []
+    for length in chunk_lengths:
+      extents.append((chunk_offset, length))
+      chunk_offset += length
+    records.append((record, extents))
+    offset = chunk_offset
+  return records, offset
+
+
+class IndexedArchiveWriter(object):
+  """Stream chunks to a new indexed archive.
+
+  Data is written to a temporary file next to |filename|, which replaces
+  |filename| on close(). That keeps |filename| readable (e.g. by lazy chunk
+  lists of a previously loaded archive) until the new file is complete.
+
+  Example:
+    writer = IndexedArchiveWriter('archive.wpr')
+    extents = writer.write_chunks(['chunk1', 'chunk2'])
+    writer.close({'entries': [('key', extents)]})
+  """
+
+  def __init__(self, filename):
+    self._filename = filename
+    self._tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    self._file = open(self._tmp_filename, 'wb')
+    self._file.write(struct.pack(HEADER_FORMAT, MAGIC, 0, 0))
+    self._offset = HEADER_SIZE
+
+  def write_chunks(self, chunks):
+    """Append |chunks| to the body region.
+
+    Args:
+      chunks: an iterable of strings (or buffers).
+    Returns:
+      [(offset, length), ...]  # one extent per chunk
+    """
+    extents = []
+    for chunk in chunks:
+      length = len(chunk)
+      self._file.write(chunk)
+      extents.append((self._offset, length))
+      self._offset += length
+    return extents
+
+  def close(self, index):
+    """Write |index|, fix up the header and move the file into place."""
+    try:
+      index_str = cPickle.dumps(index, cPickle.HIGHEST_PROTOCOL)
+      self._file.write(index_str)
+      self._file.seek(0)
+      self._file.write(
+          struct.pack(HEADER_FORMAT, MAGIC, self._offset, len(index_str)))
+      self._file.close()
+      _replace_file(self._tmp_filename, self._filename)
+    except Exception:
+      self.abort()
+      raise
+
+  def abort(self):
+    """Discard everything written so far."""
+    if not self._file.closed:
+      self._file.close()
+    if os.path.exists(self._tmp_filename):
+      os.remove(self._tmp_filename)
+
+
+def _replace_file(src, dst):
+  """Rename |src| to |dst|, even if |dst| exists and is being read."""
+  try:
+    os.rename(src, dst)
+  except OSError:
+    # Windows does not allow renaming over an existing file, nor removing a
+    # file that is open or memory-mapped.
+    for reader in list(_readers_by_path.get(os.path.realpath(dst), ())):
+      reader.release()
+    os.remove(dst)
+    os.rename(src, dst)
+
+
+class _MappedFileReader(object):
+  """Memory-map a file and hand out chunks as buffers.
+
+  The file stays open, so chunks can also be sent from it with sendfile()
+  (see fileno and ChunkList.get_file_extents).
+  """
+
+  def __init__(self, filename):
+    self._file = open(filename, 'rb')
+    self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    self._data = self._mmap
+    _readers_by_path[os.path.realpath(filename)].add(self)
+
+  def read_chunk(self, offset, length):
+    """Return a read-only buffer of |length| bytes starting at |offset|.
+
+    No data is copied. Use str() on the result to get a string.
+    """
+    return buffer(self._data, offset, length)
+
+  def fileno(self):
+    """Return the file descriptor, or None after release()."""
+    return self._file.fileno() if self._file else None
+
+  def release(self):
+    """Copy the file into memory and close it, so it can be replaced.
+
+    Buffers that were handed out before become invalid.
+    """
+    if self._file:
+      self._data = self._mmap[:]
+      self.close()
+
+  def close(self):
+    if self._file:
+      self._mmap.close()
+      self._file.close()
+      self._file = None
+
+
+class IndexedArchiveReader(_MappedFileReader):
+  """Memory-map an indexed archive and hand out chunks as buffers.
+
+  Attributes:
+    index: the unpickled index object.
+  """
+
+  def __init__(self, filename):
+    super(IndexedArchiveReader, self).__init__(filename)
+    if len(self._mmap) < HEADER_SIZE:
+      raise ArchiveFormatError('Truncated archive header: %s' % filename)
+    magic, index_offset, index_length = struct.unpack(
+        HEADER_FORMAT, self._mmap[:HEADER_SIZE])
+    if magic != MAGIC:
+      raise ArchiveFormatError('Not an indexed archive: %s' % filename)
+    if not index_offset:
+      raise ArchiveFormatError('Incomplete archive (no index): %s' % filename)
+    if index_offset + index_length > len(self._mmap):
+      raise ArchiveFormatError('Truncated archive index: %s' % filename)
+    self.index = cPickle.loads(
+        self._mmap[index_offset:index_offset + index_length])
+
+
+class JournalWriter(object):
+  """Append records with chunks to a journal.
+
+  An existing journal is continued. A partially written record at its end is
+  dropped first.
+
+  Example:
+    writer = JournalWriter('archive.wpr.journal')
+    writer.append(('key', 'value'), ['chunk1', 'chunk2'])
+    writer.close()
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    if os.path.exists(filename) and os.path.getsize(filename):
+      with open(filename, 'rb') as f:
+        _, end_offset = _scan_journal(f.read())
+      self._file = open(filename, 'r+b')
+      self._file.truncate(end_offset)
+      self._file.seek(end_offset)
+    else:
+      self._file = open(filename, 'wb')
+      self._file.write(JOURNAL_MAGIC)
+      self._file.flush()
+
+  def append(self, record, chunks):
+    """Append |record| (any picklable object) and |chunks| (strings)."""
+    record_str = cPickle.dumps(
+        (record, [len(chunk) for chunk in chunks]), cPickle.HIGHEST_PROTOCOL)
+    self._file.write(struct.pack(RECORD_HEADER_FORMAT, len(record_str)))
+    self._file.write(record_str)
+    for chunk in chunks:
+      self._file.write(chunk)
+    self._file.flush()
+
+  def truncate(self):
+    """Drop all records."""
+    self._file.truncate(len(JOURNAL_MAGIC))
+    self._file.seek(len(JOURNAL_MAGIC))
+
+  def close(self):
+    self._file.close()
+
+
+class JournalReader(_MappedFileReader):
+  """Memory-map a journal and hand out chunks as buffers.
+
+  Attributes:
+    records: [(record, extents), ...] in the order they were appended.
+  """
+
+  def __init__(self, filename):
+    super(JournalReader, self).__init__(filename)
+    try:
+      self.records, _ = _scan_journal(self._mmap)
+    except ArchiveFormatError:
+      raise ArchiveFormatError('Not a journal: %s' % filename)
+
+
+class ChunkList(object):
+  """A read-only list of chunks that are backed by an archive file.
+
+  ChunkList stands in for the list of strings in
+  ArchivedHttpResponse.response_data. Indexing and iterating give buffers
+  (see IndexedArchiveReader.read_chunk), which work with len(), file writes,
+  slicing, '%s' formatting and zlib. Code that needs actual strings should
+  call str() on them.
+
+  Comparing, copying and pickling a ChunkList behaves like a plain list of
+  strings, so code that persists or modifies responses does not need to know
+  about it.
+  """
+
+  def __init__(self, reader, extents):
+    """Initialize a ChunkList.
+
+    Args:
+      reader: an IndexedArchiveReader or JournalReader.
+      extents: [(offset, length), ...]
+    """
+    self._reader = reader
+    self._extents = extents
+
+  def __len__(self):
+    return len(self._extents)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self._reader.read_chunk(*e) for e in self._extents[index]]
+    return self._reader.read_chunk(*self._extents[index])
+
+  def __iter__(self):
+    for offset, length in self._extents:
+      yield self._reader.read_chunk(offset, length)
+
+  def __eq__(self, other):
+    return self.materialize() == [str(c) for c in other]
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(self.materialize())
+
+  def __reduce__(self):
+    return (list, (self.materialize(),))
+
+  def get_file_extents(self):
+    """Return where the chunks are in the archive file.
+
+    Returns:
+      (file descriptor, [(offset, length), ...]), or None if the file was
+      released (see IndexedArchiveReader.release).
+    """
+    fd = self._reader.fileno()
+    if fd is None:
+      return None
+    return fd, self._extents
+
+  def materialize(self):
+    """Return the chunks as a list of strings."""
+    return [str(c) for c in self]
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import archiveformat
+import copy
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class IndexedArchiveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.temp_dir, 'archive.wpr')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def write_archive(self, chunk_lists):
+    writer = archiveformat.IndexedArchiveWriter(self.filename)
+    entries = [writer.write_chunks(chunks) for chunks in chunk_lists]
+    writer.close({'entries': entries})
+
+  def test_round_trip(self):
+    self.write_archive([['abc', 'de'], [], ['fghij']])
+    self.assertTrue(archiveformat.is_indexed_archive(self.filename))
+
+    reader = archiveformat.IndexedArchiveReader(self.filename)
+    chunk_lists = [archiveformat.ChunkList(reader, extents)
+                   for extents in reader.index['entries']]
+    self.assertEqual(['abc', 'de'], chunk_lists[0].materialize())
+    self.assertEqual([], chunk_lists[1].materialize())
+    self.assertEqual(['fghij'], chunk_lists[2].materialize())
+    self.assertEqual('de', str(chunk_lists[0][1]))
+    self.assertEqual(2, len(chunk_lists[0]))
+    self.assertEqual(['abc', 'de'], chunk_lists[0])
+
+  def test_chunks_are_buffers_into_the_file(self):
+    self.write_archive([['abc', 'de']])
+    reader = archiveformat.IndexedArchiveReader(self.filename)
+    chunk = archiveformat.ChunkList(reader, reader.index['entries'][0])[0]
+    self.assertEqual(buffer, type(chunk))
+    self.assertEqual(3, len(chunk))
+    self.assertEqual('bc', chunk[1:])
+    self.assertEqual('[abc]', '[%s]' % chunk)
+
+  def test_chunk_list_copies_and_pickles_as_list(self):
+    self.write_archive([['abc', 'de']])
+    reader = archiveformat.IndexedArchiveReader(self.filename)
+    chunk_list = archiveformat.ChunkList(reader, reader.index['entries'][0])
+
+    self.assertEqual(['abc', 'de'], copy.deepcopy(chunk_list))
+    self.assertEqual(list, type(copy.deepcopy(chunk_list)))
+    unpickled = cPickle.loads(cPickle.dumps(chunk_list, 2))
+    self.assertEqual(list, type(unpickled))
+    self.assertEqual(['abc', 'de'], unpickled)
+    self.assertEqual(repr(['abc', 'de']), repr(chunk_list))
+
+  def test_old_file_stays_readable_while_rewriting(self):
+    self.write_archive([['old']])
+    reader = archiveformat.IndexedArchiveReader(self.filename)
+    chunk_list = archiveformat.ChunkList(reader, reader.index['entries'][0])
+
+    self.write_archive([['new', 'data']])
+    self.assertEqual(['old'], chunk_list.materialize())
+    self.assertEqual([], [f for f in os.listdir(self.temp_dir)
+                          if f != 'archive.wpr'])
+
+  def test_release(self):
+    self.write_archive([['abc', 'de']])
+    reader = archiveformat.IndexedArchiveReader(self.filename)
+    chunk_list = archiveformat.ChunkList(reader, reader.index['entries'][0])
+    self.assertEqual(reader.fileno(), chunk_list.get_file_extents()[0])
+
+    reader.release()
+    os.remove(self.filename)
+    self.assertIsNone(reader.fileno())
+    self.assertIsNone(chunk_list.get_file_extents())
+    self.assertEqual(['abc', 'de'], chunk_list.materialize())
+
+  def test_not_indexed_archive(self):
+    with open(self.filename, 'wb') as f:
+      cPickle.dump({}, f, cPickle.HIGHEST_PROTOCOL)
+    self.assertFalse(archiveformat.is_indexed_archive(self.filename))
+    self.assertRaises(archiveformat.ArchiveFormatError,
+                      archiveformat.IndexedArchiveReader, self.filename)
+
+  def test_incomplete_archive(self):
+    writer = archiveformat.IndexedArchiveWriter(self.filename)
+    writer.write_chunks(['abc'])
+    writer._file.close()
+    os.rename(writer._tmp_filename, self.filename)
+    self.assertRaises(archiveformat.ArchiveFormatError,
+                      archiveformat.IndexedArchiveReader, self.filename)
+
+
+
+class JournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.temp_dir, 'archive.wpr.journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def read_records(self):
+    reader = archiveformat.JournalReader(self.filename)
+    return [(record, archiveformat.ChunkList(reader, extents).materialize())
+            for record, extents in reader.records]
+
+  def test_round_trip(self):
+    writer = archiveformat.JournalWriter(self.filename)
+    writer.append('a', ['abc', 'de'])
+    writer.append(('b', 1), [])
+    self.assertEqual([('a', ['abc', 'de']), (('b', 1), [])],
+                     self.read_records())
+    writer.close()
+    self.assertTrue(archiveformat.is_journal(self.filename))
+    self.assertFalse(archiveformat.is_indexed_archive(self.filename))
+
+  def test_continue_and_truncate(self):
+    writer = archiveformat.JournalWriter(self.filename)
+    writer.append('a', ['abc'])
+    writer.close()
+    writer = archiveformat.JournalWriter(self.filename)
+    writer.append('b', ['de'])
+    self.assertEqual([('a', ['abc']), ('b', ['de'])], self.read_records())
+    writer.truncate()
+    writer.append('c', ['f'])
+    writer.close()
+    self.assertEqual([('c', ['f'])], self.read_records())
+
+  def test_partial_record_is_dropped(self):
+    writer = archiveformat.JournalWriter(self.filename)
+    writer.append('a', ['abc'])
+    writer.append('b', ['defgh'])
+    writer.close()
+    with open(self.filename, 'r+b') as f:
+      f.truncate(os.path.getsize(self.filename) - 2)
+    self.assertEqual([('a', ['abc'])], self.read_records())
+
+    writer = archiveformat.JournalWriter(self.filename)
+    writer.append('c', ['i'])
+    writer.close()
+    self.assertEqual([('a', ['abc']), ('c', ['i'])], self.read_records())
+
+  def test_not_journal(self):
+    writer = archiveformat.IndexedArchiveWriter(self.filename)
+    writer.close({'entries': []})
+    self.assertFalse(archiveformat.is_journal(self.filename))
+    self.assertRaises(archiveformat.ArchiveFormatError,
+                      archiveformat.JournalReader, self.filename)
+
+
+if __name__ == '__main__':
+  unittest.main()
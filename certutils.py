@@ -23,24 +23,31 @@ Certificate Naming Conventions:
   ca_cert_str:  a certificae authority string (w/ both the pub & priv certs)
 """
 
+import hashlib
 import logging
 import os
 import socket
 import time
+import urllib
 
 openssl_import_error = None
 
 Error = None
+SESS_CACHE_SERVER = None
 SSL_METHOD = None
 SysCallError = None
 VERIFY_PEER = None
 ZeroReturnError = None
 FILETYPE_PEM = None
 
+# Cached certificates that expire sooner than this are generated again.
+CERT_CACHE_MIN_VALIDITY_SECS = 60 * 60 * 24
+
 try:
   from OpenSSL import crypto, SSL
 
   Error = SSL.Error
+  SESS_CACHE_SERVER = SSL.SESS_CACHE_SERVER
   SSL_METHOD = SSL.SSLv23_METHOD
   SysCallError = SSL.SysCallError
   VERIFY_PEER = SSL.VERIFY_PEER
@@ -254,3 +261,101 @@ def generate_cert(root_ca_cert_str, server_cert_str, server_host):
   cert.sign(key, 'sha1')
 
   return _dump_cert(cert)
+
+
+def _format_asn1_time(timestamp):
+  """Format a timestamp like X509.get_notAfter() (e.g. '20150131235959Z')."""
+  return time.strftime('%Y%m%d%H%M%SZ', time.gmtime(timestamp))
+
+
+class CertCache(object):
+  """A directory of generated certificates that outlives the process.
+
+  Certificates are kept per root CA, in a subdirectory named after the
+  fingerprint of the CA, and per host and server certificate:
+    <cache_dir>/<CA fingerprint>/<quoted host>_<server cert hash>.pem
+  The whole subdirectory is read by load(), typically at startup.
+  """
+
+  def __init__(self, cache_dir, root_ca_cert_str):
+    """Initialize CertCache.
+
+    Args:
+      cache_dir: the directory of the cache (created when needed).
+      root_ca_cert_str: PEM formatted string of the root cert that signs the
+        cached certificates.
+    """
+    if openssl_import_error:
+      raise openssl_import_error  # pylint: disable=raising-bad-type
+    fingerprint = load_cert(root_ca_cert_str).digest('sha256')
+    self.cache_dir = os.path.join(
+        cache_dir, fingerprint.replace(':', '').lower())
+    self._certs = {}
+
+  @staticmethod
+  def _get_key(host, server_cert_str):
+    return host, hashlib.sha1(server_cert_str).hexdigest()
+
+  def _get_path(self, key):
+    host, server_cert_hash = key
+    return os.path.join(self.cache_dir, '%s_%s.pem' % (
+        urllib.quote(host, safe=''), server_cert_hash))
+
+  def load(self):
+    """Read all certificates of the cache that are still valid.
+
+    Certificates that expire within CERT_CACHE_MIN_VALIDITY_SECS are removed.
+
+    Returns:
+      the number of certificates in the cache.
+    """
+    if not os.path.isdir(self.cache_dir):
+      return len(self._certs)
+    min_not_after = _format_asn1_time(
+        time.time() + CERT_CACHE_MIN_VALIDITY_SECS)
+    for filename in os.listdir(self.cache_dir):
+      name, ext = os.path.splitext(filename)
+      if ext != '.pem' or '_' not in name:
+        continue
+      quoted_host, server_cert_hash = name.rsplit('_', 1)
+      path = os.path.join(self.cache_dir, filename)
+      try:
+        with open(path, 'r') as cert_file:
+          cert_str = cert_file.read()
+        not_after = load_cert(cert_str).get_notAfter()
+      except (IOError, crypto.Error), e:
+        logging.warning('Ignoring cached certificate %s: %s', path, e)
+        continue
+      if not_after < min_not_after:
+        try:
+          os.remove(path)
+        except OSError:
+          pass  # another process removed it
+        continue
+      self._certs[(urllib.unquote(quoted_host), server_cert_hash)] = cert_str
+    return len(self._certs)
+
+  def get(self, host, server_cert_str):
+    """Return the cached certificate string or None."""
+    return self._certs.get(self._get_key(host, server_cert_str))
+
+  def add(self, host, server_cert_str, cert_str):
+    """Add a generated certificate to the cache and write it to disk."""
+    key = self._get_key(host, server_cert_str)
+    self._certs[key] = cert_str
+    path = self._get_path(key)
+    # Other processes may load the cache, so only complete files are renamed
+    # into it.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+      if not os.path.isdir(self.cache_dir):
+        try:
+          os.makedirs(self.cache_dir)
+        except OSError:
+          if not os.path.isdir(self.cache_dir):  # else created by another
+            raise
+      with open(tmp_path, 'w') as cert_file:
+        cert_file.write(cert_str)
+      os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+      logging.warning('Unable to cache certificate of %s: %s', host, e)
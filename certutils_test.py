@@ -130,6 +130,47 @@ class CertutilsTest(unittest.TestCase):
     self.assertEqual(issuer, cert.get_issuer().commonName)
     self.assertEqual(subject, cert.get_subject().commonName)
 
+  def test_cert_cache(self):
+    cache_dir = os.path.join(self._temp_dir, 'cache')
+    root_string = ''.join(reversed(certutils.generate_dummy_ca_cert()))
+    server_cert = certutils.generate_cert(root_string, '', 'server')
+    cache = certutils.CertCache(cache_dir, root_string)
+    self.assertEqual(0, cache.load())
+    self.assertIsNone(cache.get('foo_bar.com', server_cert))
+    cert_string = certutils.generate_cert(root_string, server_cert, 'foo')
+    cache.add('foo_bar.com', server_cert, cert_string)
+    cache.add('baz.com', '', certutils.generate_cert(root_string, '', 'baz'))
+    self.assertEqual(cert_string, cache.get('foo_bar.com', server_cert))
+
+    # A new cache of the same root cert reads all the certificates.
+    cache = certutils.CertCache(cache_dir, root_string)
+    self.assertEqual(2, cache.load())
+    self.assertEqual(cert_string, cache.get('foo_bar.com', server_cert))
+    self.assertIsNone(cache.get('foo_bar.com', ''))
+    self.assertIsNone(cache.get('baz.com', server_cert))
+    self.assertTrue(cache.get('baz.com', ''))
+
+    # Another root cert has its own certificates.
+    other_root_string = ''.join(
+        reversed(certutils.generate_dummy_ca_cert('other')))
+    self.assertEqual(
+        0, certutils.CertCache(cache_dir, other_root_string).load())
+
+  def test_cert_cache_removes_expiring_certs(self):
+    cache_dir = os.path.join(self._temp_dir, 'cache')
+    root_string = ''.join(reversed(certutils.generate_dummy_ca_cert()))
+    cache = certutils.CertCache(cache_dir, root_string)
+    cache.add('foo.com', '', certutils.generate_cert(root_string, '', 'foo'))
+    self.assertEqual(1, len(os.listdir(cache.cache_dir)))
+
+    # Generated certificates are valid for 30 days.
+    self.addCleanup(setattr, certutils, 'CERT_CACHE_MIN_VALIDITY_SECS',
+                    certutils.CERT_CACHE_MIN_VALIDITY_SECS)
+    certutils.CERT_CACHE_MIN_VALIDITY_SECS = 60 * 60 * 24 * 31
+    cache = certutils.CertCache(cache_dir, root_string)
+    self.assertEqual(0, cache.load())
+    self.assertEqual([], os.listdir(cache.cache_dir))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import os
+import signal
 import threading
 
 
@@ -20,13 +23,9 @@ class DaemonServer(object):
   """Base class which manages creation and cleanup of daemon style servers."""
 
   def __enter__(self):
-    # TODO: Because of python's Global Interpreter Lock (GIL), the threads
-    # will run on the same CPU. Consider using processes instead because
-    # the components do not need to communicate with each other. On Linux,
-    # "taskset" could be used to assign each process to specific CPU/core.
-    # Of course, only bother with this if the processing speed is an issue.
-    # Some related discussion: http://stackoverflow.com/questions/990102/python-
-    # global-interpreter-lock-gil-workaround-on-multi-core-systems-using-tasks
+    # Because of python's Global Interpreter Lock (GIL), the threads will
+    # run on the same CPU. See WorkerProcessPool to serve from several
+    # processes.
     thread = threading.Thread(target=self.serve_forever)
     thread.daemon = True  # Python exits when no non-daemon threads are left.
     thread.start()
@@ -34,3 +33,92 @@ class DaemonServer(object):
 
   def __exit__(self, unused_exc_type, unused_exc_val, unused_exc_tb):
     self.cleanup()
+
+
+class WorkerProcessPool(object):
+  """Run copies of servers in forked worker processes.
+
+  Each worker calls the server initializers and serves until the pool is
+  exited or the parent process goes away. The servers have to be able to
+  share their ports with the copies in the parent and the other workers
+  (e.g. httpproxy.HttpProxyServer with reuse_port=True). Everything else,
+  such as a memory-mapped archive, is shared copy-on-write by fork().
+
+  Example:
+    with WorkerProcessPool(3, [(HttpProxyServer, args, kwargs)]):
+      [...]  # serve from this process as well
+  """
+
+  def __init__(self, num_workers, initializers, worker_init=None):
+    """Initialize a WorkerProcessPool.
+
+    Args:
+      num_workers: the number of processes to fork.
+      initializers: [(initializer, init_args, init_kwargs), ...] where
+          initializer returns a server with the with-statement interface.
+      worker_init: a function that is called in each worker before the
+          servers are created, or None.
+    """
+    self._num_workers = num_workers
+    self._initializers = initializers
+    self._worker_init = worker_init
+    self._worker_pids = []
+
+  def __enter__(self):
+    parent_pid = os.getpid()
+    for _ in xrange(self._num_workers):
+      pid = os.fork()
+      if pid == 0:
+        self._RunWorker(parent_pid)  # does not return
+      self._worker_pids.append(pid)
+    logging.info('Started worker processes: %s', self._worker_pids)
+    return self
+
+  def __exit__(self, unused_exc_type, unused_exc_val, unused_exc_tb):
+    for pid in self._worker_pids:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+    for pid in self._worker_pids:
+      try:
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+    self._worker_pids = []
+
+  def _RunWorker(self, parent_pid):
+    """Serve until SIGTERM or until the parent exits, then exit the process.
+
+    The worker never returns into the caller's stack, so that cleanup code of
+    the parent (e.g. restoring system settings) does not run twice.
+    """
+    stop = threading.Event()
+    def HandleSigterm(unused_signum, unused_frame):
+      stop.set()
+    signal.signal(signal.SIGTERM, HandleSigterm)
+    exit_status = 0
+    server_exits = []
+    try:
+      if self._worker_init:
+        self._worker_init()
+      for initializer, init_args, init_kwargs in self._initializers:
+        server = initializer(*init_args, **init_kwargs)
+        server_exits.insert(0, server.__exit__)
+        server.__enter__()
+      while not stop.is_set() and os.getppid() == parent_pid:
+        stop.wait(1)
+    except KeyboardInterrupt:
+      pass
+    except Exception:
+      logging.exception('Worker process %d failed.', os.getpid())
+      exit_status = 1
+    finally:
+      for server_exit in server_exits:
+        try:
+          server_exit(None, None, None)
+        except Exception:
+          logging.exception('Worker process %d failed to stop a server.',
+                            os.getpid())
+          exit_status = 1
+      os._exit(exit_status)  # pylint: disable=protected-access
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Schedule replay delays by their deadlines.
+
+Replay delays (round trip, response headers, data chunks and bandwidth
+pacing) are expressed as absolute deadlines, so that the oversleep of one
+wait does not add up over the following ones.
+
+TimerHeap keeps the delays of many responses in one heap for an event loop
+that resumes each write at its deadline (see eventloopproxy). Threaded
+servers wait for a deadline with SleepUntil().
+
+See delayscheduler_benchmark.py for the accuracy of the two at increasing
+concurrency.
+"""
+
+import heapq
+import itertools
+import time
+
+import platformsettings
+
+
+TIMER = platformsettings.timer
+
+
+class TimerHeap(object):
+  """Callbacks ordered by deadline. Not thread-safe."""
+
+  def __init__(self):
+    self._timers = []  # heap of (deadline, sequence number, callback, args)
+    self._sequence = itertools.count()
+
+  def __len__(self):
+    return len(self._timers)
+
+  def call_at(self, deadline, callback, *args):
+    """Call |callback| with |args| at |deadline| (a TIMER() value)."""
+    heapq.heappush(
+        self._timers, (deadline, next(self._sequence), callback, args))
+
+  def call_later(self, delay, callback, *args):
+    """Call |callback| with |args| after |delay| seconds."""
+    self.call_at(TIMER() + delay, callback, *args)
+
+  def get_timeout(self):
+    """Return the seconds until the next deadline, or None if there is none."""
+    if not self._timers:
+      return None
+    return max(0, self._timers[0][0] - TIMER())
+
+  def run_due(self):
+    """Call the callbacks whose deadlines have passed, earliest first."""
+    now = TIMER()
+    while self._timers and self._timers[0][0] <= now:
+      _, _, callback, args = heapq.heappop(self._timers)
+      callback(*args)
+
+
+def SleepUntil(deadline):
+  """Block the calling thread until |deadline| (a TIMER() value)."""
+  wait = deadline - TIMER()
+  if wait > 0:
+    time.sleep(wait)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the accuracy of replay delays at increasing concurrency.
+
+Each of N simulated responses waits for a sequence of random delays (like
+chunk delays with --use_server_delay). The delays are served by:
+  threads: a thread per response that sleeps (httpproxy.HttpProxyServer).
+  eventloop: one thread that runs all of the delays from a TimerHeap
+      (eventloopproxy.EventLoopHttpProxyServer).
+For each, the lateness of the wake-ups (actual - requested) is reported.
+The concurrency ceiling of threads is where they cannot be started any more.
+
+It also reports the aggregate rate of concurrent connections with bandwidth
+shaping: with a sleep per packet that is multiplied by the number of
+connections (the old RateLimitedFile) and with a shared BandwidthShaper.
+
+Usage:
+$ ./delayscheduler_benchmark.py [--concurrency 10,100,1000] [--waits 10]
+"""
+
+import optparse
+import random
+import sys
+import threading
+import time
+
+import delayscheduler
+import proxyshaper
+
+TIMER = delayscheduler.TIMER
+
+
+def _RunThreads(concurrency, delay_lists):
+  """Return the lateness of each wait, or None if threads ran out."""
+  lateness = []
+  def Run(delays):
+    for delay in delays:
+      deadline = TIMER() + delay
+      delayscheduler.SleepUntil(deadline)
+      lateness.append(TIMER() - deadline)
+  threads = []
+  try:
+    for delays in delay_lists[:concurrency]:
+      thread = threading.Thread(target=Run, args=(delays,))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+  except (threading.ThreadError, MemoryError):
+    return None
+  finally:
+    for thread in threads:
+      thread.join()
+  return lateness
+
+
+def _RunEventLoop(concurrency, delay_lists):
+  timers = delayscheduler.TimerHeap()
+  lateness = []
+  def Wake(deadline, delays):
+    lateness.append(TIMER() - deadline)
+    if delays:
+      next_deadline = TIMER() + delays[0]
+      timers.call_at(next_deadline, Wake, next_deadline, delays[1:])
+  for delays in delay_lists[:concurrency]:
+    deadline = TIMER() + delays[0]
+    timers.call_at(deadline, Wake, deadline, delays[1:])
+  while len(timers):
+    time.sleep(timers.get_timeout())
+    timers.run_due()
+  return lateness
+
+
+def _FormatLateness(lateness):
+  if lateness is None:
+    return 'could not start the threads (concurrency ceiling)'
+  lateness = sorted(lateness)
+  def Ms(value):
+    return '%.2f' % (value * 1000.0)
+  return 'mean %sms p50 %sms p99 %sms max %sms' % (
+      Ms(sum(lateness) / len(lateness)), Ms(lateness[len(lateness) / 2]),
+      Ms(lateness[len(lateness) * 99 / 100]), Ms(lateness[-1]))
+
+
+class _NullFile(object):
+
+  def write(self, data):
+    pass
+
+
+def _MeasureShaping(num_connections, num_bytes, bps):
+  """Return the aggregate bits per second with and without a shared shaper.
+
+  Each connection writes |num_bytes|. The connections start in turn.
+  """
+  shaper = proxyshaper.BandwidthShaper(bps)
+  def SleepPerPacket():
+    for _ in xrange(0, num_bytes, proxyshaper.RateLimitedFile.BYTES_PER_WRITE):
+      time.sleep(shaper.transfer_seconds(
+          proxyshaper.RateLimitedFile.BYTES_PER_WRITE) * num_connections)
+  def Shaper():
+    proxyshaper.RateLimitedFile(shaper, _NullFile()).write('x' * num_bytes)
+  results = []
+  for write in (SleepPerPacket, Shaper):
+    threads = [threading.Thread(target=write) for _ in xrange(num_connections)]
+    start = TIMER()
+    for thread in threads:
+      thread.start()
+      time.sleep(0.001)
+    for thread in threads:
+      thread.join()
+    results.append(8.0 * num_bytes * num_connections / (TIMER() - start))
+  return results
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options]')
+  option_parser.add_option('-c', '--concurrency', default='10,100,1000',
+                           help='Comma-separated numbers of responses.')
+  option_parser.add_option('-w', '--waits', default=10, type='int',
+                           help='Delays per response.')
+  option_parser.add_option('-d', '--max_delay_ms', default=20, type='int',
+                           help='Maximum delay in milliseconds.')
+  options, _ = option_parser.parse_args()
+
+  concurrencies = [int(c) for c in options.concurrency.split(',')]
+  random.seed(0)
+  delay_lists = [
+      [random.uniform(0.001, options.max_delay_ms / 1000.0)
+       for _ in xrange(options.waits)]
+      for _ in xrange(max(concurrencies))]
+  for concurrency in concurrencies:
+    print 'concurrency %d:' % concurrency
+    print '  threads:   %s' % _FormatLateness(
+        _RunThreads(concurrency, delay_lists))
+    print '  eventloop: %s' % _FormatLateness(
+        _RunEventLoop(concurrency, delay_lists))
+
+  bps = 10 * 1000 * 1000
+  for num_connections in (1, 10):
+    print 'shaping %d connection(s) to 10Mbit/s:' % num_connections
+    for name, achieved_bps in zip(
+        ('sleep per packet', 'shared shaper'),
+        _MeasureShaping(num_connections, 1000 * 1000 / num_connections, bps)):
+      print '  %s: %.2fMbit/s (%+.1f%%)' % (
+          name, achieved_bps / 1e6, 100.0 * (achieved_bps - bps) / bps)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import delayscheduler
+
+TIMER = delayscheduler.TIMER
+
+
+class TimerHeapTest(unittest.TestCase):
+
+  def test_runs_due_timers_in_deadline_order(self):
+    timers = delayscheduler.TimerHeap()
+    calls = []
+    now = TIMER()
+    timers.call_at(now - 1, calls.append, 'b')
+    timers.call_at(now - 2, calls.append, 'a')
+    timers.call_at(now - 1, calls.append, 'c')  # same deadline, added later
+    timers.call_at(now + 60, calls.append, 'later')
+    timers.run_due()
+    self.assertEqual(['a', 'b', 'c'], calls)
+    self.assertEqual(1, len(timers))
+    self.assertLess(59, timers.get_timeout())
+
+  def test_timeout_without_timers(self):
+    self.assertIsNone(delayscheduler.TimerHeap().get_timeout())
+
+
+class SleepUntilTest(unittest.TestCase):
+
+  def test_sleep_until(self):
+    deadline = TIMER() + 0.05
+    delayscheduler.SleepUntil(deadline)
+    self.assertLessEqual(deadline, TIMER())
+
+  def test_past_deadline_does_not_wait(self):
+    start = TIMER()
+    delayscheduler.SleepUntil(start - 60)
+    self.assertLess(TIMER() - start, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
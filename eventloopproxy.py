@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An HTTP proxy server that serves all connections from one event loop.
+
+httpproxy.HttpProxyServer uses a thread, with its stack, for each
+connection. EventLoopHttpProxyServer serves the same requests with
+non-blocking sockets from a single thread:
+  - Requests are parsed as their bytes arrive.
+  - Custom handlers and the archive fetch run on a small pool of threads, so
+    that slow fetches (e.g. in record mode) do not stall other connections.
+  - Round-trip, header and chunk delays are timers in the loop instead of
+    sleeping threads.
+
+Responses are written like httpproxy.HttpArchiveHandler writes them.
+Bandwidth shaping, TCP slow start, packet loss and jitter (see proxyshaper)
+are not supported.
+Requires poll() or epoll() (POSIX).
+"""
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import select
+import socket
+import threading
+import time
+
+import daemonserver
+import delayscheduler
+import httparchive
+import httpproxy
+import platformsettings
+import proxyshaper
+
+# Same limits as BaseHTTPServer.
+MAX_REQUEST_LINE_LENGTH = 65536
+MAX_HEADERS_LENGTH = 65536 * 4
+
+RECV_SIZE = 65536
+# Pending output smaller than this is joined into a single send() (e.g. the
+# headers and the first chunks). Larger buffers are sent without copying.
+COALESCE_SIZE = 65536
+
+# epoll and poll use the same values for these events.
+_READ = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+_WRITE = select.POLLOUT
+
+_BLOCKING_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _Poller(object):
+  """Wait for file descriptor events with epoll, or poll if unavailable."""
+
+  def __init__(self):
+    if hasattr(select, 'epoll'):
+      self._poll = select.epoll()
+      self._timeout_scale = 1.0  # epoll takes seconds
+      self._no_timeout = -1
+    else:
+      self._poll = select.poll()
+      self._timeout_scale = 1000.0  # poll takes milliseconds
+      self._no_timeout = None
+
+  def register(self, fd, events):
+    self._poll.register(fd, events)
+
+  def modify(self, fd, events):
+    self._poll.modify(fd, events)
+
+  def unregister(self, fd):
+    self._poll.unregister(fd)
+
+  def poll(self, timeout):
+    """Return [(fd, events), ...]. |timeout| is in seconds or None."""
+    if timeout is None:
+      timeout = self._no_timeout
+    else:
+      timeout *= self._timeout_scale
+    try:
+      return self._poll.poll(timeout)
+    except (IOError, select.error) as e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+
+  def close(self):
+    if hasattr(self._poll, 'close'):
+      self._poll.close()
+
+
+class _Connection(object):
+  """One client connection and the request that it is being served."""
+
+  def __init__(self, server, sock):
+    self.server = server
+    self.sock = sock
+    self.fd = sock.fileno()
+    self.is_closed = False
+    self._in_buffer = ''
+    self._out_buffers = collections.deque()
+    self._events = _READ
+    # True while a request is fetched or its response is written.
+    self._is_serving = False
+    self._request = None
+    self._response = None
+    self._start_time = None
+    self._close_connection = True
+    # [(delay_in_seconds, data), ...] that is not written yet.
+    self._steps = collections.deque()
+    self._is_waiting_for_delay = False
+
+  def run(self, func, *args):
+    """Call |func| and close the connection if it raises."""
+    try:
+      func(*args)
+    except Exception:
+      logging.exception('Error serving connection')
+      self.close()
+
+  def handle_events(self, events):
+    if events & _WRITE and self._flush():
+      self._advance_response()
+    if events & _READ and not self.is_closed:
+      self._receive()
+
+  def _receive(self):
+    try:
+      data = self.sock.recv(RECV_SIZE)
+    except socket.error as e:
+      if e.args[0] in _BLOCKING_ERRNOS:
+        return
+      self.close()
+      return
+    if not data:
+      # The client closed the connection.
+      self.close()
+      return
+    self._in_buffer += data
+    if not self._is_serving:
+      self._parse_request()
+
+  def _parse_request(self):
+    """Start serving the next request once all of it has been received."""
+    header_end = self._in_buffer.find('\r\n\r\n')
+    if header_end < 0:
+      request_line_end = self._in_buffer.find('\r\n')
+      if (request_line_end < 0 and
+          len(self._in_buffer) > MAX_REQUEST_LINE_LENGTH):
+        self._send_error(414)
+      elif len(self._in_buffer) > MAX_HEADERS_LENGTH:
+        self._send_error(400)
+      return
+    lines = self._in_buffer[:header_end].split('\r\n')
+    if len(lines[0]) > MAX_REQUEST_LINE_LENGTH:
+      self._send_error(414)
+      return
+    words = lines[0].split()
+    if len(words) != 3 or not words[2].startswith('HTTP/'):
+      self._send_error(400)
+      return
+    command, path, request_version = words
+
+    # Like mimetools.Message: lower case keys and the last value wins.
+    headers = {}
+    key = None
+    for line in lines[1:]:
+      if line[:1] in (' ', '\t') and key:
+        headers[key] = '%s %s' % (headers[key], line.strip())
+        continue
+      key, separator, value = line.partition(':')
+      if not separator:
+        key = None
+        continue
+      key = key.strip().lower()
+      headers[key] = value.strip()
+
+    try:
+      body_length = int(headers.get('content-length', 0) or 0)
+    except ValueError:
+      self._send_error(400)
+      return
+    body_start = header_end + len('\r\n\r\n')
+    if len(self._in_buffer) < body_start + body_length:
+      return  # wait for the rest of the body
+    request_body = self._in_buffer[body_start:body_start + body_length] or None
+    self._in_buffer = self._in_buffer[body_start + body_length:]
+
+    # Same keep-alive rules as BaseHTTPRequestHandler.parse_request().
+    connection_type = headers.get('connection', '').lower()
+    self._close_connection = request_version < 'HTTP/1.1'
+    if connection_type == 'close':
+      self._close_connection = True
+    elif connection_type == 'keep-alive':
+      self._close_connection = False
+
+    self._start_serving()
+    self._request = httpproxy.CreateArchivedHttpRequest(
+        command, path, headers, request_body, self.server.is_ssl)
+    if self._request is None:
+      self._start_response(httparchive.create_response(500))
+      return
+    self.server.fetch(self, self._request)
+
+  def _start_serving(self):
+    self._is_serving = True
+    self._start_time = time.time()
+    self.server.num_active_requests += 1
+
+  def handle_fetched_response(self, response):
+    """Called in the event loop with the response from the fetch threads."""
+    if self.is_closed:
+      return
+    self._response = response
+    self._start_response(response or httparchive.create_response(404))
+
+  def _send_error(self, status):
+    """Respond with |status| to a request that cannot be parsed."""
+    self._in_buffer = ''
+    self._close_connection = True
+    self._start_serving()
+    self._start_response(httparchive.create_response(status))
+
+  def _start_response(self, response):
+    """Queue the header block and chunks of |response| with their delays.
+
+    This follows httpproxy.HttpArchiveHandler.send_archived_http_response().
+    """
+    is_chunked = response.is_chunked()
+    connection = response.get_header('connection', '').lower()
+    if connection == 'close':
+      self._close_connection = True
+    elif connection == 'keep-alive':
+      self._close_connection = False
+    if response.version == 10:
+      self._close_connection = True
+
+    headers_delay_ms = 0
+    data_delays = [0] * len(response.response_data)
+    if not self.server.http_archive_fetch.is_record_mode:
+      headers_delay_ms += self.server.traffic_shaping_delay_ms
+      if self.server.use_delays:
+        headers_delay_ms += response.delays['headers']
+        data_delays = response.delays['data']
+
+    self._steps.append(
+        (headers_delay_ms / 1000.0, response.get_wire_headers()))
+    for chunk, delay in zip(response.response_data, data_delays):
+      if is_chunked:
+        # Write chunk length (hex) and data (e.g. "A\r\nTESSELATED\r\n").
+        self._steps.append(
+            (delay / 1000.0, '%x\r\n%s\r\n' % (len(chunk), chunk)))
+      else:
+        self._steps.append((delay / 1000.0, chunk))
+    if is_chunked:
+      self._steps.append((0, '0\r\n\r\n'))  # final, zero-length chunk.
+    self._advance_response()
+
+  def _advance_response(self):
+    """Write the steps of the response that are due and finish when done."""
+    while self._steps and not self._is_waiting_for_delay:
+      delay, data = self._steps[0]
+      if delay > 0:
+        # Like HttpArchiveHandler, start the delay once the previous data
+        # has been flushed. Otherwise, this is called again when it is.
+        if self._flush():
+          self._is_waiting_for_delay = True
+          self.server.call_later(delay, self.run, self._end_delay)
+        return
+      self._steps.popleft()
+      if data:
+        self._out_buffers.append(data)
+    if (self._flush() and self._is_serving and not self._steps and
+        not self._is_waiting_for_delay):
+      self._finish_request()
+
+  def _end_delay(self):
+    self._is_waiting_for_delay = False
+    if self.is_closed:
+      return
+    self._steps[0] = (0, self._steps[0][1])
+    self._advance_response()
+
+  def _flush(self):
+    """Send as much as possible. Returns True iff everything has been sent."""
+    if self.is_closed:
+      return False
+    while self._out_buffers:
+      data = self._out_buffers[0]
+      if (len(self._out_buffers) > 1 and
+          len(data) + len(self._out_buffers[1]) <= COALESCE_SIZE):
+        pieces = []
+        num_bytes = 0
+        while (self._out_buffers and
+               num_bytes + len(self._out_buffers[0]) <= COALESCE_SIZE):
+          pieces.append(self._out_buffers.popleft())
+          num_bytes += len(pieces[-1])
+        # Chunks may be buffers into an archive file (see archiveformat.py).
+        data = ''.join(str(p) for p in pieces)
+        self._out_buffers.appendleft(data)
+      try:
+        sent = self.sock.send(data)
+      except socket.error as e:
+        if e.args[0] in _BLOCKING_ERRNOS:
+          break
+        self.close()
+        return False
+      if sent < len(data):
+        self._out_buffers[0] = buffer(data, sent)
+        break
+      self._out_buffers.popleft()
+    events = _READ | _WRITE if self._out_buffers else _READ
+    if events != self._events:
+      self._events = events
+      self.server.poller.modify(self.fd, events)
+    return not self._out_buffers
+
+  def _finish_request(self):
+    request, response = self._request, self._response
+    self._request = self._response = None
+    self._is_serving = False
+    request_time_ms = (time.time() - self._start_time) * 1000.0
+    self.server.total_request_time += request_time_ms
+    self.server.num_active_requests -= 1
+    if request:
+      if response:
+        logging.debug('Served: %s (%dms)', request, request_time_ms)
+      else:
+        logging.warning('Failed to find response for: %s (%dms)',
+                        request, request_time_ms)
+    if self._close_connection:
+      self.close()
+    elif self._in_buffer:
+      self._parse_request()
+
+  def close(self):
+    if self.is_closed:
+      return
+    self.is_closed = True
+    if self._is_serving:
+      self.server.num_active_requests -= 1
+      self._is_serving = False
+    self.server.remove_connection(self)
+    try:
+      self.sock.close()
+    except socket.error:
+      pass
+
+
+class EventLoopHttpProxyServer(daemonserver.DaemonServer):
+  """Serve HTTP requests from an HttpArchive fetch in a single event loop.
+
+  Takes the same arguments as httpproxy.HttpProxyServer.
+  """
+
+  request_queue_size = 1024
+
+  # The number of simultaneous connections that the server is sized for.
+  connection_limit = 10000
+
+  # Threads that run custom handlers and archive fetches.
+  num_fetch_threads = 4
+
+  def __init__(self, http_archive_fetch, custom_handlers,
+               host='localhost', port=80, use_delays=False, is_ssl=False,
+               protocol='HTTP',
+               down_bandwidth='0', up_bandwidth='0', delay_ms='0',
+               init_cwnd='0', packet_loss_rate='0', jitter_ms='0',
+               jitter_distribution='normal', shaping_seed=None,
+               reuse_port=False):
+    """Start HTTP server.
+
+    Args:
+      host: a host string (name or IP) for the web proxy.
+      port: a port string (e.g. '80') for the web proxy.
+      use_delays: if True, add response data delays during replay.
+      is_ssl: True iff requests are considered secure (HTTP-to-HTTPS).
+      up_bandwidth, down_bandwidth: must be '0' (see module docstring).
+      delay_ms: Propagation delay in milliseconds. '0' means no delay.
+      init_cwnd, packet_loss_rate, jitter_ms: must be '0' (see module
+          docstring).
+      jitter_distribution, shaping_seed: ignored.
+      reuse_port: if True, bind with SO_REUSEPORT (see
+          httpproxy.HttpProxyServer).
+    Raises:
+      httpproxy.HttpProxyServerError: if the server cannot be started.
+    """
+    del jitter_distribution, shaping_seed  # unused
+    if (proxyshaper.GetBitsPerSecond(down_bandwidth) or
+        proxyshaper.GetBitsPerSecond(up_bandwidth) or int(init_cwnd) or
+        float(packet_loss_rate) or float(jitter_ms)):
+      raise httpproxy.HttpProxyServerError(
+          'The event loop proxy does not support bandwidth shaping, slow '
+          'start, packet loss or jitter.')
+    if platformsettings.SupportsFdLimitControl():
+      # Each connection needs one fd.
+      soft_limit, hard_limit = platformsettings.GetFdLimit()
+      desired_limit = self.connection_limit + 100
+      if hard_limit >= 0:  # not RLIM_INFINITY
+        desired_limit = min(desired_limit, hard_limit)
+      if soft_limit >= 0 and soft_limit < desired_limit:
+        platformsettings.AdjustFdLimit(desired_limit, hard_limit)
+
+    try:
+      self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      if reuse_port:
+        self.socket.setsockopt(
+            socket.SOL_SOCKET, platformsettings.GetReusePortOption(), 1)
+      self.socket.bind((host, port))
+      self.socket.listen(self.request_queue_size)
+      self.socket.setblocking(0)
+    except socket.error as e:
+      self.socket.close()
+      raise httpproxy.HttpProxyServerError(
+          'Could not start HTTPServer on port %d: %s' % (port, e))
+    self.server_address = self.socket.getsockname()
+    self.server_port = self.server_address[1]
+    self.http_archive_fetch = http_archive_fetch
+    self.custom_handlers = custom_handlers
+    self.use_delays = use_delays
+    self.is_ssl = is_ssl
+    self.traffic_shaping_delay_ms = int(delay_ms)
+    self.num_active_requests = 0
+    self.total_request_time = 0
+    self.protocol = protocol
+
+    self.poller = _Poller()
+    self._connections = {}  # fd -> _Connection
+    self._timers = delayscheduler.TimerHeap()
+    self._fetch_queue = Queue.Queue()
+    self._fetch_threads = []
+    self._fetched = collections.deque()  # (connection, response)
+    self._wakeup_fd, self._wakeup_write_fd = os.pipe()
+    for fd in (self._wakeup_fd, self._wakeup_write_fd):
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self._should_stop = False
+    self._is_shut_down = threading.Event()
+    self._is_shut_down.set()
+
+    # Note: This message may be scraped. Do not change it.
+    logging.warning(
+        '%s server started on %s:%d' % (self.protocol, self.server_address[0],
+                                        self.server_address[1]))
+
+  @property
+  def num_active_connections(self):
+    return len(self._connections)
+
+  def get_active_request_count(self):
+    return self.num_active_requests
+
+  def serve_forever(self):
+    """Run the event loop until shutdown() is called."""
+    self._is_shut_down.clear()
+    try:
+      for _ in xrange(self.num_fetch_threads):
+        thread = threading.Thread(target=self._run_fetches)
+        thread.daemon = True
+        thread.start()
+        self._fetch_threads.append(thread)
+      self.poller.register(self.socket.fileno(), _READ)
+      self.poller.register(self._wakeup_fd, _READ)
+      while not self._should_stop:
+        for fd, events in self.poller.poll(self._timers.get_timeout()):
+          if fd == self.socket.fileno():
+            self._accept()
+          elif fd == self._wakeup_fd:
+            self._drain_wakeup()
+          else:
+            connection = self._connections.get(fd)
+            if connection:
+              connection.run(connection.handle_events, events)
+        self._run_fetched()
+        self._timers.run_due()
+    finally:
+      self._should_stop = False
+      self._is_shut_down.set()
+
+  def shutdown(self):
+    """Stop serve_forever() and wait for it to return."""
+    self._should_stop = True
+    self._wakeup()
+    self._is_shut_down.wait()
+
+  def server_close(self):
+    for connection in self._connections.values():
+      connection.close()
+    for _ in self._fetch_threads:
+      self._fetch_queue.put(None)
+    self._fetch_threads = []
+    self.socket.close()
+    self.poller.close()
+    os.close(self._wakeup_fd)
+    os.close(self._wakeup_write_fd)
+
+  def cleanup(self):
+    try:
+      self.shutdown()
+      self.server_close()
+    except KeyboardInterrupt:
+      pass
+    logging.info('Stopped %s server. Total time processing requests: %dms',
+                 self.protocol, self.total_request_time)
+
+  def call_later(self, delay, callback, *args):
+    """Call |callback| with |args| from the event loop after |delay| secs."""
+    self._timers.call_later(delay, callback, *args)
+
+  def fetch(self, connection, request):
+    """Fetch the response for |request| on a fetch thread.
+
+    connection.handle_fetched_response() is called with the response from
+    the event loop.
+    """
+    self._fetch_queue.put((connection, request))
+
+  def remove_connection(self, connection):
+    self._connections.pop(connection.fd, None)
+    try:
+      self.poller.unregister(connection.fd)
+    except (IOError, KeyError, ValueError):
+      pass
+
+  def _accept(self):
+    while True:
+      try:
+        sock, _ = self.socket.accept()
+      except socket.error as e:
+        if e.args[0] in _BLOCKING_ERRNOS + (errno.ECONNABORTED,):
+          return
+        if e.args[0] in (errno.EMFILE, errno.ENFILE):
+          logging.error('Number of active connections (%s) reached the fd '
+                        'limit.', len(self._connections))
+          return
+        raise
+      sock.setblocking(0)
+      connection = _Connection(self, sock)
+      self._connections[connection.fd] = connection
+      self.poller.register(connection.fd, _READ)
+      if len(self._connections) >= self.connection_limit:
+        logging.error(
+            'Number of active connections (%s) surpasses the '
+            'supported limit of %s.' %
+            (len(self._connections), self.connection_limit))
+
+  def _run_fetches(self):
+    """Run custom handlers and the archive fetch (on a fetch thread)."""
+    while True:
+      item = self._fetch_queue.get()
+      if item is None:
+        return
+      connection, request = item
+      try:
+        response = self.custom_handlers.handle(request)
+        if not response:
+          response = self.http_archive_fetch(request)
+      except Exception:
+        logging.exception('Error fetching %s', request)
+        response = httparchive.create_response(500)
+      self._fetched.append((connection, response))
+      self._wakeup()
+
+  def _run_fetched(self):
+    while self._fetched:
+      connection, response = self._fetched.popleft()
+      connection.run(connection.handle_fetched_response, response)
+
+  def _wakeup(self):
+    try:
+      os.write(self._wakeup_write_fd, 'x')
+    except OSError as e:
+      if e.errno not in _BLOCKING_ERRNOS:  # the pipe is already full
+        raise
+
+  def _drain_wakeup(self):
+    try:
+      while os.read(self._wakeup_fd, 4096):
+        pass
+    except OSError as e:
+      if e.errno not in _BLOCKING_ERRNOS:
+        raise
+
+
+class EventLoopHttpToHttpsProxyServer(EventLoopHttpProxyServer):
+  """Listens for HTTP requests but sends them to the target as HTTPS requests"""
+
+  def __init__(self, http_archive_fetch, custom_handlers, **kwargs):
+    EventLoopHttpProxyServer.__init__(
+        self, http_archive_fetch, custom_handlers, is_ssl=True,
+        protocol='HTTP-to-HTTPS', **kwargs)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventloopproxy
+import httparchive
+import httplib
+import httpproxy
+import time
+import unittest
+
+
+class MockCustomResponseHandler(object):
+  def __init__(self, response):
+    self.response = response
+    self.requests = []
+
+  def handle(self, request):
+    self.requests.append(request)
+    return self.response
+
+
+class MockHttpArchiveFetch(object):
+  def __init__(self):
+    self.is_record_mode = False
+
+  def __call__(self, request):
+    return None
+
+
+class EventLoopHttpProxyServerTest(unittest.TestCase):
+
+  PORT = 8891
+
+  def create_server(self, response, **kwargs):
+    self.custom_handlers = MockCustomResponseHandler(response)
+    return eventloopproxy.EventLoopHttpProxyServer(
+        MockHttpArchiveFetch(), self.custom_handlers, host='localhost',
+        port=self.PORT, **kwargs)
+
+  def create_connection(self):
+    return httplib.HTTPConnection('localhost', self.PORT, timeout=10)
+
+  def test_serves_response(self):
+    response = httparchive.create_response(
+        200, headers=[('content-type', 'text/plain')], body='bat1')
+    with self.create_server(response):
+      conn = self.create_connection()
+      conn.request('POST', '/index.html?q=1', body='data')
+      res = conn.getresponse()
+      self.assertEqual(200, res.status)
+      self.assertEqual('text/plain', res.getheader('content-type'))
+      self.assertEqual('4', res.getheader('content-length'))
+      self.assertEqual('bat1', res.read())
+      conn.close()
+    request = self.custom_handlers.requests[0]
+    self.assertEqual('/index.html?q=1', request.full_path)
+    self.assertEqual('data', request.request_body)
+
+  def test_serves_buffer_chunks(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [], [buffer('bat1'), buffer('xbat2', 1)])
+    with self.create_server(response):
+      conn = self.create_connection()
+      conn.request('GET', '/')
+      res = conn.getresponse()
+      self.assertEqual('8', res.getheader('content-length'))
+      self.assertEqual('bat1bat2', res.read())
+      conn.close()
+    self.assertEqual([], response.headers)
+
+  def test_not_found(self):
+    with self.create_server(None):
+      conn = self.create_connection()
+      conn.request('GET', '/')
+      self.assertEqual(404, conn.getresponse().status)
+      conn.close()
+
+  def test_chunked_response(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('transfer-encoding', 'chunked')], ['bat1', 'bat2'])
+    with self.create_server(response):
+      conn = self.create_connection()
+      conn.request('GET', '/')
+      self.assertEqual('bat1bat2', conn.getresponse().read())
+      conn.close()
+
+  def test_delays(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [], ['bat1', 'bat2'],
+        delays={'connect': 0, 'headers': 100, 'data': [0, 100]})
+    with self.create_server(response, use_delays=True, delay_ms='50'):
+      conn = self.create_connection()
+      start = time.time()
+      conn.request('GET', '/')
+      self.assertEqual('bat1bat2', conn.getresponse().read())
+      self.assertLessEqual(0.25, time.time() - start)
+      conn.close()
+
+  def test_bandwidth_is_not_supported(self):
+    self.assertRaises(httpproxy.HttpProxyServerError, self.create_server,
+                      None, down_bandwidth='1Mbit/s')
+
+  def test_many_keep_alive_connections(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('connection', 'keep-alive')], ['bat1'])
+    with self.create_server(response) as server:
+      connections = []
+      for _ in range(400):
+        conn = self.create_connection()
+        conn.request('GET', '/', headers={'Connection': 'keep-alive'})
+        self.assertEqual('bat1', conn.getresponse().read())
+        connections.append(conn)
+      # Repeat the requests on the open connections.
+      for conn in connections:
+        conn.request('GET', '/', headers={'Connection': 'keep-alive'})
+        self.assertEqual('bat1', conn.getresponse().read())
+      self.assertEqual(400, server.num_active_connections)
+      for conn in connections:
+        conn.close()
+    self.assertEqual(800, len(self.custom_handlers.requests))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -38,23 +38,43 @@ To print statistics of a set of URLs:
 
 To merge multiple archives
   $ ./httparchive.py merge --merged_file new.wpr archive1.wpr archive2.wpr ...
+
+To convert an archive from the older, pickled format to the indexed format:
+  $ ./httparchive.py convert archive.wpr
+
+To write a copy of an archive with deterministic.js injected into all pages:
+  $ ./httparchive.py bake --baked_file baked.wpr archive.wpr
+
+To fetch all requests of an archive again into a new archive:
+  $ ./httparchive.py refetch --refetched_file new.wpr archive.wpr
+
+To fetch the requests of a request list (see LoadRequestList) into an archive:
+  $ ./httparchive.py refetch --request_list --refetched_file new.wpr urls.txt
 """
 
+import archiveformat
+import ast
+import bisect
 import calendar
 import certutils
+import collections
 import cPickle
 import difflib
 import email.utils
+import heapq
 import httplib
 import httpzlib
 import json
 import logging
 import optparse
 import os
+import Queue
+import script_injector
 import StringIO
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urlparse
 from collections import defaultdict
@@ -86,10 +106,32 @@ class HttpArchive(dict):
         in sync with the underlying dict of self. It is used as an optimization
         so that get_requests() doesn't have to linearly search all requests in
         the archive to find potential matches.
+    closest_match_index: dict of {hostname, {(command, is_ssl, path):
+        _ClosestMatchCandidates}}. Candidates for find_closest_request() that
+        are built on first use. Entries for a host are dropped whenever a
+        request for that host is added or removed.
+    metadata: dict of properties that describe the archive as a whole. It is
+        persisted with the archive. Keys include:
+          'inject_script_hash': the script_injector.GetInjectScriptHash() of
+              the script that bake() injected into all HTML responses. Adding
+              an HTML response removes it, since the new response is not
+              baked.
+    record_queue: a httpclient.RecordQueue or None. In a worker process
+        that records (see replay.py --workers), it forwards the certificates
+        that are added to the archive to the process that persists it.
   """
 
+  # Journal queue items besides (record, chunks).
+  _TRUNCATE_JOURNAL = 'truncate'
+  _CLOSE_JOURNAL = 'close'
+
   def __init__(self):  # pylint: disable=super-init-not-called
     self.responses_by_host = defaultdict(dict)
+    self.closest_match_index = {}
+    self.metadata = {}
+    self.record_queue = None
+    self._journal_queue = None
+    self._journal_thread = None
 
   def __setstate__(self, state):
     """Influence how to unpickle.
@@ -98,7 +140,13 @@ class HttpArchive(dict):
       state: a dictionary for __dict__
     """
     self.__dict__.update(state)
+    if 'metadata' not in state:
+      self.metadata = {}
     self.responses_by_host = defaultdict(dict)
+    self.closest_match_index = {}
+    self.record_queue = None
+    self._journal_queue = None
+    self._journal_thread = None
     for request in self:
       self.responses_by_host[request.host][request] = self[request]
 
@@ -110,16 +158,111 @@ class HttpArchive(dict):
     """
     state = self.__dict__.copy()
     del state['responses_by_host']
+    del state['closest_match_index']
+    state.pop('record_queue', None)
+    state.pop('_journal_queue', None)
+    state.pop('_journal_thread', None)
     return state
 
   def __setitem__(self, key, value):
+    old_value = dict.get(self, key)
     super(HttpArchive, self).__setitem__(key, value)
     if hasattr(self, 'responses_by_host'):
       self.responses_by_host[key.host][key] = value
+    if hasattr(self, 'closest_match_index'):
+      self.closest_match_index.pop(key.host, None)
+    # Scripts are only injected into HTML responses (see bake), so other
+    # responses (e.g. certificates) keep the archive baked.
+    if hasattr(self, 'metadata') and (
+        value.is_html() or (old_value is not None and old_value.is_html())):
+      self.metadata.pop('inject_script_hash', None)
+    if getattr(self, '_journal_queue', None):
+      self._journal_queue.put(
+          ((key, _GetEntryFields(value)), list(value.response_data)))
 
   def __delitem__(self, key):
     super(HttpArchive, self).__delitem__(key)
     del self.responses_by_host[key.host][key]
+    self.closest_match_index.pop(key.host, None)
+    if self._journal_queue:
+      self._journal_queue.put(((key, None), []))
+
+  def clear(self):
+    super(HttpArchive, self).clear()
+    self.responses_by_host.clear()
+    self.closest_match_index.clear()
+    self.metadata.clear()
+    if self._journal_queue:
+      self._journal_queue.put(self._TRUNCATE_JOURNAL)
+
+  def StartJournal(self, filename):
+    """Append every change of the archive to the journal |filename|.
+
+    Records are written by a background thread, so adding a response does
+    not wait for the disk. An existing journal is continued, so it only holds
+    the changes since the archive was last persisted (see LoadJournal).
+    Call CloseJournal() to stop.
+
+    Each record is (request, (version, status, reason, headers, delays)) with
+    the response body as chunks, or (request, None) if it was removed.
+    clear() empties the journal.
+    """
+    writer = archiveformat.JournalWriter(filename)
+    self._journal_queue = Queue.Queue()
+    self._journal_thread = threading.Thread(
+        target=self._WriteJournal, args=(writer, self._journal_queue))
+    self._journal_thread.daemon = True
+    self._journal_thread.start()
+
+  def _WriteJournal(self, writer, journal_queue):
+    while True:
+      item = journal_queue.get()
+      try:
+        if item == self._CLOSE_JOURNAL:
+          writer.close()
+          return
+        elif item == self._TRUNCATE_JOURNAL:
+          writer.truncate()
+        else:
+          writer.append(*item)
+      except Exception:
+        logging.exception('Failed to write journal %s', writer.filename)
+
+  def CloseJournal(self):
+    """Wait for pending journal records and close the journal."""
+    if not self._journal_thread:
+      return
+    self._journal_queue.put(self._CLOSE_JOURNAL)
+    self._journal_thread.join()
+    self.DetachJournal()
+
+  def DetachJournal(self):
+    """Stop journaling in this process without closing the journal.
+
+    Use it in processes forked while journaling, which do not have the
+    writer thread.
+    """
+    self._journal_queue = None
+    self._journal_thread = None
+
+  def LoadJournal(self, filename):
+    """Apply the records of the journal |filename| to the archive.
+
+    Response bodies are read from the journal when they are first accessed.
+    Returns:
+      the number of records applied
+    """
+    reader = archiveformat.JournalReader(filename)
+    for (request, fields), extents in reader.records:
+      if fields is None:
+        if request in self:
+          del self[request]
+        continue
+      version, status, reason, headers, delays = fields
+      self[request] = ArchivedHttpResponse(
+          version, status, reason, headers,
+          archiveformat.ChunkList(reader, extents), delays)
+    return len(reader.records)
 
   def get(self, request, default=None):
     """Return the archived response for a given request.
@@ -233,7 +376,9 @@ class HttpArchive(dict):
   def cat(self, command=None, host=None, full_path=None):
     """Print the contents of all URLs that match given params."""
     out = StringIO.StringIO()
-    for request in self.get_requests(command, host, full_path):
+    requests = self.get_requests(command, host, full_path)
+    bodies = GetDataAsTextBulk([self[r] for r in requests])
+    for request, body in zip(requests, bodies):
       print >>out, str(request)
       print >>out, 'Untrimmed request headers:'
       for k in request.headers:
@@ -254,7 +399,6 @@ class HttpArchive(dict):
                     'Chunk lengths: %s\n'
                     'Chunk delays: %s') % (
           len(chunk_lengths), chunk_lengths, response.delays['data'])
-      body = response.get_data_as_text()
       print >>out, '---- Response Data', '-' * 51
       if body:
         print >>out, body
@@ -276,6 +420,7 @@ class HttpArchive(dict):
         'Domains': defaultdict(int),
         'HTTP_response_code': defaultdict(int),
         'content_type': defaultdict(int),
+        'content_encoding': defaultdict(int),
         'Documents': defaultdict(int),
         }
 
@@ -288,6 +433,8 @@ class HttpArchive(dict):
       str_content_type = str(content_type.split(';')[0]
                             if content_type else None)
       stats['content_type'][str_content_type] += 1
+      stats['content_encoding'][
+          str(self[request].get_header('content-encoding'))] += 1
 
       #  Documents are the main URL requested and not a referenced resource.
       if str_content_type == 'text/html' and not 'referer' in request.headers:
@@ -346,6 +493,83 @@ class HttpArchive(dict):
     response.set_response_from_text(''.join(open(tmp_file.name).readlines()))
     os.remove(tmp_file.name)
 
+  def bake(self, baked_file, inject_script):
+    """Persist a copy of the archive with |inject_script| in all HTML pages.
+
+    The script is injected the same way as during record and replay, and the
+    response bodies are recompressed. The archive is tagged with the script
+    hash, so replay can skip injecting the same script again. It is not
+    tagged if a page has a content-encoding that cannot be uncompressed here
+    (e.g. br without the brotli module), so that replay injects into it.
+
+    Args:
+      baked_file: the file name for the new archive.
+      inject_script: JavaScript string (e.g. from GetInjectScript()).
+    """
+    html_items = [(request, response) for request, response in self.iteritems()
+                  if response.is_html()]
+    html_responses = [response for _, response in html_items]
+    injected_responses = []
+    injected_texts = []
+    num_not_text = 0
+    for (request, response), text in zip(html_items,
+                                         GetDataAsTextBulk(html_responses)):
+      if text is None:
+        logging.warning('Cannot inject script into %s with content-encoding %s',
+                        request, response.get_header('content-encoding'))
+        num_not_text += 1
+        continue
+      text, already_injected = script_injector.InjectScript(
+          text, 'text/html', inject_script)
+      if not already_injected:
+        injected_responses.append(response)
+        injected_texts.append(text)
+    SetDataBulk(injected_responses, injected_texts)
+    num_injected = len(injected_responses)
+    if num_not_text:
+      self.metadata.pop('inject_script_hash', None)
+      print 'Not baked: could not inject script into %d responses' % (
+          num_not_text)
+    else:
+      self.metadata['inject_script_hash'] = (
+          script_injector.GetInjectScriptHash(inject_script))
+    self.Persist(baked_file)
+    print 'Injected script into %d of %d responses' % (num_injected, len(self))
+
+  def refetch(self, refetched_file, requests=None, num_fetchers=32):
+    """Fetch requests again from the web and persist them as a new archive.
+
+    The certificates of the archive are copied to the new archive.
+
+    Args:
+      refetched_file: the file name for the new archive.
+      requests: the ArchivedHttpRequests to fetch, or None for all of the
+          requests of the archive.
+      num_fetchers: the maximum number of concurrent fetches.
+    """
+    # These import this module.
+    import dnsproxy
+    import httpclient
+    import platformsettings
+
+    cert_commands = ('SERVER_CERT', 'DUMMY_CERT')
+    if requests is None:
+      requests = [r for r in self if r.command not in cert_commands]
+    real_dns_lookup = dnsproxy.RealDnsLookup(
+        name_servers=[platformsettings.get_original_primary_nameserver()])
+    start = time.time()
+    refetched_archive, failed_requests = httpclient.RefetchArchive(
+        requests, real_dns_lookup, num_fetchers)
+    for request, response in self.iteritems():
+      if request.command in cert_commands:
+        refetched_archive[request] = response
+    refetched_archive.Persist(refetched_file)
+    for request in failed_requests:
+      print 'Failed to fetch %s' % request
+    print 'Refetched %d of %d requests in %.1f seconds' % (
+        len(requests) - len(failed_requests), len(requests),
+        time.time() - start)
+
   def find_closest_request(self, request, use_path=False):
     """Find the closest matching request in the archive to the given request.
 
@@ -362,36 +586,24 @@ class HttpArchive(dict):
       Otherwise, return None.
     """
     full_path = request.full_path if use_path else None
-    requests = self.get_requests(request.command, request.host, full_path,
-                                 is_ssl=request.is_ssl, use_query=not use_path)
-
-    if not requests:
-      return None
-
-    if len(requests) == 1:
-      return requests[0]
-
-    matcher = difflib.SequenceMatcher(b=request.formatted_request)
-
-    # quick_ratio() is cheap to compute, but ratio() is expensive. So we call
-    # quick_ratio() on all requests, sort them descending, and then loop through
-    # until we find a candidate whose ratio() is >= the next quick_ratio().
-    # This works because quick_ratio() is guaranteed to be an upper bound on
-    # ratio().
-    candidates = []
-    for candidate in requests:
-      matcher.set_seq1(candidate.formatted_request)
-      candidates.append((matcher.quick_ratio(), candidate))
-
-    candidates.sort(reverse=True, key=lambda c: c[0])
-
-    best_match = (0, None)
-    for i in xrange(len(candidates)):
-      matcher.set_seq1(candidates[i][1].formatted_request)
-      best_match = max(best_match, (matcher.ratio(), candidates[i][1]))
-      if i + 1 < len(candidates) and best_match[0] >= candidates[i+1][0]:
-        break
-    return best_match[1]
+    if not request.host:
+      return _ClosestMatchCandidates(self.get_requests(
+          request.command, None, full_path, is_ssl=request.is_ssl,
+          use_query=not use_path)).find_closest(request)
+
+    # The host entry must be in place before the candidates are read, so that
+    # a concurrent __setitem__ for the host either happens before the read or
+    # drops the entry afterwards.
+    host_index = self.closest_match_index.setdefault(request.host, {})
+    path = request.path if use_path else None
+    key = (request.command, request.is_ssl, path)
+    candidates = host_index.get(key)
+    if candidates is None:
+      candidates = _ClosestMatchCandidates(self.get_requests(
+          request.command, request.host, full_path, is_ssl=request.is_ssl,
+          use_query=not use_path))
+      host_index[key] = candidates
+    return candidates.find_closest(request)
 
   def diff(self, request):
     """Diff the given request to the closest matching request in the archive.
@@ -411,16 +623,32 @@ class HttpArchive(dict):
 
   def get_server_cert(self, host):
     """Gets certificate from the server and stores it in archive"""
+    if not self.has_server_cert(host):
+      self.set_server_cert(host, certutils.get_host_cert(host))
     request = ArchivedHttpRequest('SERVER_CERT', host, '', None, {})
-    if request not in self:
-      self[request] = create_response(200, body=certutils.get_host_cert(host))
-    return self[request].response_data[0]
+    return str(self[request].response_data[0])
+
+  def has_server_cert(self, host):
+    """Return True if the server certificate of |host| is archived."""
+    return ArchivedHttpRequest('SERVER_CERT', host, '', None, {}) in self
+
+  def set_server_cert(self, host, server_cert):
+    """Archive |server_cert| as the server certificate of |host|."""
+    self._add_certificate(
+        ArchivedHttpRequest('SERVER_CERT', host, '', None, {}),
+        create_response(200, body=server_cert))
 
   def get_certificate(self, host):
     request = ArchivedHttpRequest('DUMMY_CERT', host, '', None, {})
     if request not in self:
-      self[request] = create_response(200, body=self._generate_cert(host))
-    return self[request].response_data[0]
+      self._add_certificate(
+          request, create_response(200, body=self._generate_cert(host)))
+    return str(self[request].response_data[0])
+
+  def _add_certificate(self, request, response):
+    self[request] = response
+    if self.record_queue:
+      self.record_queue.Put(request, response)
 
   @classmethod
   def AssertWritable(cls, filename):
@@ -436,20 +664,132 @@ class HttpArchive(dict):
 
   @classmethod
   def Load(cls, filename):
-    """Load an instance from filename."""
-    return cPickle.load(open(filename, 'rb'))
+    """Load an instance from filename.
+
+    Indexed archives (see archiveformat.py) only have their index read.
+    Response bodies are read from the file when they are first accessed.
+    Journals (see StartJournal) are loaded the same way. Archives in the
+    older, pickled format are unpickled in full.
+    """
+    if archiveformat.is_journal(filename):
+      archive = cls()
+      archive.LoadJournal(filename)
+      return archive
+    if not archiveformat.is_indexed_archive(filename):
+      logging.info('Loading pickled archive %s. Run "httparchive.py convert" '
+                   'to switch it to the faster indexed format.', filename)
+      return cPickle.load(open(filename, 'rb'))
+    reader = archiveformat.IndexedArchiveReader(filename)
+    archive = cls()
+    for (request, version, status, reason, headers, delays,
+         extents) in reader.index['entries']:
+      archive[request] = ArchivedHttpResponse(
+          version, status, reason, headers,
+          archiveformat.ChunkList(reader, extents), delays)
+    archive.metadata = reader.index.get('metadata', {})
+    return archive
 
   def Persist(self, filename):
-    """Persist all state to filename."""
+    """Persist all state to filename in the indexed format.
+
+    Only a shallow snapshot of the archive is taken while other threads are
+    locked out. Response bodies are streamed to the file afterwards.
+    """
     try:
       original_checkinterval = sys.getcheckinterval()
       sys.setcheckinterval(2**31-1)  # Lock out other threads so nothing can
-                                     # modify |self| during pickling.
-      pickled_self = cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL)
+                                     # modify |self| during the snapshot.
+      snapshot = [
+          (request,) + _GetEntryFields(response) + (response.response_data,)
+          for request, response in self.iteritems()]
+      metadata = self.metadata.copy()
     finally:
       sys.setcheckinterval(original_checkinterval)
-    with open(filename, 'wb') as f:
-      f.write(pickled_self)
+    writer = archiveformat.IndexedArchiveWriter(filename)
+    entries = []
+    try:
+      for entry in snapshot:
+        extents = writer.write_chunks(entry[-1])
+        entries.append(entry[:-1] + (extents,))
+    except Exception:
+      writer.abort()
+      raise
+    writer.close({'entries': entries, 'metadata': metadata})
+
+
+class _ClosestMatchCandidates(object):
+  """Requests indexed for finding the closest match to another request.
+
+  Closeness is difflib.SequenceMatcher.ratio() between formatted requests.
+  ratio() is expensive, so candidates are visited best-first by two cheaper
+  upper bounds on it:
+    - length bound: 2 * min(len(a), len(b)) / (len(a) + len(b)). Candidates
+      are sorted by length, so this bound is visited in decreasing order by
+      walking outwards from the length of the request.
+    - quick_ratio(): computed from per-candidate character counts, which are
+      cached on first use.
+  The search stops once no bound can beat the best ratio() found so far, so
+  only requests of similar length and character make-up are compared.
+  """
+
+  def __init__(self, requests):
+    requests = sorted(requests, key=lambda r: len(r.formatted_request))
+    self._requests = requests
+    self._lengths = [len(r.formatted_request) for r in requests]
+    self._char_counts = [None] * len(requests)
+
+  def _get_char_counts(self, i):
+    char_counts = self._char_counts[i]
+    if char_counts is None:
+      char_counts = collections.Counter(self._requests[i].formatted_request)
+      self._char_counts[i] = char_counts
+    return char_counts
+
+  def find_closest(self, request):
+    """Return the candidate with the highest ratio() or None if empty."""
+    if len(self._requests) < 2:
+      return self._requests[0] if self._requests else None
+
+    text = request.formatted_request
+    text_length = len(text)
+    text_char_counts = collections.Counter(text)
+    # Same argument order as difflib.get_close_matches(): b is fixed.
+    matcher = difflib.SequenceMatcher(b=text)
+
+    def LengthBound(i):
+      total = self._lengths[i] + text_length
+      return 2.0 * min(self._lengths[i], text_length) / total if total else 1.0
+
+    def QuickRatio(i):
+      counts = self._get_char_counts(i)
+      matches = sum(min(n, text_char_counts[c]) for c, n in counts.iteritems())
+      total = self._lengths[i] + text_length
+      return 2.0 * matches / total if total else 1.0
+
+    lower = bisect.bisect_left(self._lengths, text_length) - 1
+    upper = lower + 1
+    pending = []  # heap of (-quick_ratio, index)
+    best_ratio, best_index = -1.0, None
+    while True:
+      lower_bound = LengthBound(lower) if lower >= 0 else -1.0
+      upper_bound = (
+          LengthBound(upper) if upper < len(self._lengths) else -1.0)
+      pending_bound = -pending[0][0] if pending else -1.0
+      if max(lower_bound, upper_bound, pending_bound) <= best_ratio:
+        break
+      if lower_bound > pending_bound or upper_bound > pending_bound:
+        if lower_bound >= upper_bound:
+          i, lower = lower, lower - 1
+        else:
+          i, upper = upper, upper + 1
+        heapq.heappush(pending, (-QuickRatio(i), i))
+      else:
+        _, i = heapq.heappop(pending)
+        matcher.set_seq1(self._requests[i].formatted_request)
+        ratio = matcher.ratio()
+        if ratio > best_ratio:
+          best_ratio, best_index = ratio, i
+    return self._requests[best_index]
 
 
 class ArchivedHttpRequest(object):
@@ -465,11 +805,23 @@ class ArchivedHttpRequest(object):
 
   For unpickling, 'trimmed_headers' is recreated from 'headers'. That
   allows for changes to the trim function and can help with debugging.
+
+  Hashing and equality use the matching state (see repr()). Its hash is
+  computed once, when the request is created or unpickled. 'path' and
+  'formatted_request' are computed on first use.
   """
+  __slots__ = ('command', 'host', 'full_path', 'request_body', 'headers',
+               'is_ssl', 'trimmed_headers', '_path', '_formatted_request',
+               '_hash')
+
   CONDITIONAL_HEADERS = [
       'if-none-match', 'if-match',
       'if-modified-since', 'if-unmodified-since']
 
+  # Attributes that are pickled. The others are derived from them.
+  _PICKLED_ATTRS = (
+      'command', 'host', 'full_path', 'request_body', 'headers', 'is_ssl')
+
   def __init__(self, command, host, full_path, request_body, headers,
                is_ssl=False):
     """Initialize an ArchivedHttpRequest.
@@ -483,15 +835,14 @@ class ArchivedHttpRequest(object):
       headers: {key: value, ...} where key and value are strings.
       is_ssl: a boolean which is True iff request is make via SSL.
     """
-    self.command = command
-    self.host = host
+    self.command = _intern_str(command)
+    self.host = _intern_str(host)
     self.full_path = full_path
-    self.path = urlparse.urlparse(full_path).path if full_path else None
     self.request_body = request_body
-    self.headers = headers
+    self.headers = dict((_intern_str(k), v) for k, v in headers.iteritems())
     self.is_ssl = is_ssl
-    self.trimmed_headers = self._TrimHeaders(headers)
-    self.formatted_request = self._GetFormattedRequest()
+    self.trimmed_headers = self._TrimHeaders(self.headers)
+    self._SetHash()
 
   def __str__(self):
     scheme = 'https' if self.is_ssl else 'http'
@@ -504,11 +855,48 @@ class ArchivedHttpRequest(object):
 
   def __hash__(self):
     """Return a integer hash to use for hashed collections including dict."""
-    return hash(repr(self))
+    return self._hash
 
   def __eq__(self, other):
     """Define the __eq__ method to match the hash behavior."""
-    return repr(self) == repr(other)
+    if not isinstance(other, ArchivedHttpRequest):
+      return NotImplemented
+    return (self._hash == other._hash and
+            self.full_path == other.full_path and
+            self.host == other.host and
+            self.command == other.command and
+            self.is_ssl == other.is_ssl and
+            self.request_body == other.request_body and
+            self.trimmed_headers == other.trimmed_headers)
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  def _SetHash(self):
+    """Compute the hash of the matching state."""
+    self._hash = hash((self.command, self.host, self.full_path,
+                       self.request_body, tuple(self.trimmed_headers),
+                       self.is_ssl))
+
+  @property
+  def path(self):
+    """The path of the URL without the query (e.g. '/search')."""
+    try:
+      return self._path
+    except AttributeError:
+      self._path = (
+          urlparse.urlparse(self.full_path).path if self.full_path else None)
+      return self._path
+
+  @property
+  def formatted_request(self):
+    """The request as text (see _GetFormattedRequest)."""
+    try:
+      return self._formatted_request
+    except AttributeError:
+      self._formatted_request = self._GetFormattedRequest()
+      return self._formatted_request
 
   def __setstate__(self, state):
     """Influence how to unpickle.
@@ -536,12 +924,18 @@ class ArchivedHttpRequest(object):
       # dealing with an older archive.
       state['full_path'] = state['path']
       del state['path']
-    state['trimmed_headers'] = self._TrimHeaders(dict(state['headers']))
     if 'is_ssl' not in state:
       state['is_ssl'] = False
-    self.__dict__.update(state)
-    self.path = urlparse.urlparse(self.full_path).path
-    self.formatted_request = self._GetFormattedRequest()
+    state['command'] = _intern_str(state['command'])
+    state['host'] = _intern_str(state['host'])
+    state['headers'] = dict(
+        (_intern_str(k), v) for k, v in state['headers'].iteritems())
+    # Older archives may pickle attributes that no longer exist.
+    for name, value in state.iteritems():
+      if name in self._PICKLED_ATTRS:
+        setattr(self, name, value)
+    self.trimmed_headers = self._TrimHeaders(dict(self.headers))
+    self._SetHash()
 
   def __getstate__(self):
     """Influence how to pickle.
@@ -549,11 +943,7 @@ class ArchivedHttpRequest(object):
     Returns:
       a dict to use for pickling
     """
-    state = self.__dict__.copy()
-    del state['trimmed_headers']
-    del state['path']
-    del state['formatted_request']
-    return state
+    return dict((name, getattr(self, name)) for name in self._PICKLED_ATTRS)
 
   def _GetFormattedRequest(self):
     """Format request to make diffs easier to read.
@@ -675,6 +1065,13 @@ class ArchivedHttpResponse(object):
   DELAY_EDIT_SEPARATOR = ('\n[WEB_PAGE_REPLAY_EDIT_ARCHIVE --- '
                           'Delays are above. Response content is below.]\n')
 
+  __slots__ = ('version', 'status', 'reason', 'headers', 'response_data',
+               '_delays', '_wire_cache')
+
+  # Attributes that are pickled ('delays' is set through its property).
+  _PICKLED_ATTRS = (
+      'version', 'status', 'reason', 'headers', 'response_data', 'delays')
+
   def __init__(self, version, status, reason, headers, response_data,
                delays=None):
     """Initialize an ArchivedHttpResponse.
@@ -694,33 +1091,56 @@ class ArchivedHttpResponse(object):
           connect - The time to connect to the server.
             Each resource has a value because Replay's record mode captures it.
             This includes the time for the SYN and SYN/ACK (1 rtt).
+            It is 0 if the response came over a reused keep-alive connection,
+            which is marked with 'reused_connection': True.
           headers - The time elapsed between the TCP connect and the headers.
             This typically includes all the server-time to generate a response.
           data - If the response is chunked, these are the times for each chunk.
     """
     self.version = version
     self.status = status
-    self.reason = reason
-    self.headers = headers
+    self.reason = _intern_str(reason)
+    self.headers = [(_intern_str(k), v) for k, v in headers]
     self.response_data = response_data
     self.delays = delays
+    self._wire_cache = None
     self.fix_delays()
 
-  def fix_delays(self):
-    """Initialize delays, or check the number of data delays."""
-    expected_num_delays = len(self.response_data)
-    if not self.delays:
-      self.delays = {
+  @property
+  def delays(self):
+    """The delays dict (see __init__).
+
+    Responses without delays share no state until the delays are used, at
+    which point all-zero delays are created.
+    """
+    if self._delays is None:
+      self._delays = {
           'connect': 0,
           'headers': 0,
-          'data': [0] * expected_num_delays
+          'data': [0] * len(self.response_data)
           }
-    else:
-      num_delays = len(self.delays['data'])
+    return self._delays
+
+  @delays.setter
+  def delays(self, delays):
+    self._delays = delays or None
+
+  def has_delays(self):
+    """Return True iff delays were set or used (see delays)."""
+    return self._delays is not None
+
+  def fix_delays(self):
+    """Check the number of data delays.
+
+    Missing delays are created as all-zero delays on first use.
+    """
+    expected_num_delays = len(self.response_data)
+    if self._delays is not None:
+      num_delays = len(self._delays['data'])
       if num_delays != expected_num_delays:
         raise HttpArchiveException(
             'Server delay length mismatch: %d (expected %d): %s',
-            num_delays, expected_num_delays, self.delays['data'])
+            num_delays, expected_num_delays, self._delays['data'])
 
   def __repr__(self):
     return repr((self.version, self.status, self.reason, sorted(self.headers),
@@ -749,9 +1169,25 @@ class ArchivedHttpResponse(object):
       del state['server_delays']
     elif 'delays' not in state:
       state['delays'] = None
-    self.__dict__.update(state)
+    state['reason'] = _intern_str(state['reason'])
+    state['headers'] = [(_intern_str(k), v) for k, v in state['headers']]
+    # Older archives may pickle attributes that no longer exist.
+    for name, value in state.iteritems():
+      if name in self._PICKLED_ATTRS:
+        setattr(self, name, value)
+    self._wire_cache = None
     self.fix_delays()
 
+  def __getstate__(self):
+    """Influence how to pickle.
+
+    Returns:
+      a dict to use for pickling
+    """
+    return {'version': self.version, 'status': self.status,
+            'reason': self.reason, 'headers': self.headers,
+            'response_data': self.response_data, 'delays': self._delays}
+
   def get_header(self, key, default=None):
     for k, v in self.headers:
       if key.lower() == k.lower():
@@ -803,32 +1239,95 @@ class ArchivedHttpResponse(object):
       return email.utils.formatdate(updated_seconds, usegmt=True)
     return date_str
 
+  def get_wire_headers(self, now=None):
+    """Return the status line and headers to send for the response.
+
+    The Server and Date headers come first. 'last-modified' and 'expires' are
+    shifted like update_date() does. Unchunked responses without a
+    content-length get one, without changing |headers|.
+
+    The header block is built once and reused until the status, headers or
+    body change. Only the dates are formatted on each call.
+
+    Args:
+      now: the epoch seconds of the Date header (default: the current time).
+    Returns:
+      a string that ends with the empty line after the headers.
+    """
+    parts = []
+    if now is None:
+      now = time.time()
+    for text, date_offset in self._get_wire_template():
+      parts.append(text)
+      if date_offset is not None:
+        parts.append(email.utils.formatdate(now + date_offset, usegmt=True))
+    return ''.join(parts)
+
+  def _get_wire_template(self):
+    """Return [(text, date offset or None), ...] for get_wire_headers()."""
+    # response_data may be edited in place, so key on its length.
+    data_length = sum(len(c) for c in self.response_data)
+    key = (self.version, self.status, self.reason, tuple(self.headers),
+           data_length)
+    cache = self._wire_cache
+    if cache and cache[0] == key:
+      return cache[1]
+    protocol_version = 'HTTP/1.0' if self.version == 10 else 'HTTP/1.1'
+    lines = ['%s %d %s' % (protocol_version, self.status, self.reason),
+             'Server: %s' % self.get_header('server', 'WebPageReplay')]
+    template = []
+    date_seconds = self._get_epoch_seconds(self.get_header('date'))
+
+    def AddDate(name, date_offset):
+      lines.append('%s: ' % name)
+      template.append(('\r\n'.join(lines), date_offset))
+      del lines[:]
+      lines.append('')
+
+    AddDate('Date', 0)
+    for header, value in self.headers:
+      if header in ('last-modified', 'expires'):
+        header_seconds = self._get_epoch_seconds(value)
+        if date_seconds and header_seconds:
+          AddDate(header, header_seconds - date_seconds)
+          continue
+        lines.append('%s: %s' % (header, value))
+      elif header not in ('date', 'server'):
+        lines.append('%s: %s' % (header, value))
+    if not self.is_chunked() and self.get_header('content-length') is None:
+      lines.append('content-length: %d' % data_length)
+    lines.extend(['', ''])
+    template.append(('\r\n'.join(lines), None))
+    self._wire_cache = (key, template)
+    return template
+
   def is_gzip(self):
     return self.get_header('content-encoding') == 'gzip'
 
   def is_compressed(self):
-    return self.get_header('content-encoding') in ('gzip', 'deflate')
+    return self.get_header('content-encoding') in httpzlib.ENCODINGS
 
   def is_chunked(self):
     return self.get_header('transfer-encoding') == 'chunked'
 
+  def is_html(self):
+    content_type = self.get_header('content-type')
+    return bool(content_type and content_type.startswith('text/html'))
+
+  def is_text(self):
+    content_type = self.get_header('content-type')
+    return bool(content_type and
+                (content_type.startswith('text/') or
+                 content_type == 'application/x-javascript' or
+                 content_type.startswith('application/json')))
+
   def get_data_as_text(self):
     """Return content as a single string.
 
     Uncompresses and concatenates chunks with CHUNK_EDIT_SEPARATOR.
+    See GetDataAsTextBulk for many responses.
     """
-    content_type = self.get_header('content-type')
-    if (not content_type or
-        not (content_type.startswith('text/') or
-             content_type == 'application/x-javascript' or
-             content_type.startswith('application/json'))):
-      return None
-    if self.is_compressed():
-      uncompressed_chunks = httpzlib.uncompress_chunks(
-          self.response_data, self.is_gzip())
-    else:
-      uncompressed_chunks = self.response_data
-    return self.CHUNK_EDIT_SEPARATOR.join(uncompressed_chunks)
+    return GetDataAsTextBulk([self], num_threads=1)[0]
 
   def get_delays_as_text(self):
     """Return delays as editable text."""
@@ -851,12 +1350,12 @@ class ArchivedHttpResponse(object):
     """Inverse of get_data_as_text().
 
     Split on CHUNK_EDIT_SEPARATOR and compress if needed.
+    See SetDataBulk for many responses.
     """
-    text_chunks = text.split(self.CHUNK_EDIT_SEPARATOR)
-    if self.is_compressed():
-      self.response_data = httpzlib.compress_chunks(text_chunks, self.is_gzip())
-    else:
-      self.response_data = text_chunks
+    SetDataBulk([self], [text], num_threads=1)
+
+  def _set_response_data(self, response_data):
+    self.response_data = response_data
     if not self.is_chunked():
       content_length = sum(len(c) for c in self.response_data)
       self.set_header('content-length', str(content_length))
@@ -895,6 +1394,124 @@ class ArchivedHttpResponse(object):
     self.set_data(data)
 
 
+def LoadRequestList(filename):
+  """Return the ArchivedHttpRequests listed in a text file.
+
+  Each line is 'command%host%full_path%request_body%headers', where headers
+  is a Python list of (name, value) tuples. The body and the headers may be
+  empty. For example (see mock-archive.txt):
+    GET%www.example.com%/%%[('accept-encoding', 'gzip,deflate')]
+  Hosts that start with 'https://' are fetched over SSL. The full path may
+  contain '%', the request body may not.
+  """
+  requests = []
+  with open(filename) as request_list:
+    for line in request_list:
+      line = line.rstrip('\r\n')
+      if not line:
+        continue
+      command, host, rest = line.split('%', 2)
+      headers_start = rest.rfind('%[' if rest.endswith(']') else '%')
+      full_path, request_body = rest[:headers_start].rsplit('%', 1)
+      headers = ast.literal_eval(rest[headers_start + 1:] or '[]')
+      is_ssl = host.startswith('https://')
+      if is_ssl:
+        host = host[len('https://'):]
+      requests.append(ArchivedHttpRequest(
+          command, host, full_path, request_body or None, dict(headers),
+          is_ssl=is_ssl))
+  return requests
+
+
+def GetDataAsTextBulk(responses, num_threads=None):
+  """Return the content of many responses as text.
+
+  Like [r.get_data_as_text() for r in responses], but the responses are
+  uncompressed in parallel (see httpzlib.uncompress_chunk_lists).
+  Responses with a content-encoding that httpzlib does not support (e.g. br
+  without the brotli module) are not text.
+
+  Args:
+    responses: a list of ArchivedHttpResponses.
+    num_threads: the maximum number of threads (default: number of CPUs).
+  Returns:
+    a list with a string, or None if the content is not text, per response.
+  """
+  chunk_lists = [None] * len(responses)
+  compressed_indexes = []
+  for i, response in enumerate(responses):
+    if not response.is_text():
+      continue
+    if response.is_compressed():
+      if httpzlib.is_supported(response.get_header('content-encoding')):
+        compressed_indexes.append(i)
+    else:
+      # Chunks may be buffers into an archive file (see archiveformat.py).
+      chunk_lists[i] = [str(c) for c in response.response_data]
+  uncompressed_chunk_lists = httpzlib.uncompress_chunk_lists(
+      [responses[i].response_data for i in compressed_indexes],
+      [responses[i].get_header('content-encoding')
+       for i in compressed_indexes], num_threads)
+  for i, chunks in zip(compressed_indexes, uncompressed_chunk_lists):
+    chunk_lists[i] = chunks
+  return [None if chunks is None
+          else ArchivedHttpResponse.CHUNK_EDIT_SEPARATOR.join(chunks)
+          for chunks in chunk_lists]
+
+
+def SetDataBulk(responses, texts, num_threads=None):
+  """Set the content of many responses from text.
+
+  Like r.set_data(text) for each pair, but the responses are compressed in
+  parallel (see httpzlib.compress_chunk_lists).
+
+  Args:
+    responses: a list of ArchivedHttpResponses.
+    texts: a list with the text for each response.
+    num_threads: the maximum number of threads (default: number of CPUs).
+  Raises:
+    ValueError: if the content-encoding of a response is not supported (see
+        httpzlib.is_supported).
+  """
+  chunk_lists = [text.split(ArchivedHttpResponse.CHUNK_EDIT_SEPARATOR)
+                 for text in texts]
+  compressed_indexes = [i for i, r in enumerate(responses)
+                        if r.is_compressed()]
+  compressed_chunk_lists = httpzlib.compress_chunk_lists(
+      [chunk_lists[i] for i in compressed_indexes],
+      [responses[i].get_header('content-encoding')
+       for i in compressed_indexes], num_threads)
+  for i, chunks in zip(compressed_indexes, compressed_chunk_lists):
+    chunk_lists[i] = chunks
+  for response, chunks in zip(responses, chunk_lists):
+    response._set_response_data(chunks)  # pylint: disable=protected-access
+
+
+def GetJournalFilename(archive_filename):
+  """Return the name of the journal kept while recording |archive_filename|."""
+  return archive_filename + '.journal'
+
+
+def _GetEntryFields(response):
+  """Return the fields of |response| besides the body that are persisted.
+
+  Returns:
+    (version, status, reason, headers, delays)
+  """
+  return (response.version, response.status, response.reason,
+          list(response.headers),
+          dict(response.delays) if response.has_delays() else None)
+
+
+def _intern_str(value):
+  """Intern |value| if it is a str, so that equal values share one object.
+
+  Used for strings that repeat across many requests and responses, such as
+  header names and host names.
+  """
+  return intern(value) if type(value) is str else value
+
+
 def create_response(status, reason=None, headers=None, body=None):
   """Convenience method for creating simple ArchivedHttpResponse objects."""
   if reason is None:
@@ -915,7 +1532,8 @@ def main():
         return ''
 
   option_parser = optparse.OptionParser(
-      usage='%prog [ls|cat|edit|stats|merge] [options] replay_file(s)',
+      usage=('%prog [ls|cat|edit|stats|merge|convert|bake|refetch] [options] '
+             'replay_file(s)'),
       formatter=PlainHelpFormatter(),
       description=__doc__,
       epilog='http://code.google.com/p/web-page-replay/')
@@ -936,6 +1554,28 @@ def main():
         action='store',
         type='string',
         help='The output file to use when using the merge command.')
+  option_parser.add_option('-b', '--baked_file', default=None,
+        action='store',
+        type='string',
+        help='The output file to use when using the bake command.')
+  option_parser.add_option('-i', '--inject_scripts', default='deterministic.js',
+        action='store',
+        type='string',
+        help='A comma separated list of JavaScript sources to inject with '
+             'the bake command.')
+  option_parser.add_option('-r', '--refetched_file', default=None,
+        action='store',
+        type='string',
+        help='The output file to use when using the refetch command.')
+  option_parser.add_option('-l', '--request_list', default=False,
+        action='store_true',
+        help='With the refetch command, read the requests from a request '
+             'list instead of an archive.')
+  option_parser.add_option('-n', '--num_fetchers', default=32,
+        action='store',
+        type='int',
+        help='The maximum number of concurrent fetches of the refetch '
+             'command.')
 
   options, args = option_parser.parse_args()
 
@@ -950,7 +1590,10 @@ def main():
   if not os.path.exists(replay_file):
     option_parser.error('Replay file "%s" does not exist' % replay_file)
 
-  http_archive = HttpArchive.Load(replay_file)
+  if command == 'refetch' and options.request_list:
+    http_archive = HttpArchive()
+  else:
+    http_archive = HttpArchive.Load(replay_file)
   if command == 'ls':
     print http_archive.ls(options.command, options.host, options.full_path)
   elif command == 'cat':
@@ -965,6 +1608,28 @@ def main():
   elif command == 'edit':
     http_archive.edit(options.command, options.host, options.full_path)
     http_archive.Persist(replay_file)
+  elif command == 'convert':
+    http_archive.Persist(replay_file)
+    print 'Converted %d responses in %s' % (len(http_archive), replay_file)
+  elif command == 'bake':
+    if not options.baked_file:
+      print 'Error: Must specify a baked file name (use --baked_file)'
+      return
+    http_archive.bake(options.baked_file,
+                      script_injector.GetInjectScript(options.inject_scripts))
+  elif command == 'refetch':
+    if not options.refetched_file:
+      print 'Error: Must specify a refetched file name (use --refetched_file)'
+      return
+    if options.request_list:
+      requests = LoadRequestList(replay_file)
+    elif options.command or options.host or options.full_path:
+      requests = http_archive.get_requests(
+          options.command, options.host, options.full_path)
+    else:
+      requests = None
+    http_archive.refetch(options.refetched_file, requests,
+                         options.num_fetchers)
   else:
     option_parser.error('Unknown command "%s"' % command)
   return 0
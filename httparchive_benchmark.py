@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the memory and lookup cost of HttpArchive entries.
+
+Builds a synthetic archive with realistic request and response headers and
+reports the bytes per entry (all objects reachable from the archive, with
+shared objects counted once) and the time per lookup.
+
+Usage:
+$ ./httparchive_benchmark.py [--entries N]
+"""
+
+import gc
+import optparse
+import sys
+import time
+
+import httparchive
+
+
+def _create_entry(i):
+  host = 'host%d.example.com' % (i % 100)
+  request = httparchive.ArchivedHttpRequest(
+      'GET', host, '/path/%d/resource.js?v=%d' % (i, i), None,
+      {'host': host,
+       'accept': '*/*',
+       'accept-encoding': 'gzip, deflate, sdch',
+       'accept-language': 'en-US,en;q=0.8',
+       'referer': 'http://%s/index.html' % host,
+       'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) Chrome/42.0',
+       'cookie': 'id=%d' % i})
+  response = httparchive.ArchivedHttpResponse(
+      11, 200, 'OK',
+      [('content-type', 'application/javascript'),
+       ('content-encoding', 'gzip'),
+       ('cache-control', 'max-age=3600'),
+       ('date', 'Wed, 13 Jul 2011 03:58:08 GMT'),
+       ('last-modified', 'Wed, 13 Jul 2011 03:58:08 GMT'),
+       ('etag', '"%x"' % i),
+       ('content-length', '3')],
+      ['abc'])
+  return request, response
+
+
+def _deep_size(root):
+  """Return the size of |root| and all objects reachable from it."""
+  seen = set()
+  size = 0
+  pending = [root]
+  while pending:
+    obj = pending.pop()
+    if id(obj) in seen or isinstance(obj, type):
+      continue
+    seen.add(id(obj))
+    size += sys.getsizeof(obj)
+    pending.extend(gc.get_referents(obj))
+  return size
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options]')
+  option_parser.add_option('-n', '--entries', default=100000, type='int',
+                           help='Number of archive entries.')
+  options, _ = option_parser.parse_args()
+
+  archive = httparchive.HttpArchive()
+  for i in xrange(options.entries):
+    request, response = _create_entry(i)
+    archive[request] = response
+  # Drop the per-host index, which is not part of the entries.
+  archive.responses_by_host.clear()
+
+  size = _deep_size(archive)
+  print 'entries: %d' % options.entries
+  print 'bytes per entry: %d' % (size / options.entries)
+
+  lookups = [_create_entry(i)[0] for i in xrange(0, options.entries, 10)]
+  start = time.time()
+  for request in lookups:
+    archive.get(request)
+  elapsed = time.time() - start
+  print 'us per lookup: %.2f' % (elapsed * 1e6 / len(lookups))
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -14,8 +14,18 @@
 # limitations under the License.
 
 import calendar
+import certutils
+import cPickle
+import difflib
 import email.utils
+import errno
 import httparchive
+import httpzlib
+import os
+import random
+import script_injector
+import shutil
+import tempfile
 import unittest
 
 
@@ -104,6 +114,30 @@ class HttpArchiveTest(unittest.TestCase):
     self.assert_(not empty_request.matches(
         request2.command, None, request2.full_path, use_query=False))
 
+  def test_request_hash_and_equality(self):
+    request1 = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {'user-agent': 'a', 'x-foo': 'bar'})
+    request2 = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {'user-agent': 'b', 'x-foo': 'bar'})
+    request3 = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {'x-foo': 'baz'})
+    # user-agent is trimmed, so requests 1 and 2 match.
+    self.assertTrue(request1 == request2)
+    self.assertFalse(request1 != request2)
+    self.assertEqual(hash(request1), hash(request2))
+    self.assertTrue(request1 != request3)
+    self.assertFalse(request1 == repr(request1))
+
+    for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+      unpickled = cPickle.loads(cPickle.dumps(request1, protocol))
+      self.assertEqual(request1, unpickled)
+      self.assertEqual(hash(request1), hash(unpickled))
+      self.assertEqual(request1.headers, unpickled.headers)
+      self.assertEqual('/', unpickled.path)
+      self.assertEqual(request1.formatted_request,
+                       unpickled.formatted_request)
+      self.assertIs(intern('x-foo'), unpickled.trimmed_headers[0][0])
+
   def setup_find_closest_request(self):
     headers = {}
     request1 = httparchive.ArchivedHttpRequest(
@@ -148,6 +182,43 @@ class HttpArchiveTest(unittest.TestCase):
     self.assertEqual(
         None, archive.find_closest_request(request1, use_path=True))
 
+  def test_find_closest_request_after_add(self):
+    archive, request1, request2, request3 = self.setup_find_closest_request()
+    self.assertEqual(
+        request3, archive.find_closest_request(request1, use_path=False))
+
+    request4 = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/a?hello=worl', None, {})
+    archive[request4] = self.RESPONSE
+    self.assertEqual(
+        request4, archive.find_closest_request(request1, use_path=False))
+    self.assertEqual(
+        request4, archive.find_closest_request(request1, use_path=True))
+
+  def test_find_closest_request_has_best_ratio(self):
+    rand = random.Random(0)
+    archive = httparchive.HttpArchive()
+    for _ in xrange(200):
+      path = '/%s?%s' % (
+          ''.join(rand.choice('abcd/') for _ in xrange(rand.randint(1, 12))),
+          ''.join(rand.choice('xyz=&') for _ in xrange(rand.randint(0, 30))))
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'www.test.com', path, None, {})
+      archive[request] = self.RESPONSE
+
+    for _ in xrange(20):
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'www.test.com', '/%s?%s' % (
+              ''.join(rand.choice('abc/') for _ in xrange(6)),
+              ''.join(rand.choice('xyz=') for _ in xrange(15))), None, {})
+      matcher = difflib.SequenceMatcher(b=request.formatted_request)
+      def Ratio(candidate):
+        matcher.set_seq1(candidate.formatted_request)
+        return matcher.ratio()
+      best_ratio = max(Ratio(r) for r in archive)
+      self.assertEqual(
+          best_ratio, Ratio(archive.find_closest_request(request)))
+
   def test_get_simple(self):
     request = self.REQUEST
     response = self.RESPONSE
@@ -347,6 +418,211 @@ class HttpArchiveTest(unittest.TestCase):
     request = create_request(request_headers)
     self.assertEqual(archive.get(request), response)
 
+  def test_get_server_cert_puts_cert_on_record_queue(self):
+    class MockRecordQueue(object):
+      def __init__(self):
+        self.items = []
+      def Put(self, request, response):
+        self.items.append((request, response))
+    self.addCleanup(setattr, certutils, 'get_host_cert',
+                    certutils.get_host_cert)
+    certutils.get_host_cert = lambda host: 'cert of %s' % host
+    self.archive.record_queue = MockRecordQueue()
+
+    self.assertEqual('cert of a.com', self.archive.get_server_cert('a.com'))
+    self.assertEqual('cert of a.com', self.archive.get_server_cert('a.com'))
+    request = httparchive.ArchivedHttpRequest(
+        'SERVER_CERT', 'a.com', '', None, {})
+    self.assertEqual([(request, self.archive[request])],
+                     self.archive.record_queue.items)
+
+
+class HttpArchivePersistTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.temp_dir, 'archive.wpr')
+    self.archive = httparchive.HttpArchive()
+    self.request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/a?b=c', None, {'accept-encoding': 'gzip'})
+    self.response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'text/html')], ['<html>', 'body'],
+        delays={'connect': 10, 'headers': 20, 'data': [1, 2]})
+    self.archive[self.request] = self.response
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def test_persist_and_load(self):
+    self.archive.Persist(self.filename)
+    loaded = httparchive.HttpArchive.Load(self.filename)
+    self.assertEqual(1, len(loaded))
+    self.assertEqual(self.response, loaded[self.request])
+    self.assertEqual(self.response.delays, loaded[self.request].delays)
+    self.assertEqual(
+        [self.request], loaded.get_requests(host='www.test.com'))
+
+  def test_load_pickled_archive(self):
+    with open(self.filename, 'wb') as f:
+      cPickle.dump(self.archive, f, cPickle.HIGHEST_PROTOCOL)
+    loaded = httparchive.HttpArchive.Load(self.filename)
+    self.assertEqual(self.response, loaded[self.request])
+
+  def test_load_pickled_archive_with_legacy_attributes(self):
+    def AddLegacyState(cls, legacy_state):
+      getstate = cls.__getstate__
+      self.addCleanup(setattr, cls, '__getstate__', getstate)
+      cls.__getstate__ = lambda obj: dict(getstate(obj), **legacy_state)
+    AddLegacyState(httparchive.ArchivedHttpRequest,
+                   {'path_without_query': '/'})
+    AddLegacyState(httparchive.ArchivedHttpResponse, {'request_time': 0})
+    with open(self.filename, 'wb') as f:
+      cPickle.dump(self.archive, f, cPickle.HIGHEST_PROTOCOL)
+    loaded = httparchive.HttpArchive.Load(self.filename)
+    self.assertEqual(self.response, loaded[self.request])
+    self.assertEqual('/a', loaded.keys()[0].path)
+
+  def test_persist_loaded_archive_in_place(self):
+    self.archive.Persist(self.filename)
+    loaded = httparchive.HttpArchive.Load(self.filename)
+    response = loaded[self.request]
+    response.set_data(response.CHUNK_EDIT_SEPARATOR.join(['<head>', 'text']))
+    loaded.Persist(self.filename)
+    reloaded = httparchive.HttpArchive.Load(self.filename)
+    self.assertEqual(['<head>', 'text'],
+                     reloaded[self.request].response_data.materialize())
+
+  @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Requires /proc.')
+  def test_persist_over_loaded_archive_on_windows(self):
+    # Windows can neither rename over nor remove a file that is open.
+    rename, remove = os.rename, os.remove
+    def Rename(src, dst):
+      if os.path.exists(dst):
+        raise OSError(errno.EEXIST, 'File exists', dst)
+      rename(src, dst)
+    def Remove(path):
+      fd_dir = '/proc/self/fd'
+      open_paths = set()
+      for fd in os.listdir(fd_dir):
+        try:
+          open_paths.add(os.readlink(os.path.join(fd_dir, fd)))
+        except OSError:
+          pass  # closed meanwhile
+      if os.path.realpath(path) in open_paths:
+        raise OSError(errno.EACCES, 'Permission denied', path)
+      remove(path)
+    self.addCleanup(setattr, os, 'rename', rename)
+    self.addCleanup(setattr, os, 'remove', remove)
+    os.rename, os.remove = Rename, Remove
+
+    self.archive.Persist(self.filename)
+    loaded = httparchive.HttpArchive.Load(self.filename)
+    new_request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/new', None, {})
+    loaded[new_request] = httparchive.create_response(200, body='new')
+    loaded.Persist(self.filename)
+    # The loaded archive is still readable.
+    self.assertEqual(self.response, loaded[self.request])
+
+    reloaded = httparchive.HttpArchive.Load(self.filename)
+    self.assertEqual(self.response, reloaded[self.request])
+    self.assertEqual(['new'], reloaded[new_request].response_data)
+    self.assertEqual(['archive.wpr'], os.listdir(self.temp_dir))
+
+  def test_bake(self):
+    baked_filename = os.path.join(self.temp_dir, 'baked.wpr')
+    self.response.set_header('content-encoding', 'gzip')
+    self.response.set_data('<html>' + self.response.CHUNK_EDIT_SEPARATOR)
+    self.archive.bake(baked_filename, 'var flag = 0;')
+
+    baked = httparchive.HttpArchive.Load(baked_filename)
+    self.assertEqual(
+        '<html><script>var flag = 0;</script>' +
+        self.response.CHUNK_EDIT_SEPARATOR,
+        baked[self.request].get_data_as_text())
+    self.assertEqual(
+        script_injector.GetInjectScriptHash('var flag = 0;'),
+        baked.metadata['inject_script_hash'])
+
+    # Responses that scripts are not injected into keep the archive baked.
+    baked[httparchive.ArchivedHttpRequest(
+        'SERVER_CERT', 'www.test.com', '', None, {})] = (
+            httparchive.create_response(200, body='cert'))
+    baked[httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/style.css', None, {})] = (
+            httparchive.create_response(
+                200, headers=[('content-type', 'text/css')], body='a {}'))
+    self.assertIn('inject_script_hash', baked.metadata)
+
+    # New HTML responses are not baked, so the archive is no longer either.
+    baked[httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/new', None, {})] = self.response
+    self.assertEqual({}, baked.metadata)
+
+  def test_bake_without_decoder_leaves_archive_unbaked(self):
+    baked_filename = os.path.join(self.temp_dir, 'baked.wpr')
+    self.addCleanup(setattr, httpzlib, 'is_supported', httpzlib.is_supported)
+    httpzlib.is_supported = lambda encoding: encoding != 'br'
+    self.response.set_header('content-encoding', 'br')
+    plain_request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/plain', None, {})
+    self.archive[plain_request] = httparchive.create_response(
+        200, headers=[('content-type', 'text/html')], body='<html>')
+    self.archive.bake(baked_filename, 'var flag = 0;')
+
+    baked = httparchive.HttpArchive.Load(baked_filename)
+    self.assertEqual('<html><script>var flag = 0;</script>',
+                     baked[plain_request].get_data_as_text())
+    self.assertNotIn('inject_script_hash', baked.metadata)
+
+  def test_load_request_list(self):
+    list_filename = os.path.join(self.temp_dir, 'requests.txt')
+    with open(list_filename, 'w') as f:
+      f.write("GET%www.test.com%/a?b=c%%[('accept-encoding', 'gzip')]\n"
+              "\n"
+              "POST%https://www.test.com%/%20x%data%\n")
+    requests = httparchive.LoadRequestList(list_filename)
+    self.assertEqual([self.request, httparchive.ArchivedHttpRequest(
+        'POST', 'www.test.com', '/%20x', 'data', {}, is_ssl=True)], requests)
+
+  def test_journal(self):
+    journal_filename = httparchive.GetJournalFilename(self.filename)
+    self.archive.StartJournal(journal_filename)
+    other_request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/other', None, {})
+    self.archive[other_request] = self.response
+    self.archive[self.request] = self.response
+    del self.archive[other_request]
+    self.archive.CloseJournal()
+
+    loaded = httparchive.HttpArchive.Load(journal_filename)
+    self.assertEqual([self.request], loaded.keys())
+    self.assertEqual(self.response, loaded[self.request])
+    self.assertEqual(self.response.delays, loaded[self.request].delays)
+
+    # A restarted recording continues the journal.
+    self.archive.StartJournal(journal_filename)
+    self.archive[other_request] = self.response
+    self.archive.CloseJournal()
+    resumed = httparchive.HttpArchive()
+    self.assertEqual(4, resumed.LoadJournal(journal_filename))
+    self.assertEqual({self.request, other_request}, set(resumed))
+
+  def test_clear_truncates_journal(self):
+    journal_filename = httparchive.GetJournalFilename(self.filename)
+    self.archive.StartJournal(journal_filename)
+    self.archive[self.request] = self.response
+    self.archive.clear()
+    self.archive.CloseJournal()
+    self.assertEqual(0, len(httparchive.HttpArchive.Load(journal_filename)))
+
+  def test_clear(self):
+    self.archive.metadata['inject_script_hash'] = 'abc'
+    self.archive.clear()
+    self.assertEqual(0, len(self.archive))
+    self.assertEqual([], self.archive.get_requests(host='www.test.com'))
+    self.assertEqual({}, self.archive.metadata)
+
 
 class ArchivedHttpResponse(unittest.TestCase):
   PAST_DATE_A = 'Tue, 13 Jul 2010 03:47:07 GMT'
@@ -386,6 +662,72 @@ class ArchivedHttpResponse(unittest.TestCase):
         self.response.update_date(self.PAST_DATE_B, now=self.NOW_SECONDS),
         self.PAST_DATE_B)
 
+  def test_get_wire_headers(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK',
+        [('date', self.PAST_DATE_A), ('server', 'test'),
+         ('last-modified', self.PAST_DATE_B), ('x-header', 'a')],
+        ['bat', '1'])
+    self.assertEqual(
+        'HTTP/1.1 200 OK\r\n'
+        'Server: test\r\n'
+        'Date: %s\r\n'
+        'last-modified: %s\r\n'
+        'x-header: a\r\n'
+        'content-length: 4\r\n'
+        '\r\n' % (self.NOW_DATE_A, self.NOW_DATE_B),
+        response.get_wire_headers(now=self.NOW_SECONDS))
+    self.assertEqual(4, len(response.headers))
+
+    # Edits are picked up.
+    response.set_header('x-header', 'b')
+    response.set_data('bat')
+    headers = response.get_wire_headers(now=self.NOW_SECONDS)
+    self.assertIn('x-header: b\r\n', headers)
+    self.assertIn('content-length: 3\r\n', headers)
+    self.assertEqual(1, headers.count('content-length'))
+
+    # So are edits of response_data in place.
+    response = httparchive.ArchivedHttpResponse(11, 200, 'OK', [], ['bat'])
+    self.assertIn('content-length: 3\r\n',
+                  response.get_wire_headers(now=self.NOW_SECONDS))
+    response.response_data.append('12')
+    self.assertIn('content-length: 5\r\n',
+                  response.get_wire_headers(now=self.NOW_SECONDS))
+
+  def test_set_and_get_compressed_data(self):
+    for encoding in ('gzip', 'deflate', 'br', 'zstd'):
+      response = create_response([('content-type', 'text/html'),
+                                  ('content-encoding', encoding)])
+      self.assertTrue(response.is_compressed())
+      if not httpzlib.is_supported(encoding):
+        response.response_data = ['\x8b\x01\x80compressed\x03']
+        self.assertEqual(None, response.get_data_as_text())
+        continue
+      text = response.CHUNK_EDIT_SEPARATOR.join(['<html>', 'body'])
+      response.set_data(text)
+      self.assertEqual(2, len(response.response_data))
+      self.assertNotEqual('<html>', response.response_data[0])
+      self.assertEqual(text, response.get_data_as_text())
+
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [], ['a', 'b'])
+    self.assertFalse(response.has_delays())
+    unpickled = cPickle.loads(cPickle.dumps(response, 2))
+    self.assertFalse(unpickled.has_delays())
+    self.assertEqual({'connect': 0, 'headers': 0, 'data': [0, 0]},
+                     unpickled.delays)
+    self.assertTrue(unpickled.has_delays())
+
+  def test_unpickle_with_delays(self):
+    delays = {'connect': 10, 'headers': 20, 'data': [30]}
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('Content-Type', 'text/plain')], ['a'], delays)
+    unpickled = cPickle.loads(cPickle.dumps(response, 0))
+    self.assertEqual(delays, unpickled.delays)
+    self.assertEqual(response, unpickled)
+    self.assertIs(intern('Content-Type'), unpickled.headers[0][0])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -15,11 +15,15 @@
 
 """Retrieve web resources over http."""
 
+import collections
 import copy
 import httplib
 import logging
+import multiprocessing.queues
+import Queue
 import random
 import StringIO
+import threading
 
 import httparchive
 import platformsettings
@@ -54,9 +58,13 @@ def _InjectScripts(response, inject_script):
   """
   if type(response) == tuple:
     logging.warn('tuple response: %s', response)
-  content_type = response.get_header('content-type')
-  if content_type and content_type.startswith('text/html'):
+  if response.is_html():
     text = response.get_data_as_text()
+    if text is None:
+      logging.warning('Cannot inject script into %s-encoded HTML (see '
+                      'httpzlib.is_supported)',
+                      response.get_header('content-encoding'))
+      return response
     text, already_injected = script_injector.InjectScript(
         text, 'text/html', inject_script)
     if not already_injected:
@@ -65,6 +73,98 @@ def _InjectScripts(response, inject_script):
   return response
 
 
+class InjectedResponseCache(object):
+  """Cache of responses with a script injected, bounded by a byte budget.
+
+  Injecting a script means uncompressing, scanning and recompressing an HTML
+  response (see _InjectScripts). The cache keeps the result, so serving the
+  same page again only costs a lookup. Least recently used entries are
+  dropped once the bodies of the cached responses exceed |max_bytes|.
+
+  Entries are keyed by the archived request and a hash of the inject script.
+  Each entry also remembers the response it was made from. If the archive
+  holds a different response for the request by the time it is looked up
+  (e.g. after an edit), the entry is replaced.
+  """
+
+  def __init__(self, inject_script, max_bytes):
+    """Initialize InjectedResponseCache.
+
+    Args:
+      inject_script: script string to inject in all pages.
+      max_bytes: maximum total size of the cached response bodies.
+    """
+    self.inject_script = inject_script
+    self.script_hash = script_injector.GetInjectScriptHash(inject_script)
+    self.max_bytes = max_bytes
+    self.num_bytes = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, request, response):
+    """Return |response| with the inject script, preferably from the cache.
+
+    Args:
+      request: the ArchivedHttpRequest used to look up |response|.
+      response: the archived ArchivedHttpResponse.
+    Returns:
+      an ArchivedHttpResponse
+    """
+    if not response.is_html():
+      return response
+    key = (request, self.script_hash)
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry:
+        original_response, injected_response, num_bytes = entry
+        if original_response is response:
+          self._entries[key] = entry  # Mark as most recently used.
+          return injected_response
+        self.num_bytes -= num_bytes
+    injected_response = _InjectScripts(response, self.inject_script)
+    self._add(key, response, injected_response)
+    return injected_response
+
+  def prefill(self, http_archive):
+    """Inject into the HTML responses of |http_archive| up to the budget.
+
+    Returns:
+      the number of cached responses.
+    """
+    for request, response in http_archive.items():
+      if self.num_bytes >= self.max_bytes:
+        break
+      self.get(request, response)
+    logging.info('Prefilled injected response cache: %d responses, %d bytes',
+                 len(self), self.num_bytes)
+    return len(self)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.num_bytes = 0
+
+  def _add(self, key, response, injected_response):
+    # Unmodified responses are shared with the archive and cost nothing extra.
+    num_bytes = 0
+    if injected_response is not response:
+      num_bytes = sum(len(c) for c in injected_response.response_data)
+    if num_bytes > self.max_bytes:
+      return
+    with self._lock:
+      old_entry = self._entries.pop(key, None)
+      if old_entry:
+        self.num_bytes -= old_entry[2]
+      self._entries[key] = (response, injected_response, num_bytes)
+      self.num_bytes += num_bytes
+      while self.num_bytes > self.max_bytes:
+        _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+        self.num_bytes -= evicted_bytes
+
+
 def _ScrambleImages(response):
   """If the |response| is an image, attempt to scramble it.
 
@@ -81,7 +181,7 @@ def _ScrambleImages(response):
   content_type = response.get_header('content-type')
   if content_type and content_type.startswith('image/'):
     try:
-      image_data = response.response_data[0]
+      image_data = str(response.response_data[0])
       image_data.decode(encoding='base64')
       im = Image.open(StringIO.StringIO(image_data))
 
@@ -185,8 +285,81 @@ class DetailedHTTPSConnection(httplib.HTTPSConnection):
   response_class = DetailedHTTPSResponse
 
 
+class HttpConnectionPool(object):
+  """Idle keep-alive connections, keyed by where they connect to.
+
+  A connection is taken with get() and given back with put() once its
+  response has been read. The most recently used connection of a key is
+  reused first. Connections that have been idle for longer than
+  |max_idle_seconds| are closed, since servers close them too.
+  """
+
+  def __init__(self, max_idle_seconds=10, max_idle_per_key=6):
+    """Initialize HttpConnectionPool.
+
+    Args:
+      max_idle_seconds: how long an idle connection is kept.
+      max_idle_per_key: how many idle connections are kept per key
+          (like the connections per host of a browser).
+    """
+    self.max_idle_seconds = max_idle_seconds
+    self.max_idle_per_key = max_idle_per_key
+    self._idle = collections.defaultdict(list)  # key: [(time, connection)]
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    with self._lock:
+      return sum(len(connections) for connections in self._idle.itervalues())
+
+  def get(self, key):
+    """Return an idle connection for |key|, or None if there is none."""
+    expired = []
+    connection = None
+    with self._lock:
+      connections = self._idle.get(key, [])
+      oldest_time = TIMER() - self.max_idle_seconds
+      while connections:
+        idle_time, idle_connection = connections.pop()
+        if idle_time < oldest_time:
+          # The rest are older still.
+          expired = [idle_connection] + [c for _, c in connections]
+          del connections[:]
+        else:
+          connection = idle_connection
+          break
+      if not connections:
+        self._idle.pop(key, None)
+    for expired_connection in expired:
+      expired_connection.close()
+    return connection
+
+  def put(self, key, connection):
+    """Keep |connection| for reuse by the next get() of |key|."""
+    evicted = None
+    with self._lock:
+      connections = self._idle[key]
+      connections.append((TIMER(), connection))
+      if len(connections) > self.max_idle_per_key:
+        _, evicted = connections.pop(0)
+    if evicted:
+      evicted.close()
+
+  def close(self):
+    """Close all of the idle connections."""
+    with self._lock:
+      idle, self._idle = self._idle, collections.defaultdict(list)
+    for connections in idle.itervalues():
+      for _, connection in connections:
+        connection.close()
+
+
 class RealHttpFetch(object):
 
+  _MAX_RETRIES = 3
+  # Methods that may be sent again on a fresh connection when a pooled
+  # connection fails before the request is sent.
+  _IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
   def __init__(self, real_dns_lookup):
     """Initialize RealHttpFetch.
 
@@ -194,6 +367,11 @@ class RealHttpFetch(object):
       real_dns_lookup: a function that resolves a host to an IP.
     """
     self._real_dns_lookup = real_dns_lookup
+    self._connection_pool = HttpConnectionPool()
+
+  def Close(self):
+    """Close the idle keep-alive connections."""
+    self._connection_pool.close()
 
   @staticmethod
   def _GetHeaderNameValue(header):
@@ -299,6 +477,15 @@ class RealHttpFetch(object):
       connection = DetailedHTTPConnection(connection_ip, connection_port)
     return connection
 
+  @staticmethod
+  def _get_pool_key(connection, is_ssl):
+    """Return the connection pool key of |connection|.
+
+    Connections are shared by (ip, port, ssl, proxy tunnel host and port).
+    """
+    return (connection.host, connection.port, is_ssl,
+            connection._tunnel_host, connection._tunnel_port)
+
   def __call__(self, request):
     """Fetch an HTTP request.
 
@@ -309,20 +496,30 @@ class RealHttpFetch(object):
     """
     logging.debug('RealHttpFetch: %s %s', request.host, request.full_path)
     request_host, request_port = self._get_request_host_port(request)
-    retries = 3
+    retries = self._MAX_RETRIES
     while True:
+      connection = None
+      pooled_connection = None
+      request_sent = False
       try:
         connection = self._get_connection(
             request_host, request_port, request.is_ssl)
-        connect_start = TIMER()
-        connection.connect()
-        connect_delay = int((TIMER() - connect_start) * 1000)
+        pool_key = self._get_pool_key(connection, request.is_ssl)
+        pooled_connection = self._connection_pool.get(pool_key)
+        if pooled_connection:
+          connection = pooled_connection
+          connect_delay = 0
+        else:
+          connect_start = TIMER()
+          connection.connect()
+          connect_delay = int((TIMER() - connect_start) * 1000)
         start = TIMER()
         connection.request(
             request.command,
             request.full_path,
             request.request_body,
             request.headers)
+        request_sent = True
         response = connection.getresponse()
         headers_delay = int((TIMER() - start) * 1000)
 
@@ -332,6 +529,10 @@ class RealHttpFetch(object):
             'headers': headers_delay,
             'data': chunk_delays
             }
+        if pooled_connection:
+          delays['reused_connection'] = True
+        if not response.will_close:
+          self._connection_pool.put(pool_key, connection)
         archived_http_response = httparchive.ArchivedHttpResponse(
             response.version,
             response.status,
@@ -341,6 +542,13 @@ class RealHttpFetch(object):
             delays)
         return archived_http_response
       except Exception, e:
+        if connection:
+          connection.close()
+        if (pooled_connection and not request_sent and
+            request.command in self._IDEMPOTENT_METHODS):
+          # The server may have closed the idle connection.
+          logging.debug('Reconnecting to fetch %s: %s', request, e)
+          continue
         if retries:
           retries -= 1
           logging.warning('Retrying fetch %s: %s', request, e)
@@ -363,6 +571,8 @@ class RecordHttpArchiveFetch(object):
     self.http_archive = http_archive
     self.real_http_fetch = RealHttpFetch(real_dns_lookup)
     self.inject_script = inject_script
+    # Set in worker processes to send new responses to the archive owner.
+    self.record_queue = None
 
   def __call__(self, request):
     """Fetch the request and return the response.
@@ -381,18 +591,200 @@ class RecordHttpArchiveFetch(object):
       if response is None:
         return None
       self.http_archive[request] = response
+      if self.record_queue:
+        self.record_queue.Put(request, response)
     if self.inject_script:
       response = _InjectScripts(response, self.inject_script)
     logging.debug('Recorded: %s', request)
     return response
 
 
+class RecordQueue(object):
+  """Funnel responses recorded in worker processes into one archive.
+
+  Workers (see daemonserver.WorkerProcessPool) inherit the queue and Put()
+  the responses they record. A thread in the process that owns the archive
+  adds them, so that process is the only writer of the archive that is
+  persisted. Use it in a with-statement in the owning process.
+  """
+
+  def __init__(self, http_archive):
+    self.http_archive = http_archive
+    # SimpleQueue writes synchronously, so nothing is lost when a worker
+    # exits right after a Put().
+    self._queue = multiprocessing.queues.SimpleQueue()
+    self._thread = None
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self._AddResponses)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def __exit__(self, unused_exc_type, unused_exc_value, unused_traceback):
+    self._queue.put(None)
+    self._thread.join()
+
+  def Put(self, request, response):
+    self._queue.put((request, response))
+
+  def _AddResponses(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      request, response = item
+      if request not in self.http_archive:
+        self.http_archive[request] = response
+
+
+def RefetchArchive(requests, real_dns_lookup, num_fetchers=32):
+  """Fetch |requests| again into a new HttpArchive.
+
+  The responses are fetched as in record mode (without script injection) by
+  up to |num_fetchers| concurrent fetches, which share keep-alive
+  connections per host.
+
+  Args:
+    requests: ArchivedHttpRequests to fetch.
+    real_dns_lookup: a function that resolves a host to an IP.
+    num_fetchers: the maximum number of concurrent fetches.
+  Returns:
+    (http_archive, failed_requests)
+  """
+  real_http_fetch = RealHttpFetch(real_dns_lookup)
+  request_queue = Queue.Queue()
+  for request in requests:
+    request_queue.put(request)
+  num_requests = request_queue.qsize()
+  http_archive = httparchive.HttpArchive()
+  failed_requests = []
+  lock = threading.Lock()
+
+  def Fetch():
+    while True:
+      try:
+        request = request_queue.get_nowait()
+      except Queue.Empty:
+        return
+      response = real_http_fetch(request)
+      with lock:
+        if response is None:
+          failed_requests.append(request)
+        else:
+          http_archive[request] = response
+        num_done = len(http_archive) + len(failed_requests)
+      if num_done % 1000 == 0:
+        logging.info('Refetched %d of %d requests', num_done, num_requests)
+
+  threads = [threading.Thread(target=Fetch)
+             for _ in xrange(min(num_fetchers, num_requests))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  real_http_fetch.Close()
+  return http_archive, failed_requests
+
+
+class UnknownRequestLogger(object):
+  """Log requests that cannot be replayed from the archive.
+
+  The first miss of each distinct request is logged right away, repeats are
+  only counted. Diffs against the closest archived request (see
+  HttpArchive.diff) are slow for large archives, so they are computed by a
+  background thread instead of delaying the response. If more than
+  |max_queued| diffs are pending, new ones are skipped.
+
+  Use it in a with-statement (or call Close()) to wait for pending diffs and
+  log a summary of all misses.
+  """
+
+  SUMMARY_SIZE = 20
+
+  def __init__(self, http_archive, use_diff, max_queued=100):
+    """Initialize UnknownRequestLogger.
+
+    Args:
+      http_archive: an instance of a HttpArchive
+      use_diff: If True, log a diff to the closest archived request.
+      max_queued: the maximum number of pending diffs.
+    """
+    self.http_archive = http_archive
+    self.use_diff = use_diff
+    self.miss_counts = collections.Counter()
+    self.num_skipped_diffs = 0
+    self._queue = Queue.Queue(max_queued)
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_exc_type, unused_exc_value, unused_traceback):
+    self.Close()
+
+  def Log(self, request):
+    """Record a miss for |request| and schedule a diff if it is new."""
+    with self._lock:
+      self.miss_counts[request] += 1
+      if self.miss_counts[request] > 1:
+        return
+      if self.use_diff:
+        if not self._thread:
+          self._thread = threading.Thread(target=self._DiffRequests)
+          self._thread.daemon = True
+          self._thread.start()
+        try:
+          self._queue.put_nowait(request)
+        except Queue.Full:
+          self.num_skipped_diffs += 1
+    logging.warning('Could not replay: %s', request)
+
+  def _DiffRequests(self):
+    while True:
+      request = self._queue.get()
+      if request is None:
+        return
+      try:
+        diff = self.http_archive.diff(request)
+      except Exception:
+        logging.exception('Failed to diff unknown request: %s', request)
+        continue
+      if diff:
+        logging.warning(
+            "Nearest request diff for %s "
+            "('-' for archived request, '+' for current request):\n%s",
+            request, diff)
+
+  def Close(self):
+    """Wait for pending diffs and log a summary of the misses."""
+    with self._lock:
+      thread, self._thread = self._thread, None
+    if thread:
+      self._queue.put(None)
+      thread.join()
+    if not self.miss_counts:
+      return
+    most_common = self.miss_counts.most_common(self.SUMMARY_SIZE)
+    logging.warning(
+        'Could not replay %d requests (%d distinct). Most frequent:\n%s',
+        sum(self.miss_counts.itervalues()), len(self.miss_counts),
+        '\n'.join('%6d %s' % (count, request)
+                  for request, count in most_common))
+    if self.num_skipped_diffs:
+      logging.warning('Skipped %d request diffs (too many pending).',
+                      self.num_skipped_diffs)
+
+
 class ReplayHttpArchiveFetch(object):
   """Serve responses from the given HttpArchive."""
 
   def __init__(self, http_archive, real_dns_lookup, inject_script,
                use_diff_on_unknown_requests=False,
-               use_closest_match=False, scramble_images=False):
+               use_closest_match=False, scramble_images=False,
+               inject_cache_bytes=0):
     """Initialize ReplayHttpArchiveFetch.
 
     Args:
@@ -403,13 +795,42 @@ class ReplayHttpArchiveFetch(object):
         with a diff to requests that look similar.
       use_closest_match: If True, on replay mode, serve the closest match
         in the archive instead of giving a 404.
+      inject_cache_bytes: If non-zero, cache responses with the injected
+        script up to this many bytes (see InjectedResponseCache).
     """
     self.http_archive = http_archive
     self.inject_script = inject_script
-    self.use_diff_on_unknown_requests = use_diff_on_unknown_requests
+    self.unknown_request_logger = UnknownRequestLogger(
+        http_archive, use_diff_on_unknown_requests)
     self.use_closest_match = use_closest_match
     self.scramble_images = scramble_images
     self.real_http_fetch = RealHttpFetch(real_dns_lookup)
+    self.inject_script_hash = None
+    if inject_script:
+      self.inject_script_hash = script_injector.GetInjectScriptHash(
+          inject_script)
+    self.inject_cache = None
+    if inject_script and inject_cache_bytes:
+      self.inject_cache = InjectedResponseCache(
+          inject_script, inject_cache_bytes)
+
+  def IsArchiveBaked(self):
+    """Returns True iff the archive already has the inject script baked in.
+
+    See httparchive.HttpArchive.bake().
+    """
+    return (self.inject_script_hash is not None and
+            self.http_archive.metadata.get('inject_script_hash') ==
+            self.inject_script_hash)
+
+  def PrefillInjectCache(self):
+    """Inject the script into archived HTML responses ahead of time."""
+    if self.inject_cache and not self.IsArchiveBaked():
+      self.inject_cache.prefill(self.http_archive)
+
+  def ClearInjectCache(self):
+    if self.inject_cache:
+      self.inject_cache.clear()
 
   def __call__(self, request):
     """Fetch the request and return the response.
@@ -423,6 +844,7 @@ class ReplayHttpArchiveFetch(object):
       return self.real_http_fetch(request)
 
     response = self.http_archive.get(request)
+    archived_request = request
 
     if self.use_closest_match and not response:
       closest_request = self.http_archive.find_closest_request(
@@ -430,21 +852,18 @@ class ReplayHttpArchiveFetch(object):
       if closest_request:
         response = self.http_archive.get(closest_request)
         if response:
+          archived_request = closest_request
           logging.info('Request not found: %s\nUsing closest match: %s',
                        request, closest_request)
 
     if not response:
-      reason = str(request)
-      if self.use_diff_on_unknown_requests:
-        diff = self.http_archive.diff(request)
-        if diff:
-          reason += (
-              "\nNearest request diff "
-              "('-' for archived request, '+' for current request):\n%s" % diff)
-      logging.warning('Could not replay: %s', reason)
+      self.unknown_request_logger.Log(request)
     else:
-      if self.inject_script:
-        response = _InjectScripts(response, self.inject_script)
+      if not self.IsArchiveBaked():
+        if self.inject_cache:
+          response = self.inject_cache.get(archived_request, response)
+        elif self.inject_script:
+          response = _InjectScripts(response, self.inject_script)
       if self.scramble_images:
         response = _ScrambleImages(response)
     return response
@@ -455,7 +874,8 @@ class ControllableHttpArchiveFetch(object):
 
   def __init__(self, http_archive, real_dns_lookup,
                inject_script, use_diff_on_unknown_requests,
-               use_record_mode, use_closest_match, scramble_images):
+               use_record_mode, use_closest_match, scramble_images,
+               inject_cache_bytes=0):
     """Initialize HttpArchiveFetch.
 
     Args:
@@ -467,13 +887,16 @@ class ControllableHttpArchiveFetch(object):
       use_record_mode: If True, start in server in record mode.
       use_closest_match: If True, on replay mode, serve the closest match
         in the archive instead of giving a 404.
+      inject_cache_bytes: If non-zero, the replay mode byte budget for
+        caching responses with the injected script.
     """
     self.http_archive = http_archive
     self.record_fetch = RecordHttpArchiveFetch(
         http_archive, real_dns_lookup, inject_script)
     self.replay_fetch = ReplayHttpArchiveFetch(
         http_archive, real_dns_lookup, inject_script,
-        use_diff_on_unknown_requests, use_closest_match, scramble_images)
+        use_diff_on_unknown_requests, use_closest_match, scramble_images,
+        inject_cache_bytes)
     if use_record_mode:
       self.SetRecordMode()
     else:
@@ -482,6 +905,7 @@ class ControllableHttpArchiveFetch(object):
   def SetRecordMode(self):
     self.fetch = self.record_fetch
     self.is_record_mode = True
+    self.replay_fetch.ClearInjectCache()
 
   def SetReplayMode(self):
     self.fetch = self.replay_fetch
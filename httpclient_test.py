@@ -13,10 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import BaseHTTPServer
+import os
+import SocketServer
+import threading
 import unittest
 
+import httparchive
 import httpclient
 import platformsettings
+import script_injector
 
 
 class RealHttpFetchTest(unittest.TestCase):
@@ -181,5 +187,316 @@ class RealHttpFetchGetConnectionTest(unittest.TestCase):
     self.assertEqual(None, connection._tunnel_port)  # host port
 
 
+class MockConnection(object):
+  def __init__(self):
+    self.is_closed = False
+
+  def close(self):
+    self.is_closed = True
+
+
+class HttpConnectionPoolTest(unittest.TestCase):
+
+  def test_reuses_most_recent_connection(self):
+    pool = httpclient.HttpConnectionPool()
+    first, second = MockConnection(), MockConnection()
+    pool.put('a', first)
+    pool.put('a', second)
+    self.assertIsNone(pool.get('b'))
+    self.assertIs(second, pool.get('a'))
+    self.assertIs(first, pool.get('a'))
+    self.assertIsNone(pool.get('a'))
+    self.assertEqual(0, len(pool))
+
+  def test_closes_idle_connections(self):
+    pool = httpclient.HttpConnectionPool(max_idle_seconds=0)
+    connection = MockConnection()
+    pool.put('a', connection)
+    self.assertIsNone(pool.get('a'))
+    self.assertTrue(connection.is_closed)
+
+  def test_limits_connections_per_key(self):
+    pool = httpclient.HttpConnectionPool(max_idle_per_key=1)
+    first, second = MockConnection(), MockConnection()
+    pool.put('a', first)
+    pool.put('a', second)
+    self.assertTrue(first.is_closed)
+    self.assertEqual(1, len(pool))
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.num_connections += 1
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Length', '4')
+    self.end_headers()
+    self.wfile.write('bat1')
+
+  def log_message(self, *args):
+    pass
+
+
+class RealHttpFetchConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    self.server.num_connections = 0
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.fetch = httpclient.RealHttpFetch(lambda host: '127.0.0.1')
+    self.fetch._get_system_proxy = (
+        lambda is_ssl: platformsettings.SystemProxy(None, None))
+
+  def tearDown(self):
+    self.fetch.Close()
+    self.server.shutdown()
+    self.thread.join()
+    self.server.server_close()
+
+  def get(self, command='GET', request_body=None):
+    request = httparchive.ArchivedHttpRequest(
+        command, 'localhost:%d' % self.server.server_port, '/', request_body,
+        {})
+    return self.fetch(request)
+
+  def close_idle_sockets(self):
+    for _, connection in self.fetch._connection_pool._idle.values()[0]:
+      connection.sock.close()
+
+  def test_reuses_keep_alive_connection(self):
+    first_response = self.get()
+    second_response = self.get()
+    self.assertEqual(['bat1'], second_response.response_data)
+    self.assertNotIn('reused_connection', first_response.delays)
+    self.assertTrue(second_response.delays['reused_connection'])
+    self.assertEqual(0, second_response.delays['connect'])
+    self.assertEqual(1, self.server.num_connections)
+
+  def test_reconnects_when_server_closed_connection(self):
+    self.get()
+    self.close_idle_sockets()
+    self.fetch._MAX_RETRIES = 0
+    response = self.get()
+    self.assertEqual(['bat1'], response.response_data)
+    self.assertNotIn('reused_connection', response.delays)
+
+  def test_counts_failed_non_idempotent_request_as_retry(self):
+    self.get()
+    self.close_idle_sockets()
+    self.fetch._MAX_RETRIES = 0
+    self.assertIsNone(self.get('POST', 'data'))
+    self.assertEqual(1, self.server.num_connections)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class RefetchArchiveTest(unittest.TestCase):
+
+  def test_refetches_requests(self):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server.num_connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    host = 'localhost:%d' % server.server_port
+    requests = [httparchive.ArchivedHttpRequest('GET', host, '/%d' % i, None, {})
+                for i in range(20)]
+    unreachable_request = httparchive.ArchivedHttpRequest(
+        'GET', 'unknown', '/', None, {})
+    try:
+      http_archive, failed_requests = httpclient.RefetchArchive(
+          requests + [unreachable_request],
+          lambda host: '127.0.0.1' if host == 'localhost' else None,
+          num_fetchers=4)
+    finally:
+      server.shutdown()
+      thread.join()
+      server.server_close()
+    self.assertEqual(set(requests), set(http_archive))
+    self.assertEqual(['bat1'], http_archive[requests[0]].response_data)
+    self.assertEqual([unreachable_request], failed_requests)
+    self.assertLessEqual(server.num_connections, 4)
+
+
+class InjectedResponseCacheTest(unittest.TestCase):
+
+  SCRIPT = 'var flag = 0;'
+
+  def create_html_response(self, body):
+    return httparchive.create_response(
+        200, headers=[('content-type', 'text/html')], body=body)
+
+  def create_request(self, path):
+    return httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', path, None, {})
+
+  def test_injects_once(self):
+    cache = httpclient.InjectedResponseCache(self.SCRIPT, 1000)
+    request = self.create_request('/')
+    response = self.create_html_response('<html><head></head></html>')
+    injected = cache.get(request, response)
+    self.assertEqual(
+        '<html><head><script>var flag = 0;</script></head></html>',
+        injected.get_data_as_text())
+    self.assertIs(injected, cache.get(request, response))
+    self.assertEqual(len('<html><head></head></html>') +
+                     len('<script>var flag = 0;</script>'), cache.num_bytes)
+
+  def test_skips_non_html(self):
+    cache = httpclient.InjectedResponseCache(self.SCRIPT, 1000)
+    response = httparchive.create_response(200)
+    self.assertIs(response, cache.get(self.create_request('/'), response))
+    self.assertEqual(0, len(cache))
+
+  def test_replaces_stale_entries(self):
+    cache = httpclient.InjectedResponseCache(self.SCRIPT, 1000)
+    request = self.create_request('/')
+    cache.get(request, self.create_html_response('<head>old'))
+    injected = cache.get(request, self.create_html_response('<head>new'))
+    self.assertEqual('<head><script>var flag = 0;</script>new',
+                     injected.get_data_as_text())
+    self.assertEqual(1, len(cache))
+    self.assertEqual(len(injected.get_data_as_text()), cache.num_bytes)
+
+  def test_evicts_least_recently_used(self):
+    body = '<head>' + 'x' * 100
+    entry_bytes = len(body) + len('<script>var flag = 0;</script>')
+    cache = httpclient.InjectedResponseCache(self.SCRIPT, 2 * entry_bytes)
+    requests = [self.create_request('/%d' % i) for i in range(3)]
+    responses = [self.create_html_response(body) for _ in range(3)]
+    injected = cache.get(requests[0], responses[0])
+    cache.get(requests[1], responses[1])
+    self.assertIs(injected, cache.get(requests[0], responses[0]))
+    cache.get(requests[2], responses[2])
+    self.assertEqual(2, len(cache))
+    self.assertEqual(2 * entry_bytes, cache.num_bytes)
+    self.assertIs(injected, cache.get(requests[0], responses[0]))
+    self.assertIsNot(injected, cache.get(requests[1], responses[1]))
+
+  def test_prefill(self):
+    archive = httparchive.HttpArchive()
+    for i in range(3):
+      archive[self.create_request('/%d' % i)] = self.create_html_response(
+          '<head>%d' % i)
+    archive[self.create_request('/text')] = httparchive.create_response(200)
+    cache = httpclient.InjectedResponseCache(self.SCRIPT, 1000)
+    self.assertEqual(3, cache.prefill(archive))
+
+
+class ReplayHttpArchiveFetchTest(unittest.TestCase):
+
+  SCRIPT = 'var flag = 0;'
+
+  def setUp(self):
+    self.request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {})
+    self.response = httparchive.create_response(
+        200, headers=[('content-type', 'text/html')], body='<head></head>')
+    self.archive = httparchive.HttpArchive()
+    self.archive[self.request] = self.response
+
+  def create_fetch(self, inject_cache_bytes=0):
+    return httpclient.ReplayHttpArchiveFetch(
+        self.archive, lambda host: None, self.SCRIPT,
+        inject_cache_bytes=inject_cache_bytes)
+
+  def test_injects_script(self):
+    for inject_cache_bytes in (0, 1000):
+      fetch = self.create_fetch(inject_cache_bytes)
+      self.assertEqual('<head><script>var flag = 0;</script></head>',
+                       fetch(self.request).get_data_as_text())
+
+  def test_skips_injection_for_baked_archive(self):
+    self.archive.metadata['inject_script_hash'] = (
+        script_injector.GetInjectScriptHash(self.SCRIPT))
+    for inject_cache_bytes in (0, 1000):
+      fetch = self.create_fetch(inject_cache_bytes)
+      self.assertIs(self.response, fetch(self.request))
+
+  def test_injects_script_baked_with_other_script(self):
+    self.archive.metadata['inject_script_hash'] = (
+        script_injector.GetInjectScriptHash('var other = 1;'))
+    self.assertIsNot(self.response, self.create_fetch()(self.request))
+
+  def test_logs_unknown_requests(self):
+    fetch = self.create_fetch()
+    unknown_request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/unknown', None, {})
+    self.assertIsNone(fetch(unknown_request))
+    self.assertIsNone(fetch(unknown_request))
+    self.assertEqual({unknown_request: 2},
+                     fetch.unknown_request_logger.miss_counts)
+
+
+class RecordQueueTest(unittest.TestCase):
+
+  @unittest.skipUnless(hasattr(os, 'fork'), 'Requires fork().')
+  def test_adds_responses_from_other_process(self):
+    archive = httparchive.HttpArchive()
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {})
+    response = httparchive.create_response(200)
+    with httpclient.RecordQueue(archive) as record_queue:
+      pid = os.fork()
+      if pid == 0:
+        record_queue.Put(request, response)
+        os._exit(0)  # pylint: disable=protected-access
+      os.waitpid(pid, 0)
+    self.assertEqual(response, archive[request])
+
+
+class UnknownRequestLoggerTest(unittest.TestCase):
+
+  class BlockingArchive(object):
+
+    def __init__(self):
+      self.unblock = threading.Event()
+      self.diffed_requests = []
+
+    def diff(self, request):
+      self.unblock.wait()
+      self.diffed_requests.append(request)
+      return 'diff'
+
+  def create_request(self, path):
+    return httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', path, None, {})
+
+  def test_diffs_each_request_once(self):
+    archive = self.BlockingArchive()
+    archive.unblock.set()
+    with httpclient.UnknownRequestLogger(archive, True) as logger:
+      for path in ('/a', '/b', '/a'):
+        logger.Log(self.create_request(path))
+    self.assertEqual([self.create_request('/a'), self.create_request('/b')],
+                     archive.diffed_requests)
+    self.assertEqual(2, logger.miss_counts[self.create_request('/a')])
+
+  def test_skips_diffs_when_queue_is_full(self):
+    archive = self.BlockingArchive()
+    logger = httpclient.UnknownRequestLogger(archive, True, max_queued=1)
+    for i in range(5):
+      logger.Log(self.create_request('/%d' % i))
+    # The worker holds at most one request and one more is queued.
+    self.assertLessEqual(3, logger.num_skipped_diffs)
+    archive.unblock.set()
+    logger.Close()
+    self.assertEqual(5 - logger.num_skipped_diffs,
+                     len(archive.diffed_requests))
+
+  def test_without_diff(self):
+    archive = self.BlockingArchive()
+    with httpclient.UnknownRequestLogger(archive, False) as logger:
+      logger.Log(self.create_request('/a'))
+    self.assertEqual([], archive.diffed_requests)
+
+
 if __name__ == '__main__':
   unittest.main()
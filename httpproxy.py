@@ -13,10 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import archiveformat
 import BaseHTTPServer
 import certutils
 import errno
+import itertools
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import select
 import socket
 import SocketServer
 import ssl
@@ -30,6 +36,53 @@ import platformsettings
 import proxyshaper
 import sslproxy
 
+# os.sendfile is new in Python 3.3. The pysendfile module provides it for
+# older versions.
+sendfile = getattr(os, 'sendfile', None)
+if sendfile is None:
+  try:
+    from sendfile import sendfile
+  except ImportError:
+    sendfile = None
+
+# Archived chunks of at least this size are sent from the archive file with
+# sendfile() when possible. Smaller ones are not worth the extra send.
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# Larger chunks are written in pieces of this size, so that no more than this
+# is copied at once (e.g. into a string for an SSL or shaped connection).
+WRITE_SIZE = 64 * 1024
+
+
+def _SendFile(sock, fd, offset, length):
+  """Send |length| bytes at |offset| of the file |fd| to |sock|."""
+  while length:
+    try:
+      sent = sendfile(sock.fileno(), fd, offset, length)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        # Sockets with a timeout are non-blocking.
+        if not select.select([], [sock], [], sock.gettimeout())[1]:
+          raise socket.timeout('timed out')
+        continue
+      raise socket.error(e.errno, e.strerror)
+    if not sent:
+      raise socket.error(errno.EPIPE, 'sendfile() sent no data')
+    offset += sent
+    length -= sent
+
+
+# The maximum number of concurrent server certificate fetches (of hosts that
+# have none in the archive) while pregenerating certificates.
+MAX_SERVER_CERT_FETCHES = 16
+
+
+def _GenerateCert(args):
+  """Generate a certificate in a worker process of pregenerate_certificates."""
+  ca_cert_str, server_cert, host = args
+  return server_cert, certutils.generate_cert(ca_cert_str, server_cert, host)
+
+
 def _HandleSSLCertificateError():
   """
   This method is intended to be called from
@@ -52,6 +105,33 @@ class HttpProxyServerError(HttpProxyError):
   pass
 
 
+def CreateArchivedHttpRequest(command, path, headers, request_body, is_ssl):
+  """Return an ArchivedHttpRequest for a parsed request.
+
+  Args:
+    command: a string (e.g. 'GET' or 'POST').
+    path: the path from the request line.
+    headers: {key: value, ...} where keys are lower case.
+    request_body: a request body string or None.
+    is_ssl: True iff the request came in through SSL.
+  Returns:
+    an ArchivedHttpRequest, or None if there is no host header.
+  """
+  host = headers.get('host')
+  if host is None:
+    logging.error('Request without host header')
+    return None
+
+  parsed = urlparse.urlparse(path)
+  params = ';%s' % parsed.params if parsed.params else ''
+  query = '?%s' % parsed.query if parsed.query else ''
+  fragment = '#%s' % parsed.fragment if parsed.fragment else ''
+  full_path = '%s%s%s%s' % (parsed.path, params, query, fragment)
+
+  return httparchive.ArchivedHttpRequest(
+      command, host, full_path, request_body, headers, is_ssl)
+
+
 class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   protocol_version = 'HTTP/1.1'  # override BaseHTTPServer setting
 
@@ -61,14 +141,20 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   def setup(self):
     """Override StreamRequestHandler method."""
     BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
-    if self.server.traffic_shaping_up_bps:
+    self.network_conditions = self.server.create_network_conditions()
+    up_cwnd = down_cwnd = None
+    if self.network_conditions:
+      # Each direction of the connection does its own congestion control.
+      up_cwnd = proxyshaper.CongestionWindow(
+          self.server.init_cwnd, self.network_conditions)
+      down_cwnd = proxyshaper.CongestionWindow(
+          self.server.init_cwnd, self.network_conditions)
+    if self.server.up_shaper or up_cwnd:
       self.rfile = proxyshaper.RateLimitedFile(
-          self.server.get_active_request_count, self.rfile,
-          self.server.traffic_shaping_up_bps)
-    if self.server.traffic_shaping_down_bps:
+          self.server.up_shaper, self.rfile, up_cwnd)
+    if self.server.down_shaper or down_cwnd:
       self.wfile = proxyshaper.RateLimitedFile(
-          self.server.get_active_request_count, self.wfile,
-          self.server.traffic_shaping_down_bps)
+          self.server.down_shaper, self.wfile, down_cwnd)
 
   # Make request handler logging match our logging format.
   def log_request(self, code='-', size='-'):
@@ -91,71 +177,58 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     return dict(self.headers.items())
 
   def get_archived_http_request(self):
-    host = self.headers.get('host')
-    if host is None:
-      logging.error('Request without host header')
-      return None
-
-    parsed = urlparse.urlparse(self.path)
-    params = ';%s' % parsed.params if parsed.params else ''
-    query = '?%s' % parsed.query if parsed.query else ''
-    fragment = '#%s' % parsed.fragment if parsed.fragment else ''
-    full_path = '%s%s%s%s' % (parsed.path, params, query, fragment)
-
-    return httparchive.ArchivedHttpRequest(
-        self.command,
-        host,
-        full_path,
-        self.read_request_body(),
-        self.get_header_dict(),
-        self.server.is_ssl)
+    return CreateArchivedHttpRequest(
+        self.command, self.path, self.get_header_dict(),
+        self.read_request_body(), self.server.is_ssl)
 
   def send_archived_http_response(self, response):
     try:
-      # We need to set the server name before we start the response.
       is_chunked = response.is_chunked()
-      has_content_length = response.get_header('content-length') is not None
-      self.server_version = response.get_header('server', 'WebPageReplay')
-      self.sys_version = ''
-
       if response.version == 10:
         self.protocol_version = 'HTTP/1.0'
 
-      # If we don't have chunked encoding and there is no content length,
-      # we need to manually compute the content-length.
-      if not is_chunked and not has_content_length:
-        content_length = sum(len(c) for c in response.response_data)
-        response.headers.append(('content-length', str(content_length)))
-
       is_replay = not self.server.http_archive_fetch.is_record_mode
-      if is_replay and self.server.traffic_shaping_delay_ms:
-        logging.debug('Using round trip delay: %sms',
-                      self.server.traffic_shaping_delay_ms)
-        time.sleep(self.server.traffic_shaping_delay_ms / 1000.0)
+      headers_delay_ms = 0
+      if is_replay and self.network_conditions:
+        rtt_ms = self.network_conditions.GetRoundTripTime() * 1000.0
+        logging.debug('Using round trip delay: %sms', rtt_ms)
+        headers_delay_ms += rtt_ms
       if is_replay and self.server.use_delays:
         logging.debug('Using delays (ms): %s', response.delays)
-        time.sleep(response.delays['headers'] / 1000.0)
+        headers_delay_ms += response.delays['headers']
         delays = response.delays['data']
       else:
         delays = [0] * len(response.response_data)
-      self.send_response(response.status, response.reason)
-      # TODO(mbelshe): This is lame - each write is a packet!
-      for header, value in response.headers:
-        if header in ('last-modified', 'expires'):
-          self.send_header(header, response.update_date(value))
-        elif header not in ('date', 'server'):
-          self.send_header(header, value)
-      self.end_headers()
-
-      for chunk, delay in zip(response.response_data, delays):
+      if headers_delay_ms:
+        time.sleep(headers_delay_ms / 1000.0)
+      # The header block is cached by the response (see get_wire_headers).
+      # wfile is buffered, so the headers and the chunks up to the next delay
+      # go out in a single send.
+      self.wfile.write(response.get_wire_headers())
+      connection = response.get_header('connection', '').lower()
+      if connection == 'close':
+        self.close_connection = 1
+      elif connection == 'keep-alive':
+        self.close_connection = 0
+
+      file_extents = self.get_sendfile_extents(response)
+      for index, (chunk, delay) in enumerate(
+          zip(response.response_data, delays)):
         if delay:
           self.wfile.flush()
           time.sleep(delay / 1000.0)
         if is_chunked:
           # Write chunk length (hex) and data (e.g. "A\r\nTESSELATED\r\n").
-          self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+          self.wfile.write('%x\r\n' % len(chunk))
+        if file_extents and len(chunk) >= SENDFILE_MIN_SIZE:
+          self.wfile.flush()
+          fd, extents = file_extents
+          _SendFile(self.connection, fd, *extents[index])
         else:
-          self.wfile.write(chunk)
+          for offset in xrange(0, len(chunk), WRITE_SIZE):
+            self.wfile.write(chunk[offset:offset + WRITE_SIZE])
+        if is_chunked:
+          self.wfile.write('\r\n')
       if is_chunked:
         self.wfile.write('0\r\n\r\n')  # write final, zero-length chunk.
       self.wfile.flush()
@@ -168,6 +241,22 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       logging.error('Error sending response for %s%s: %s',
                     self.headers['host'], self.path, e)
 
+  def get_sendfile_extents(self, response):
+    """Return where the body of |response| is in the archive file.
+
+    Returns:
+      (file descriptor, [(offset, length), ...]) (see
+      archiveformat.ChunkList.get_file_extents), or None if the body cannot
+      be sent with sendfile(): it is not backed by an archive file, or the
+      connection is encrypted or shaped (see proxyshaper.RateLimitedFile).
+    """
+    if (sendfile and
+        isinstance(response.response_data, archiveformat.ChunkList) and
+        type(self.connection) is socket.socket and
+        not isinstance(self.wfile, proxyshaper.RateLimitedFile)):
+      return response.response_data.get_file_extents()
+    return None
+
   def handle_one_request(self):
     """Handle a single HTTP request.
 
@@ -286,7 +375,10 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
   def __init__(self, http_archive_fetch, custom_handlers,
                host='localhost', port=80, use_delays=False, is_ssl=False,
                protocol='HTTP',
-               down_bandwidth='0', up_bandwidth='0', delay_ms='0'):
+               down_bandwidth='0', up_bandwidth='0', delay_ms='0',
+               init_cwnd='0', packet_loss_rate='0', jitter_ms='0',
+               jitter_distribution='normal', shaping_seed=None,
+               reuse_port=False):
     """Start HTTP server.
 
     Args:
@@ -298,6 +390,19 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
       down_bandwidth: Download bandwidth
            Bandwidths measured in [K|M]{bit/s|Byte/s}. '0' means unlimited.
       delay_ms: Propagation delay in milliseconds. '0' means no delay.
+          Responses also go through TCP slow start with this round trip time.
+      init_cwnd: the initial congestion window in packets for slow start.
+          '0' means the Linux default.
+      packet_loss_rate: Packet loss rate in range [0..1]. Lost packets are
+          retransmitted after a delay (see proxyshaper.CongestionWindow).
+      jitter_ms: Variation of the round trip time in milliseconds.
+      jitter_distribution: 'normal' or 'uniform' (see
+          proxyshaper.NetworkConditions).
+      shaping_seed: an integer seed for loss and jitter, or None for a
+          random seed.
+      reuse_port: if True, bind with SO_REUSEPORT so that servers in other
+          processes can listen on the same port (see
+          daemonserver.WorkerProcessPool).
     """
     if platformsettings.SupportsFdLimitControl():
       # BaseHTTPServer opens a new thread and two fds for each connection.
@@ -314,6 +419,7 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
             (hard_limit, desired_limit))
         platformsettings.AdjustFdLimit(desired_limit, hard_limit)
 
+    self.reuse_port = reuse_port
     try:
       BaseHTTPServer.HTTPServer.__init__(self, (host, port), self.HANDLER)
     except Exception, e:
@@ -325,7 +431,20 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
     self.is_ssl = is_ssl
     self.traffic_shaping_down_bps = proxyshaper.GetBitsPerSecond(down_bandwidth)
     self.traffic_shaping_up_bps = proxyshaper.GetBitsPerSecond(up_bandwidth)
+    # The connections share the bandwidth of each direction.
+    self.down_shaper = self.up_shaper = None
+    if self.traffic_shaping_down_bps:
+      self.down_shaper = proxyshaper.BandwidthShaper(
+          self.traffic_shaping_down_bps)
+    if self.traffic_shaping_up_bps:
+      self.up_shaper = proxyshaper.BandwidthShaper(self.traffic_shaping_up_bps)
     self.traffic_shaping_delay_ms = int(delay_ms)
+    self.init_cwnd = int(init_cwnd) or proxyshaper.DEFAULT_INIT_CWND
+    self.packet_loss_rate = float(packet_loss_rate)
+    self.jitter_ms = float(jitter_ms)
+    self.jitter_distribution = jitter_distribution
+    self.shaping_seed = shaping_seed
+    self._num_shaped_connections = itertools.count()
     self.num_active_requests = 0
     self.num_active_connections = 0
     self.total_request_time = 0
@@ -336,6 +455,13 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
         '%s server started on %s:%d' % (self.protocol, self.server_address[0],
                                         self.server_address[1]))
 
+  def server_bind(self):
+    """Override TCPServer method to share the port with other processes."""
+    if self.reuse_port:
+      self.socket.setsockopt(
+          socket.SOL_SOCKET, platformsettings.GetReusePortOption(), 1)
+    BaseHTTPServer.HTTPServer.server_bind(self)
+
   def cleanup(self):
     try:
       self.shutdown()
@@ -348,6 +474,24 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
   def get_active_request_count(self):
     return self.num_active_requests
 
+  def create_network_conditions(self):
+    """Return NetworkConditions for a new connection, or None if not shaped.
+
+    With a seed, the random numbers of a connection depend only on the
+    seed and on the order of the connection.
+    """
+    if not (self.traffic_shaping_delay_ms or self.packet_loss_rate or
+            self.jitter_ms):
+      return None
+    seed = None
+    if self.shaping_seed is not None:
+      seed = (self.shaping_seed, next(self._num_shaped_connections))
+    return proxyshaper.NetworkConditions(
+        self.traffic_shaping_delay_ms / 1000.0,
+        jitter_seconds=self.jitter_ms / 1000.0,
+        jitter_distribution=self.jitter_distribution,
+        packet_loss_rate=self.packet_loss_rate, seed=seed)
+
   def get_request(self):
     self.num_active_connections += 1
     if self.num_active_connections >= HttpProxyServer.connection_limit:
@@ -362,19 +506,151 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
     self.num_active_connections -= 1
 
 
+class HostCertificates(object):
+  """The certificates that HTTPS servers present for the archive hosts.
+
+  Create it (and pregenerate the certificates) before forking worker
+  processes, so that the workers inherit the certificates.
+  """
+
+  def __init__(self, http_archive, ca_cert_str, cert_cache_dir=None):
+    """Initialize HostCertificates.
+
+    Args:
+      http_archive: the HttpArchive with the server certificates.
+      ca_cert_str: the root CA certificate string that signs the
+          certificates.
+      cert_cache_dir: a directory that keeps the generated certificates
+          across runs (see certutils.CertCache), or None.
+    """
+    self._http_archive = http_archive
+    self._ca_cert_str = ca_cert_str
+    self._host_to_cert_map = {}
+    self._server_cert_to_cert_map = {}
+    self._cert_cache = None
+    if cert_cache_dir:
+      self._cert_cache = certutils.CertCache(cert_cache_dir, ca_cert_str)
+      logging.info('Loaded %d certificates from %s',
+                   self._cert_cache.load(), self._cert_cache.cache_dir)
+
+  def get_certificate(self, host):
+    if host in self._host_to_cert_map:
+      return self._host_to_cert_map[host]
+
+    server_cert = self._http_archive.get_server_cert(host)
+    if server_cert in self._server_cert_to_cert_map:
+      cert = self._server_cert_to_cert_map[server_cert]
+      self._host_to_cert_map[host] = cert
+      return cert
+
+    cert = None
+    if self._cert_cache is not None:
+      cert = self._cert_cache.get(host, server_cert)
+    if not cert:
+      cert = certutils.generate_cert(self._ca_cert_str, server_cert, host)
+      if self._cert_cache is not None:
+        self._cert_cache.add(host, server_cert, cert)
+    self._server_cert_to_cert_map[server_cert] = cert
+    self._host_to_cert_map[host] = cert
+    return cert
+
+  def pregenerate(self, num_processes=None):
+    """Generate the certificates of all the HTTPS hosts of the archive.
+
+    Otherwise, the first connection to each host waits in the SNI callback
+    while its certificate is generated (and, for a host without an archived
+    server certificate, while that is fetched).
+
+    Args:
+      num_processes: the maximum number of processes that generate
+          certificates (default: number of CPUs).
+    Returns:
+      the number of generated certificates.
+    """
+    http_archive = self._http_archive
+    hosts = sorted(
+        host for host, responses in http_archive.responses_by_host.iteritems()
+        if host not in self._host_to_cert_map and
+        any(r.is_ssl or r.command == 'SERVER_CERT' for r in responses))
+    if not hosts:
+      return 0
+    # The threads only fetch; the archive is written from this thread.
+    fetch_hosts = [h for h in hosts if not http_archive.has_server_cert(h)]
+    if fetch_hosts:
+      pool = ThreadPool(min(MAX_SERVER_CERT_FETCHES, len(fetch_hosts)))
+      try:
+        fetched_certs = pool.map(certutils.get_host_cert, fetch_hosts)
+      finally:
+        pool.close()
+        pool.join()
+      for host, server_cert in zip(fetch_hosts, fetched_certs):
+        http_archive.set_server_cert(host, server_cert)
+
+    # Like get_certificate, generate one certificate per server certificate.
+    server_cert_to_hosts = {}
+    for host in hosts:
+      server_cert = http_archive.get_server_cert(host)
+      cert = self._server_cert_to_cert_map.get(server_cert)
+      if not cert and self._cert_cache is not None:
+        cert = self._cert_cache.get(host, server_cert)
+      if cert:
+        self._server_cert_to_cert_map[server_cert] = cert
+        self._host_to_cert_map[host] = cert
+      else:
+        server_cert_to_hosts.setdefault(server_cert, []).append(host)
+    num_certs = len(server_cert_to_hosts)
+    if not num_certs:
+      return 0
+    logging.info('Generating %d certificates for %d hosts', num_certs,
+                 sum(len(h) for h in server_cert_to_hosts.itervalues()))
+    args = [(self._ca_cert_str, server_cert, cert_hosts[0])
+            for server_cert, cert_hosts in server_cert_to_hosts.iteritems()]
+    pool = None
+    if num_processes == 1 or num_certs < 2:
+      results = itertools.imap(_GenerateCert, args)
+    else:
+      pool = multiprocessing.Pool(num_processes)
+      results = pool.imap_unordered(_GenerateCert, args)
+    try:
+      for num_done, (server_cert, cert) in enumerate(results, 1):
+        self._server_cert_to_cert_map[server_cert] = cert
+        for host in server_cert_to_hosts[server_cert]:
+          self._host_to_cert_map[host] = cert
+          if self._cert_cache is not None:
+            self._cert_cache.add(host, server_cert, cert)
+        if num_done % 100 == 0 or num_done == num_certs:
+          logging.info('Generated %d of %d certificates', num_done, num_certs)
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+    return num_certs
+
+
 class HttpsProxyServer(HttpProxyServer):
   """SSL server that generates certs for each host."""
 
   def __init__(self, http_archive_fetch, custom_handlers,
-               https_root_ca_cert_path, **kwargs):
+               https_root_ca_cert_path, cert_cache_dir=None,
+               host_certificates=None, **kwargs):
+    """Initialize HttpsProxyServer.
+
+    Args:
+      cert_cache_dir: a directory that keeps the generated certificates
+          across runs (see certutils.CertCache), or None.
+      host_certificates: a HostCertificates shared with other servers, or
+          None to create one (with cert_cache_dir).
+    """
     self.ca_cert_path = https_root_ca_cert_path
     self.HANDLER = sslproxy.wrap_handler(HttpArchiveHandler)
     HttpProxyServer.__init__(self, http_archive_fetch, custom_handlers,
                              is_ssl=True, protocol='HTTPS', **kwargs)
-    with open(self.ca_cert_path, 'r') as cert_file:
-      self._ca_cert_str = cert_file.read()
-    self._host_to_cert_map = {}
-    self._server_cert_to_cert_map = {}
+    if host_certificates is None:
+      with open(self.ca_cert_path, 'r') as cert_file:
+        ca_cert_str = cert_file.read()
+      host_certificates = HostCertificates(
+          http_archive_fetch.http_archive, ca_cert_str, cert_cache_dir)
+    self.host_certificates = host_certificates
 
   def cleanup(self):
     try:
@@ -384,19 +660,14 @@ class HttpsProxyServer(HttpProxyServer):
       pass
 
   def get_certificate(self, host):
-    if host in self._host_to_cert_map:
-      return self._host_to_cert_map[host]
+    return self.host_certificates.get_certificate(host)
 
-    server_cert = self.http_archive_fetch.http_archive.get_server_cert(host)
-    if server_cert in self._server_cert_to_cert_map:
-      cert = self._server_cert_to_cert_map[server_cert]
-      self._host_to_cert_map[host] = cert
-      return cert
+  def pregenerate_certificates(self, num_processes=None):
+    """Generate the certificates of all the HTTPS hosts of the archive.
 
-    cert = certutils.generate_cert(self._ca_cert_str, server_cert, host)
-    self._server_cert_to_cert_map[server_cert] = cert
-    self._host_to_cert_map[host] = cert
-    return cert
+    See HostCertificates.pregenerate.
+    """
+    return self.host_certificates.pregenerate(num_processes)
 
   def handle_error(self, request, client_address):
     _HandleSSLCertificateError()
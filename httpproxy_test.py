@@ -14,9 +14,16 @@
 # limitations under the License.
 
 
+import certutils
+import daemonserver
 import httparchive
 import httplib
 import httpproxy
+import os
+import platformsettings
+import shutil
+import socket
+import tempfile
 import threading
 import unittest
 import util
@@ -45,9 +52,12 @@ class MockHttpArchiveFetch(object):
 
 
 class MockHttpArchiveHandler(httpproxy.HttpArchiveHandler):
+  _count_lock = threading.Lock()
+
   def handle_one_request(self):
     httpproxy.HttpArchiveHandler.handle_one_request(self)
-    HttpProxyTest.HANDLED_REQUEST_COUNT += 1
+    with self._count_lock:
+      HttpProxyTest.HANDLED_REQUEST_COUNT += 1
 
 
 class HttpProxyTest(unittest.TestCase):
@@ -139,7 +149,10 @@ class HttpProxyTest(unittest.TestCase):
       res = conn.getresponse().read()
       self.assertEqual(res, "bat1")
 
-    # Check that the right number of requests have been handled.
+    # Check that the right number of requests have been handled. The count
+    # goes up after a response is sent, so the last one may still be pending.
+    util.WaitFor(
+        lambda: HttpProxyTest.HANDLED_REQUEST_COUNT == 2 * request_count, 1)
     self.assertEqual(2 * request_count, HttpProxyTest.HANDLED_REQUEST_COUNT)
 
     # Check to make sure that exactly "request_count" new threads are active.
@@ -151,6 +164,77 @@ class HttpProxyTest(unittest.TestCase):
 
     util.WaitFor(lambda: threading.activeCount() == initial_thread_count, 1)
 
+  # Tests that responses backed by an archive file are served correctly.
+  def test_archive_backed_response(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      archive_path = os.path.join(temp_dir, 'archive.wpr')
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'localhost:8889', '/index.html', None, {})
+      archive = httparchive.HttpArchive()
+      archive[request] = httparchive.ArchivedHttpResponse(
+          version=11, status=200, reason="OK",
+          headers=[('transfer-encoding', 'chunked')],
+          response_data=["bat1", "bat2"])
+      archive.Persist(archive_path)
+      response = httparchive.HttpArchive.Load(archive_path)[request]
+      self.set_up_proxy_server(response)
+      t = threading.Thread(
+          target=HttpProxyTest.serve_requests_forever, args=(self,))
+      t.start()
+
+      initial_thread_count = threading.activeCount()
+      conn = httplib.HTTPConnection('localhost', 8889, timeout=10)
+      conn.request("GET", "/index.html")
+      self.assertEqual("bat1bat2", conn.getresponse().read())
+      conn.close()
+      util.WaitFor(lambda: threading.activeCount() == initial_thread_count, 2)
+    finally:
+      shutil.rmtree(temp_dir)
+
+  # Tests that large chunks of an archive file are sent with sendfile().
+  def test_large_archive_backed_response(self):
+    sent_lengths = []
+    if httpproxy.sendfile:
+      def SpySendFile(out_fd, in_fd, offset, length):
+        sent = original_sendfile(out_fd, in_fd, offset, length)
+        sent_lengths.append(sent)
+        return sent
+      original_sendfile = httpproxy.sendfile
+      self.addCleanup(setattr, httpproxy, 'sendfile', original_sendfile)
+      httpproxy.sendfile = SpySendFile
+    large_chunk = 'x' * httpproxy.SENDFILE_MIN_SIZE * 3
+    temp_dir = tempfile.mkdtemp()
+    try:
+      archive_path = os.path.join(temp_dir, 'archive.wpr')
+      archive = httparchive.HttpArchive()
+      requests = []
+      for headers in ([], [('transfer-encoding', 'chunked')]):
+        request = httparchive.ArchivedHttpRequest(
+            'GET', 'localhost:8889', '/%d' % len(headers), None, {})
+        archive[request] = httparchive.ArchivedHttpResponse(
+            11, 200, 'OK', headers, ['small', large_chunk])
+        requests.append(request)
+      archive.Persist(archive_path)
+      archive = httparchive.HttpArchive.Load(archive_path)
+      responses = dict((r.full_path, archive[r]) for r in requests)
+      self.set_up_proxy_server(None)
+      self.proxy_server.custom_handlers.handle = (
+          lambda request: responses.get(request.full_path))
+      t = threading.Thread(
+          target=HttpProxyTest.serve_requests_forever, args=(self,))
+      t.start()
+
+      conn = httplib.HTTPConnection('localhost', 8889, timeout=10)
+      for request in requests:
+        conn.request('GET', request.full_path)
+        self.assertEqual('small' + large_chunk, conn.getresponse().read())
+      conn.close()
+    finally:
+      shutil.rmtree(temp_dir)
+    if httpproxy.sendfile:
+      self.assertEqual(2 * len(large_chunk), sum(sent_lengths))
+
   # Test that opening 400 simultaneous connections does not cause httpproxy to
   # hit a process fd limit. The default limit is 256 fds.
   def test_max_fd(self):
@@ -173,10 +257,162 @@ class HttpProxyTest(unittest.TestCase):
       connections.append(conn)
 
     # Check that the right number of requests have been handled.
+    util.WaitFor(
+        lambda: HttpProxyTest.HANDLED_REQUEST_COUNT == request_count, 1)
     self.assertEqual(request_count, HttpProxyTest.HANDLED_REQUEST_COUNT)
 
     for conn in connections:
       conn.close()
 
+
+class MockArchiveFetch(object):
+  def __init__(self, http_archive):
+    self.http_archive = http_archive
+    self.is_record_mode = False
+
+
+@unittest.skipUnless(httpproxy.sendfile, 'sendfile() is not available')
+class SendFileTest(unittest.TestCase):
+
+  def test_times_out_when_client_stops_reading(self):
+    server_sock, client_sock = socket.socketpair()
+    self.addCleanup(server_sock.close)
+    self.addCleanup(client_sock.close)
+    server_sock.settimeout(0.1)
+    with tempfile.TemporaryFile() as f:
+      # More than the socket buffers hold.
+      f.write('x' * 16 * 1024 * 1024)
+      f.flush()
+      self.assertRaises(socket.timeout, httpproxy._SendFile,
+                        server_sock, f.fileno(), 0, 16 * 1024 * 1024)
+
+
+@unittest.skipIf(certutils.openssl_import_error, 'pyOpenSSL is not installed')
+class HttpsProxyServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.temp_dir)
+    self.ca_cert_path = os.path.join(self.temp_dir, 'ca.pem')
+    certutils.write_dummy_ca_cert(*certutils.generate_dummy_ca_cert(),
+                                  cert_path=self.ca_cert_path)
+    with open(self.ca_cert_path) as ca_file:
+      ca_cert_str = ca_file.read()
+    # a.com and b.com share a server certificate, http.com is not HTTPS.
+    self.archive = httparchive.HttpArchive()
+    server_certs = {'a.com': certutils.generate_cert(ca_cert_str, '', 'ab'),
+                    'c.com': certutils.generate_cert(ca_cert_str, '', 'c')}
+    server_certs['b.com'] = server_certs['a.com']
+    for host, server_cert in server_certs.iteritems():
+      request = httparchive.ArchivedHttpRequest(
+          'SERVER_CERT', host, '', None, {})
+      self.archive[request] = httparchive.create_response(
+          200, body=server_cert)
+    for host, is_ssl in (('a.com', True), ('http.com', False)):
+      request = httparchive.ArchivedHttpRequest(
+          'GET', host, '/', None, {}, is_ssl=is_ssl)
+      self.archive[request] = httparchive.create_response(200)
+
+  def create_server(self, **kwargs):
+    server = httpproxy.HttpsProxyServer(
+        MockArchiveFetch(self.archive), None, self.ca_cert_path,
+        host='localhost', port=0, **kwargs)
+    self.addCleanup(server.server_close)
+    return server
+
+  def assertCertificates(self, server):
+    def FailToGenerate(*args):
+      self.fail('Unexpected generate_cert%r' % (args,))
+    self.addCleanup(setattr, certutils, 'generate_cert',
+                    certutils.generate_cert)
+    certutils.generate_cert = FailToGenerate
+    certs = dict((h, server.get_certificate(h))
+                 for h in ('a.com', 'b.com', 'c.com'))
+    self.assertEqual(certs['a.com'], certs['b.com'])
+    self.assertNotEqual(certs['a.com'], certs['c.com'])
+    self.assertEqual(
+        'ab', certutils.load_cert(certs['a.com']).get_subject().commonName)
+
+  def test_pregenerate_certificates(self):
+    server = self.create_server()
+    self.assertEqual(2, server.pregenerate_certificates(num_processes=2))
+    self.assertEqual(0, server.pregenerate_certificates())
+    self.assertCertificates(server)
+
+  def test_pregenerate_certificates_with_cache(self):
+    cert_cache_dir = os.path.join(self.temp_dir, 'cache')
+    self.create_server(cert_cache_dir=cert_cache_dir).pregenerate_certificates()
+    server = self.create_server(cert_cache_dir=cert_cache_dir)
+    self.assertEqual(0, server.pregenerate_certificates(num_processes=1))
+    self.assertCertificates(server)
+
+  def test_pregenerate_certificates_archives_fetched_server_certs(self):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'd.com', '/', None, {}, is_ssl=True)
+    self.archive[request] = httparchive.create_response(200)
+    with open(self.ca_cert_path) as ca_file:
+      server_cert = certutils.generate_cert(ca_file.read(), '', 'd')
+    fetch_threads = []
+    def GetHostCert(host):
+      fetch_threads.append(threading.current_thread())
+      return server_cert
+    self.addCleanup(setattr, certutils, 'get_host_cert',
+                    certutils.get_host_cert)
+    certutils.get_host_cert = GetHostCert
+    set_threads = []
+    set_server_cert = self.archive.set_server_cert
+    def SetServerCert(host, cert):
+      set_threads.append(threading.current_thread())
+      set_server_cert(host, cert)
+    self.archive.set_server_cert = SetServerCert
+
+    server = self.create_server()
+    self.assertEqual(3, server.pregenerate_certificates(num_processes=1))
+    self.assertEqual(1, len(fetch_threads))
+    self.assertEqual([threading.current_thread()], set_threads)
+    self.assertTrue(self.archive.has_server_cert('d.com'))
+    self.assertEqual(server_cert, self.archive.get_server_cert('d.com'))
+
+  def test_shares_host_certificates(self):
+    with open(self.ca_cert_path) as ca_file:
+      host_certificates = httpproxy.HostCertificates(
+          self.archive, ca_file.read())
+    self.assertEqual(2, host_certificates.pregenerate(num_processes=1))
+    server = self.create_server(host_certificates=host_certificates)
+    self.assertEqual(0, server.pregenerate_certificates())
+    self.assertCertificates(server)
+
+
+class WorkerProcessPoolTest(unittest.TestCase):
+
+  def create_server(self, body):
+    response = httparchive.ArchivedHttpResponse(
+        version=10, status=200, reason="OK", headers=[], response_data=[body])
+    return httpproxy.HttpProxyServer(
+        MockHttpArchiveFetch(), MockCustomResponseHandler(response),
+        host='localhost', port=8890, reuse_port=True)
+
+  @unittest.skipUnless(
+      hasattr(os, 'fork') and platformsettings.GetReusePortOption(),
+      'Requires fork() and SO_REUSEPORT.')
+  def test_workers_share_port(self):
+    with self.create_server('parent'):
+      pool = daemonserver.WorkerProcessPool(
+          1, [(self.create_server, ('worker',), {})])
+      with pool:
+        bodies = set()
+        for _ in range(100):
+          conn = httplib.HTTPConnection('localhost', 8890, timeout=10)
+          try:
+            conn.request('GET', '/')
+            bodies.add(conn.getresponse().read())
+          except (httplib.HTTPException, socket.error):
+            pass  # the worker may not be listening yet
+          conn.close()
+          if 'worker' in bodies:
+            break
+      self.assertIn('worker', bodies)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -13,11 +13,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Apply gzip/deflate to separate chunks of data."""
+"""Apply gzip/deflate/brotli/zstd to separate chunks of data.
 
+Each chunk is flushed, so the compressed chunks may be sent one at a time
+(e.g. with HTTP chunked encoding) and uncompressed one at a time.
+
+brotli ('br') needs the brotli module and zstd needs the zstandard module.
+Use is_supported() to check for them.
+
+compress_chunk_lists() and uncompress_chunk_lists() process the bodies of
+many responses at once in a pool of threads. zlib releases the GIL while it
+compresses, so that scales with the number of cores.
+"""
+
+from multiprocessing.pool import ThreadPool
 import struct
 import zlib
 
+try:
+  import brotli
+except ImportError:
+  brotli = None
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+# Content-encodings that compress_chunks and uncompress_chunks know about.
+ENCODINGS = ('gzip', 'deflate', 'br', 'zstd')
+
 GZIP_HEADER = (
     '\037\213'             # magic header
     '\010'                 # compression method
@@ -26,61 +50,164 @@ GZIP_HEADER = (
     '\002'
     '\377')
 
+# Bulk calls with fewer bytes than this are not worth the thread handoffs.
+MIN_PARALLEL_BYTES = 256 * 1024
+
 
-def compress_chunks(uncompressed_chunks, use_gzip):
-  """Compress a list of data with gzip or deflate.
+def is_supported(encoding):
+  """Return True iff |encoding| can be compressed and uncompressed."""
+  if encoding == 'br':
+    return brotli is not None
+  if encoding == 'zstd':
+    return zstandard is not None
+  return encoding in ENCODINGS
+
+
+def _check_supported(encoding):
+  if not is_supported(encoding):
+    raise ValueError('Unsupported content-encoding: %s' % encoding)
+
+
+def _new_compressor(encoding):
+  """Return (compress, flush, finish) functions of a new compressor.
+
+  flush() ends the output of the current chunk, finish() ends the stream.
+  """
+  if encoding == 'gzip':
+    compressor = zlib.compressobj(
+        6, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+  elif encoding == 'deflate':
+    compressor = zlib.compressobj()
+  elif encoding == 'br':
+    compressor = brotli.Compressor()
+    return compressor.process, compressor.flush, compressor.finish
+  else:
+    compressor = zstandard.ZstdCompressor().compressobj()
+    return (compressor.compress,
+            lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush)
+  return (compressor.compress,
+          lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+          lambda: compressor.flush(zlib.Z_FULL_FLUSH) + compressor.flush())
+
+
+def compress_chunks(uncompressed_chunks, encoding):
+  """Compress a list of data with a content-encoding.
 
   The returned chunks may be used with HTTP chunked encoding.
 
   Args:
     uncompressed_chunks: a list of strings
        (e.g. ["this is the first chunk", "and the second"])
-    use_gzip: if True, compress with gzip. Otherwise, use deflate.
+    encoding: one of ENCODINGS (e.g. 'gzip').
 
   Returns:
     [compressed_chunk_1, compressed_chunk_2, ...]
+  Raises:
+    ValueError: if |encoding| is not supported (see is_supported).
   """
+  _check_supported(encoding)
+  use_gzip = encoding == 'gzip'
   if use_gzip:
     size = 0
     crc = zlib.crc32("") & 0xffffffffL
-    compressor = zlib.compressobj(
-        6, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-  else:
-    compressor = zlib.compressobj()
+  compress, flush, finish = _new_compressor(encoding)
   compressed_chunks = []
   last_index = len(uncompressed_chunks) - 1
   for index, data in enumerate(uncompressed_chunks):
-    chunk = ''
+    parts = []
     if use_gzip:
       size += len(data)
       crc = zlib.crc32(data, crc) & 0xffffffffL
       if index == 0:
-        chunk += GZIP_HEADER
-    chunk += compressor.compress(data)
+        parts.append(GZIP_HEADER)
+    parts.append(compress(data))
     if index < last_index:
-      chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+      parts.append(flush())
     else:
-      chunk += (compressor.flush(zlib.Z_FULL_FLUSH) +
-                compressor.flush())
+      parts.append(finish())
       if use_gzip:
-        chunk += (struct.pack("<L", long(crc)) +
-                  struct.pack("<L", long(size)))
-    compressed_chunks.append(chunk)
+        parts.append(struct.pack('<LL', long(crc), long(size)))
+    compressed_chunks.append(''.join(parts))
   return compressed_chunks
 
 
-def uncompress_chunks(compressed_chunks, use_gzip):
-  """Uncompress a list of data compressed with gzip or deflate.
+def uncompress_chunks(compressed_chunks, encoding):
+  """Uncompress a list of data compressed with a content-encoding.
 
   Args:
     compressed_chunks: a list of compressed data
-    use_gzip: if True, uncompress with gzip. Otherwise, use deflate.
+    encoding: one of ENCODINGS (e.g. 'gzip').
 
   Returns:
     [uncompressed_chunk_1, uncompressed_chunk_2, ...]
+  Raises:
+    ValueError: if |encoding| is not supported (see is_supported).
   """
-  if use_gzip:
+  _check_supported(encoding)
+  if encoding == 'gzip':
     decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+  elif encoding == 'br':
+    decompress = brotli.Decompressor().process
+  elif encoding == 'zstd':
+    decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+  elif _has_zlib_header(compressed_chunks):
+    # HTTP deflate is zlib data (as written by compress_chunks), but some
+    # servers send raw deflate data instead.
+    decompress = zlib.decompressobj(zlib.MAX_WBITS).decompress
   else:
     decompress = zlib.decompressobj(-zlib.MAX_WBITS).decompress
-  return [decompress(c) for c in compressed_chunks]
+  return [decompress(str(c)) for c in compressed_chunks]
+
+
+def _has_zlib_header(compressed_chunks):
+  """Return True iff the data starts with a zlib (RFC 1950) header."""
+  header = ''.join(str(c[:2]) for c in compressed_chunks[:2])[:2]
+  if len(header) < 2:
+    return False
+  cmf, flg = struct.unpack('BB', header)
+  return cmf & 0x0f == zlib.DEFLATED and (cmf << 8 | flg) % 31 == 0
+
+
+def _map_chunk_lists(function, chunk_lists, encodings, num_threads):
+  """Return [function(chunks, encoding), ...], in parallel if worthwhile."""
+  items = zip(chunk_lists, encodings)
+  num_bytes = sum(len(c) for chunks, _ in items for c in chunks)
+  if num_threads == 1 or len(items) < 2 or num_bytes < MIN_PARALLEL_BYTES:
+    return [function(chunks, encoding) for chunks, encoding in items]
+  pool = ThreadPool(min(num_threads, len(items)) if num_threads else None)
+  try:
+    # Bodies vary a lot in size, so hand them out one at a time.
+    return pool.map(lambda item: function(*item), items, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def compress_chunk_lists(chunk_lists, encodings, num_threads=None):
+  """Compress many lists of data, e.g. the bodies of many responses.
+
+  Args:
+    chunk_lists: a list of lists of strings (see compress_chunks).
+    encodings: a list with the encoding of each list of chunk_lists.
+    num_threads: the maximum number of threads (default: number of CPUs).
+
+  Returns:
+    [compress_chunks(chunk_lists[0], encodings[0]), ...]
+  """
+  return _map_chunk_lists(compress_chunks, chunk_lists, encodings, num_threads)
+
+
+def uncompress_chunk_lists(chunk_lists, encodings, num_threads=None):
+  """Uncompress many lists of data, e.g. the bodies of many responses.
+
+  Args:
+    chunk_lists: a list of lists of compressed data (see uncompress_chunks).
+    encodings: a list with the encoding of each list of chunk_lists.
+    num_threads: the maximum number of threads (default: number of CPUs).
+
+  Returns:
+    [uncompress_chunks(chunk_lists[0], encodings[0]), ...]
+  """
+  return _map_chunk_lists(
+      uncompress_chunks, chunk_lists, encodings, num_threads)
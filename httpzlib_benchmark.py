@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure bulk compression of response bodies.
+
+Uncompresses and recompresses the compressed bodies of an archive, one
+response at a time (uncompress_chunks/compress_chunks) and all at once with
+increasing numbers of threads (uncompress_chunk_lists/compress_chunk_lists).
+Without an archive, synthetic text bodies are used.
+
+Usage:
+$ ./httpzlib_benchmark.py [--threads 1,2,4,8] [archive.wpr]
+"""
+
+import optparse
+import random
+import sys
+import time
+
+import httparchive
+import httpzlib
+
+
+def _load_bodies(filename):
+  """Return ([compressed chunks, ...], [encoding, ...]) of an archive."""
+  archive = httparchive.HttpArchive.Load(filename)
+  responses = [r for r in archive.itervalues()
+               if r.is_compressed() and
+               httpzlib.is_supported(r.get_header('content-encoding'))]
+  return ([[str(c) for c in r.response_data] for r in responses],
+          [r.get_header('content-encoding') for r in responses])
+
+
+def _create_bodies(count):
+  """Return ([compressed chunks, ...], [encoding, ...]) of synthetic text."""
+  rand = random.Random(0)
+  words = ['<div class="item%d">%x</div>' % (i, rand.getrandbits(32))
+           for i in xrange(1000)]
+  chunk_lists = []
+  encodings = []
+  for i in xrange(count):
+    num_words = rand.randint(100, 20000)
+    text = ''.join(rand.choice(words) for _ in xrange(num_words))
+    encoding = 'deflate' if i % 4 == 0 else 'gzip'
+    chunk_lists.append(httpzlib.compress_chunks([text], encoding))
+    encodings.append(encoding)
+  return chunk_lists, encodings
+
+
+def _time(function, *args):
+  start = time.time()
+  result = function(*args)
+  return time.time() - start, result
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options] [archive]')
+  option_parser.add_option('-t', '--threads', default='1,2,4,8',
+                           help='Comma separated numbers of threads.')
+  option_parser.add_option('-n', '--responses', default=500, type='int',
+                           help='Number of synthetic responses (no archive).')
+  options, args = option_parser.parse_args()
+
+  if args:
+    chunk_lists, encodings = _load_bodies(args[0])
+  else:
+    chunk_lists, encodings = _create_bodies(options.responses)
+  print 'responses: %d' % len(chunk_lists)
+  print 'compressed bytes: %d' % sum(
+      len(c) for chunks in chunk_lists for c in chunks)
+
+  elapsed, uncompressed = _time(
+      lambda: [httpzlib.uncompress_chunks(c, e)
+               for c, e in zip(chunk_lists, encodings)])
+  print 'uncompressed bytes: %d' % sum(
+      len(c) for chunks in uncompressed for c in chunks)
+  print 'serial: uncompress %.3fs' % elapsed,
+  elapsed, _ = _time(
+      lambda: [httpzlib.compress_chunks(c, e)
+               for c, e in zip(uncompressed, encodings)])
+  print 'compress %.3fs' % elapsed
+
+  for num_threads in [int(n) for n in options.threads.split(',')]:
+    elapsed, _ = _time(httpzlib.uncompress_chunk_lists,
+                       chunk_lists, encodings, num_threads)
+    print '%d threads: uncompress %.3fs' % (num_threads, elapsed),
+    elapsed, _ = _time(httpzlib.compress_chunk_lists,
+                       uncompressed, encodings, num_threads)
+    print 'compress %.3fs' % elapsed
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import httpzlib
+import StringIO
+import unittest
+import zlib
+
+
+class HttpZlibTest(unittest.TestCase):
+
+  CHUNKS = ['first chunk ' * 10, 'second', 'third chunk ' * 20]
+
+  def assertRoundTrip(self, encoding):
+    compressed = httpzlib.compress_chunks(self.CHUNKS, encoding)
+    self.assertEqual(3, len(compressed))
+    self.assertEqual(self.CHUNKS,
+                     httpzlib.uncompress_chunks(compressed, encoding))
+    # Each chunk can be uncompressed as soon as it arrives.
+    self.assertEqual(self.CHUNKS[:1],
+                     httpzlib.uncompress_chunks(compressed[:1], encoding))
+    return compressed
+
+  def test_gzip_round_trip(self):
+    compressed = self.assertRoundTrip('gzip')
+    gzip_file = gzip.GzipFile(fileobj=StringIO.StringIO(''.join(compressed)))
+    self.assertEqual(''.join(self.CHUNKS), gzip_file.read())
+
+  def test_deflate_round_trip(self):
+    compressed = self.assertRoundTrip('deflate')
+    self.assertEqual(''.join(self.CHUNKS), zlib.decompress(''.join(compressed)))
+
+  def test_raw_deflate(self):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    raw = compressor.compress('raw data') + compressor.flush()
+    self.assertEqual(['raw data'],
+                     httpzlib.uncompress_chunks([raw], 'deflate'))
+
+  @unittest.skipUnless(httpzlib.brotli, 'brotli is not installed')
+  def test_brotli_round_trip(self):
+    compressed = self.assertRoundTrip('br')
+    self.assertEqual(''.join(self.CHUNKS),
+                     httpzlib.brotli.decompress(''.join(compressed)))
+
+  @unittest.skipUnless(httpzlib.zstandard, 'zstandard is not installed')
+  def test_zstd_round_trip(self):
+    self.assertRoundTrip('zstd')
+
+  def test_unsupported_encoding(self):
+    self.assertFalse(httpzlib.is_supported('sdch'))
+    self.assertRaises(ValueError, httpzlib.compress_chunks, ['a'], 'sdch')
+    self.assertRaises(ValueError, httpzlib.uncompress_chunks, ['a'], 'sdch')
+
+  def test_chunk_lists(self):
+    chunk_lists = [self.CHUNKS, ['x' * 100000], [], ['y'] * 50]
+    encodings = ['gzip', 'deflate', 'gzip', 'deflate']
+    for num_threads in (None, 1, 3):
+      compressed = httpzlib.compress_chunk_lists(
+          chunk_lists, encodings, num_threads)
+      self.assertEqual(
+          [httpzlib.compress_chunks(c, e)
+           for c, e in zip(chunk_lists, encodings)], compressed)
+      self.assertEqual(chunk_lists, httpzlib.uncompress_chunk_lists(
+          compressed, encodings, num_threads))
+
+  def test_chunk_lists_in_parallel(self):
+    self.addCleanup(setattr, httpzlib, 'MIN_PARALLEL_BYTES',
+                    httpzlib.MIN_PARALLEL_BYTES)
+    httpzlib.MIN_PARALLEL_BYTES = 0
+    chunk_lists = [['body %d' % i] * i for i in range(20)]
+    encodings = ['gzip' if i % 2 else 'deflate' for i in range(20)]
+    compressed = httpzlib.compress_chunk_lists(chunk_lists, encodings, 4)
+    self.assertEqual(chunk_lists, httpzlib.uncompress_chunk_lists(
+        compressed, encodings, 4))
+
+
+if __name__ == '__main__':
+  unittest.main()
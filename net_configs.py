@@ -27,6 +27,11 @@ import collections
 
 NetConfig = collections.namedtuple('NetConfig', ['down', 'up', 'delay_ms'])
 
+# Packet loss and jitter on top of a NetConfig (see GetNetImpairment).
+NetImpairment = collections.namedtuple(
+    'NetImpairment', ['packet_loss_rate', 'jitter_ms'])
+NO_IMPAIRMENT = NetImpairment(packet_loss_rate='0', jitter_ms='0')
+
 
 # pylint: disable=bad-whitespace
 _NET_CONFIGS = {
@@ -35,6 +40,12 @@ _NET_CONFIGS = {
     'dsl':    NetConfig(down= '1536Kbit/s', up= '384Kbit/s', delay_ms=  '50'),
     'cable':  NetConfig(down=    '5Mbit/s', up=   '1Mbit/s', delay_ms=  '28'),
     'fios':   NetConfig(down=   '20Mbit/s', up=   '5Mbit/s', delay_ms=   '4'),
+    # Not from webpagetest.org: 3g with loss and jitter of a weak signal.
+    '3g_lossy': NetConfig(down='1638Kbit/s', up='768Kbit/s', delay_ms='150'),
+    }
+
+_NET_IMPAIRMENTS = {
+    '3g_lossy': NetImpairment(packet_loss_rate='0.02', jitter_ms='40'),
     }
 
 
@@ -46,3 +57,10 @@ def GetNetConfig(key):
   if key not in _NET_CONFIGS:
     raise KeyError('No net config with key: %s' % key)
   return _NET_CONFIGS[key]
+
+
+def GetNetImpairment(key):
+  """Returns the NetImpairment of the net config |key| (default: none)."""
+  if key not in _NET_CONFIGS:
+    raise KeyError('No net config with key: %s' % key)
+  return _NET_IMPAIRMENTS.get(key, NO_IMPAIRMENT)
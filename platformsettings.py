@@ -37,6 +37,7 @@ import socket
 import stat
 import subprocess
 import sys
+import tempfile
 import time
 import urlparse
 
@@ -105,6 +106,19 @@ def SupportsFdLimitControl():
   return os.name is 'posix'
 
 
+def GetReusePortOption():
+  """Returns the SO_REUSEPORT socket option, or None if it is not supported.
+
+  Python 2 does not define socket.SO_REUSEPORT on Linux (supported since
+  kernel 3.9), so its value is filled in here.
+  """
+  if hasattr(socket, 'SO_REUSEPORT'):
+    return socket.SO_REUSEPORT
+  if platform.system() == 'Linux':
+    return 15
+  return None
+
+
 def GetFdLimit():
   """Returns a tuple of (soft_limit, hard_limit)."""
   import resource
@@ -203,6 +217,33 @@ class _BasePlatformSettings(object):
                       'Error: %s' % e.message)
       return False
 
+  def _tc_cmd(self):
+    raise NotImplementedError
+
+  def tc_batch(self, commands):
+    """Run all of |commands| with one tc process.
+
+    Args:
+      commands: a sequence of tc argument lists, e.g. [('qdisc', 'show')].
+    Raises:
+      CalledProcessError if tc fails.
+    Returns:
+      output as a byte string.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.tc') as batch_file:
+      for command in commands:
+        batch_file.write(' '.join(str(a) for a in command) + '\n')
+      batch_file.flush()
+      return self._check_output(self._tc_cmd(), '-batch', batch_file.name,
+                                elevate_privilege=True)
+
+  def ip_link(self, *args):
+    raise NotImplementedError
+
+  def get_primary_interface(self):
+    """Return the name of the interface of the default route."""
+    raise NotImplementedError
+
   def _get_cwnd(self):
     return None
 
@@ -516,6 +557,7 @@ class _LinuxPlatformSettings(_PosixPlatformSettings):
   """
   RESOLV_CONF = '/etc/resolv.conf'
   ROUTE_RE = re.compile('initcwnd (\d+)')
+  ROUTE_DEVICE_RE = re.compile(r'\bdev (\S+)')
   TCP_BASE_MSS = 'net.ipv4.tcp_base_mss'
   TCP_MTU_PROBING = 'net.ipv4.tcp_mtu_probing'
 
@@ -526,6 +568,19 @@ class _LinuxPlatformSettings(_PosixPlatformSettings):
         return line
     return None
 
+  def get_primary_interface(self):
+    default_line = self._get_default_route_line()
+    m = self.ROUTE_DEVICE_RE.search(default_line or '')
+    if not m:
+      raise PlatformSettingsError('Unable to find the default route device.')
+    return m.group(1)
+
+  def _tc_cmd(self):
+    return 'tc'
+
+  def ip_link(self, *args):
+    return self._check_output('ip', 'link', *args, elevate_privilege=True)
+
   def _set_cwnd(self, cwnd):
     default_line = self._get_default_route_line()
     self._check_output(
@@ -787,6 +842,9 @@ get_httpproxy_ip_address = _inst.get_httpproxy_ip_address
 get_system_proxy = _inst.get_system_proxy
 ipfw = _inst.ipfw
 has_ipfw = _inst.has_ipfw
+tc_batch = _inst.tc_batch
+ip_link = _inst.ip_link
+get_primary_interface = _inst.get_primary_interface
 set_temporary_tcp_init_cwnd = _inst.set_temporary_tcp_init_cwnd
 setup_temporary_loopback_config = _inst.setup_temporary_loopback_config
 
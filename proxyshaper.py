@@ -18,14 +18,22 @@
 Allows running replay without dummynet.
 """
 
-import logging
+import collections
+import delayscheduler
 import platformsettings
+import random
 import re
-import time
+import threading
 
 
 TIMER = platformsettings.timer
 
+# TCP maximum segment size on Ethernet.
+BYTES_PER_PACKET = 1460
+
+# The initial congestion window of Linux (RFC 6928).
+DEFAULT_INIT_CWND = 10
+
 
 class ProxyShaperError(Exception):
   """Module catch-all error."""
@@ -36,57 +44,281 @@ class BandwidthValueError(ProxyShaperError):
   pass
 
 
-class RateLimitedFile(object):
-  """Wrap a file like object with rate limiting.
+class _Packet(object):
+  """A packet of a connection that waits for the shared link."""
+  __slots__ = ('num_bytes', 'start_time', 'deadline', 'waiter')
+
+  def __init__(self, num_bytes, start_time):
+    self.num_bytes = num_bytes
+    self.start_time = start_time
+    self.deadline = None
+    # Released when the packet is scheduled on the link.
+    self.waiter = threading.Lock()
+    self.waiter.acquire()
+
+
+class BandwidthShaper(object):
+  """Share one bandwidth limit fairly among connections.
 
-  TODO(slamm): Simulate slow-start.
-      Each RateLimitedFile corresponds to one-direction of a
-      bidirectional socket. Slow-start can be added here (algorithm needed).
-      Will consider changing this class to take read and write files and
-      corresponding bit rates for each.
+  A server has one shaper per direction. It models a single link: packets
+  pass one at a time, each for its transfer time at the full rate. Every
+  connection has a queue of waiting packets, and the next packet is taken
+  from those queues by deficit round robin. So the aggregate throughput is
+  the configured rate, connections that are waiting share it equally, and
+  connections that are idle (e.g. between chunks) take none of it.
   """
-  BYTES_PER_WRITE = 1460
+  # Deficit round robin quantum.
+  BYTES_PER_ROUND = BYTES_PER_PACKET
 
-  def __init__(self, request_counter, f, bps):
-    """Initialize a RateLimiter.
+  # How far the link may fall behind its deadlines and still catch up.
+  # Beyond that, the link is considered idle and starts over.
+  MAX_LAG_SECONDS = 0.01
+
+  def __init__(self, bps):
+    """Initialize a BandwidthShaper.
 
     Args:
-      request_counter: callable to see how many requests share the limit.
-      f: file-like object to wrap.
       bps: an integer of bits per second.
     """
-    self.request_counter = request_counter
-    self.original_file = f
     self.bps = bps
+    self._lock = threading.Lock()
+    self._queues = {}  # connection -> deque of _Packet
+    self._deficits = {}  # connection -> number of bytes it may send
+    self._round_robin = collections.deque()  # connections with packets
+    self._has_quantum = False  # True iff round_robin[0] got its quantum
+    self._is_sending = False
+    self._link_free_time = 0
 
   def transfer_seconds(self, num_bytes):
     """Seconds to read/write |num_bytes| with |self.bps|."""
     return 8.0 * num_bytes / self.bps
 
+  def Transfer(self, connection, num_bytes, start_time=None):
+    """Block until |num_bytes| of |connection| have passed the link.
+
+    Args:
+      connection: any hashable that identifies the connection.
+      num_bytes: the size of the packet.
+      start_time: a TIMER() value from when the bytes could start to pass
+          (e.g. when a read started), or None for now.
+    """
+    packet = _Packet(num_bytes, start_time)
+    with self._lock:
+      queue = self._queues.get(connection)
+      if queue is None:
+        queue = self._queues[connection] = collections.deque()
+        self._deficits[connection] = 0
+        self._round_robin.append(connection)
+      queue.append(packet)
+      self._SendNextPacket()
+    packet.waiter.acquire()
+    try:
+      delayscheduler.SleepUntil(packet.deadline)
+    finally:
+      with self._lock:
+        self._is_sending = False
+        self._SendNextPacket()
+
+  def _SendNextPacket(self):
+    """Schedule the next packet on the link if it is free.
+
+    Must be called with self._lock held.
+    """
+    if self._is_sending or not self._round_robin:
+      return
+    while True:
+      connection = self._round_robin[0]
+      queue = self._queues[connection]
+      if not self._has_quantum:
+        self._deficits[connection] += self.BYTES_PER_ROUND
+        self._has_quantum = True
+      if self._deficits[connection] >= queue[0].num_bytes:
+        break
+      self._round_robin.rotate(-1)
+      self._has_quantum = False
+    packet = queue.popleft()
+    self._deficits[connection] -= packet.num_bytes
+    if not queue:
+      # An idle connection does not keep its deficit.
+      del self._queues[connection]
+      del self._deficits[connection]
+      self._round_robin.popleft()
+      self._has_quantum = False
+
+    start = self._link_free_time
+    if packet.start_time is not None:
+      start = max(start, packet.start_time)
+    elif start < TIMER() - self.MAX_LAG_SECONDS:
+      start = TIMER()
+    packet.deadline = start + self.transfer_seconds(packet.num_bytes)
+    self._link_free_time = packet.deadline
+    self._is_sending = True
+    packet.waiter.release()
+
+
+class NetworkConditions(object):
+  """The round trip time, jitter and packet loss of one connection.
+
+  The random numbers come from a generator per connection, so a seed
+  gives the same jitter and losses for the same connection order.
+  """
+  JITTER_DISTRIBUTIONS = ('normal', 'uniform')
+
+  def __init__(self, rtt_seconds, jitter_seconds=0,
+               jitter_distribution='normal', packet_loss_rate=0, seed=None):
+    """Initialize NetworkConditions.
+
+    Args:
+      rtt_seconds: the mean round trip time.
+      jitter_seconds: the standard deviation of the round trip time for a
+          'normal' |jitter_distribution|, or the maximum deviation in either
+          direction for 'uniform'.
+      jitter_distribution: one of JITTER_DISTRIBUTIONS.
+      packet_loss_rate: the probability that a packet is lost, in [0..1].
+      seed: the seed of the random numbers, or None to seed from the time.
+    """
+    if jitter_distribution not in self.JITTER_DISTRIBUTIONS:
+      raise ProxyShaperError(
+          'Unknown jitter distribution: %s' % jitter_distribution)
+    if not 0 <= packet_loss_rate <= 1:
+      raise ProxyShaperError(
+          'Packet loss rate must be in [0..1]: %s' % packet_loss_rate)
+    self.rtt_seconds = rtt_seconds
+    self.jitter_seconds = jitter_seconds
+    self.jitter_distribution = jitter_distribution
+    self.packet_loss_rate = packet_loss_rate
+    self._random = random.Random(seed)
+
+  def GetRoundTripTime(self):
+    """Return the seconds of one round trip, including jitter."""
+    if not self.jitter_seconds:
+      return self.rtt_seconds
+    if self.jitter_distribution == 'normal':
+      jitter = self._random.gauss(0, self.jitter_seconds)
+    else:
+      jitter = self._random.uniform(-self.jitter_seconds, self.jitter_seconds)
+    return max(0, self.rtt_seconds + jitter)
+
+  def IsLost(self, num_bytes):
+    """Return True iff |num_bytes| (at most a packet) are lost."""
+    if not self.packet_loss_rate:
+      return False
+    loss_rate = self.packet_loss_rate * num_bytes / float(BYTES_PER_PACKET)
+    return self._random.random() < loss_rate
+
+
+class CongestionWindow(object):
+  """Emulate TCP congestion control for one direction of a connection.
+
+  The sender may send a window of cwnd packets per round trip. The acks of
+  a round grow the window by one packet each, so it doubles every round
+  trip that fills it (slow start). Like Linux, the window restarts from the
+  initial window after the connection has been idle for longer than a
+  retransmission timeout (RFC 5681 section 4.1).
+
+  A lost packet is retransmitted after a round trip if the window is large
+  enough for three duplicate acks (fast retransmit), and after the
+  retransmission timeout otherwise. The loss halves the window, which then
+  grows by one packet per round trip (congestion avoidance).
+  """
+  # Linux TCP_RTO_MIN.
+  MIN_RTO_SECONDS = 0.2
+
+  # Fast retransmit needs the 3 packets after the lost one to be acked.
+  MIN_FAST_RETRANSMIT_CWND = 4
+
+  def __init__(self, init_cwnd, network_conditions):
+    """Initialize a CongestionWindow.
+
+    Args:
+      init_cwnd: the initial window in packets.
+      network_conditions: the NetworkConditions of the connection.
+    """
+    self.init_cwnd = init_cwnd
+    self.network_conditions = network_conditions
+    self.cwnd = init_cwnd
+    self.ssthresh = None  # no loss yet
+    self.num_lost_packets = 0
+    self._round_start = None
+    self._round_bytes = 0
+    self._last_send_time = None
+
+  def Wait(self, num_bytes):
+    """Block until |num_bytes| (at most a packet) have been sent."""
+    conditions = self.network_conditions
+    now = TIMER()
+    if (self._last_send_time is None or now - self._last_send_time >
+        conditions.rtt_seconds + self.MIN_RTO_SECONDS):
+      self.cwnd = self.init_cwnd
+      self.ssthresh = None
+      self._StartRound(now)
+    elif self._round_bytes + num_bytes > self.cwnd * BYTES_PER_PACKET:
+      # Wait for the acks of the round.
+      round_end = self._round_start + conditions.GetRoundTripTime()
+      delayscheduler.SleepUntil(round_end)
+      if self.ssthresh is None or self.cwnd < self.ssthresh:
+        self.cwnd += (self._round_bytes + BYTES_PER_PACKET - 1) // (
+            BYTES_PER_PACKET)
+      else:
+        self.cwnd += 1
+      # If the bandwidth limit is slower than the window, the round trip
+      # has already passed.
+      self._StartRound(max(round_end, TIMER()))
+    if conditions.IsLost(num_bytes):
+      self.num_lost_packets += 1
+      retransmit_delay = conditions.GetRoundTripTime()
+      if self.cwnd < self.MIN_FAST_RETRANSMIT_CWND:
+        retransmit_delay += self.MIN_RTO_SECONDS
+      self.ssthresh = self.cwnd = max(self.cwnd // 2, 2)
+      delayscheduler.SleepUntil(TIMER() + retransmit_delay)
+      self._StartRound(TIMER())
+    self._round_bytes += num_bytes
+    self._last_send_time = TIMER()
+
+  def _StartRound(self, start_time):
+    self._round_start = start_time
+    self._round_bytes = 0
+
+
+class RateLimitedFile(object):
+  """Wrap a file like object with rate limiting.
+
+  Each RateLimitedFile corresponds to one direction of a bidirectional
+  socket.
+  """
+  BYTES_PER_WRITE = BYTES_PER_PACKET
+
+  def __init__(self, shaper, f, congestion_window=None):
+    """Initialize a RateLimiter.
+
+    Args:
+      shaper: a BandwidthShaper that is shared by the connections of one
+          direction, or None for unlimited bandwidth.
+      f: file-like object to wrap.
+      congestion_window: a CongestionWindow of this direction, or None.
+    """
+    self.shaper = shaper
+    self.original_file = f
+    self.congestion_window = congestion_window
+
+  def _transfer(self, num_bytes, start_time=None):
+    if self.congestion_window:
+      self.congestion_window.Wait(num_bytes)
+    if self.shaper:
+      self.shaper.Transfer(self, num_bytes, start_time)
+
   def write(self, data):
-    num_bytes = len(data)
-    num_sent_bytes = 0
-    while num_sent_bytes < num_bytes:
-      num_write_bytes = min(self.BYTES_PER_WRITE, num_bytes - num_sent_bytes)
-      num_requests = self.request_counter()
-      wait = self.transfer_seconds(num_write_bytes) * num_requests
-      logging.debug('write sleep: %0.4fs (%d requests)', wait, num_requests)
-      time.sleep(wait)
-
-      self.original_file.write(
-          data[num_sent_bytes:num_sent_bytes + num_write_bytes])
-      num_sent_bytes += num_write_bytes
+    for offset in xrange(0, len(data), self.BYTES_PER_WRITE):
+      packet = data[offset:offset + self.BYTES_PER_WRITE]
+      self._transfer(len(packet))
+      self.original_file.write(packet)
 
   def _read(self, read_func, size):
     start = TIMER()
     data = read_func(size)
-    read_seconds = TIMER() - start
-    num_bytes = len(data)
-    num_requests = self.request_counter()
-    wait = self.transfer_seconds(num_bytes) * num_requests - read_seconds
-    if wait > 0:
-      logging.debug('read sleep: %0.4fs %d requests)', wait, num_requests)
-      time.sleep(wait)
+    # The bytes could pass the link while they were read.
+    for offset in xrange(0, len(data), self.BYTES_PER_WRITE):
+      self._transfer(min(self.BYTES_PER_WRITE, len(data) - offset), start)
     return data
 
   def readline(self, size=-1):
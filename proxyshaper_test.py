@@ -21,6 +21,8 @@ $ ./proxyshaper_test.py
 
 import proxyshaper
 import StringIO
+import threading
+import time
 import unittest
 
 
@@ -60,9 +62,9 @@ class RateLimitedFileTest(TimedTestCase):
   def testReadLimitedBasic(self):
     num_bytes = 1024
     bps = 384000
-    request_counter = lambda: 1
     f = StringIO.StringIO(' ' * num_bytes)
-    limited_f = proxyshaper.RateLimitedFile(request_counter, f, bps)
+    limited_f = proxyshaper.RateLimitedFile(
+        proxyshaper.BandwidthShaper(bps), f)
     start = proxyshaper.TIMER()
     self.assertEqual(num_bytes, len(limited_f.read()))
     expected_ms = 8.0 * num_bytes / bps * 1000.0
@@ -72,35 +74,21 @@ class RateLimitedFileTest(TimedTestCase):
   def testReadlineLimitedBasic(self):
     num_bytes = 1024 * 8 + 512
     bps = 384000
-    request_counter = lambda: 1
     f = StringIO.StringIO(' ' * num_bytes)
-    limited_f = proxyshaper.RateLimitedFile(request_counter, f, bps)
+    limited_f = proxyshaper.RateLimitedFile(
+        proxyshaper.BandwidthShaper(bps), f)
     start = proxyshaper.TIMER()
     self.assertEqual(num_bytes, len(limited_f.readline()))
     expected_ms = 8.0 * num_bytes / bps * 1000.0
     actual_ms = (proxyshaper.TIMER() - start) * 1000.0
     self.assertValuesAlmostEqual(expected_ms, actual_ms)
 
-  def testReadLimitedSlowedByMultipleRequests(self):
-    num_bytes = 1024
-    bps = 384000
-    request_count = 2
-    request_counter = lambda: request_count
-    f = StringIO.StringIO(' ' * num_bytes)
-    limited_f = proxyshaper.RateLimitedFile(request_counter, f, bps)
-    start = proxyshaper.TIMER()
-    num_read_bytes = limited_f.read()
-    self.assertEqual(num_bytes, len(num_read_bytes))
-    expected_ms = 8.0 * num_bytes / (bps / float(request_count)) * 1000.0
-    actual_ms = (proxyshaper.TIMER() - start) * 1000.0
-    self.assertValuesAlmostEqual(expected_ms, actual_ms)
-
   def testWriteLimitedBasic(self):
     num_bytes = 1024 * 10 + 350
     bps = 384000
-    request_counter = lambda: 1
     f = StringIO.StringIO()
-    limited_f = proxyshaper.RateLimitedFile(request_counter, f, bps)
+    limited_f = proxyshaper.RateLimitedFile(
+        proxyshaper.BandwidthShaper(bps), f)
     start = proxyshaper.TIMER()
     limited_f.write(' ' * num_bytes)
     self.assertEqual(num_bytes, len(limited_f.getvalue()))
@@ -108,19 +96,186 @@ class RateLimitedFileTest(TimedTestCase):
     actual_ms = (proxyshaper.TIMER() - start) * 1000.0
     self.assertValuesAlmostEqual(expected_ms, actual_ms)
 
-  def testWriteLimitedSlowedByMultipleRequests(self):
-    num_bytes = 1024 * 10
-    bps = 384000
-    request_count = 2
-    request_counter = lambda: request_count
-    f = StringIO.StringIO(' ' * num_bytes)
-    limited_f = proxyshaper.RateLimitedFile(request_counter, f, bps)
+  def testWriteLimitedManySmallPackets(self):
+    # With a sleep per packet, the oversleeps added up to about 10% here.
+    num_bytes = 1460 * 200
+    bps = 10000000
+    f = StringIO.StringIO()
+    limited_f = proxyshaper.RateLimitedFile(
+        proxyshaper.BandwidthShaper(bps), f)
     start = proxyshaper.TIMER()
     limited_f.write(' ' * num_bytes)
-    self.assertEqual(num_bytes, len(limited_f.getvalue()))
-    expected_ms = 8.0 * num_bytes / (bps / float(request_count)) * 1000.0
+    expected_ms = 8.0 * num_bytes / bps * 1000.0
     actual_ms = (proxyshaper.TIMER() - start) * 1000.0
-    self.assertValuesAlmostEqual(expected_ms, actual_ms)
+    self.assertValuesAlmostEqual(expected_ms, actual_ms, tolerance=0.03)
+
+
+class CongestionWindowTest(TimedTestCase):
+  def testWindowDoublesEachRoundTrip(self):
+    rtt_ms = 50
+    congestion_window = proxyshaper.CongestionWindow(
+        2, proxyshaper.NetworkConditions(rtt_ms / 1000.0))
+    limited_f = proxyshaper.RateLimitedFile(
+        None, StringIO.StringIO(), congestion_window)
+    start = proxyshaper.TIMER()
+    # Rounds of 2, 4, 8 and 1 packets.
+    limited_f.write(' ' * 1460 * 15)
+    actual_ms = (proxyshaper.TIMER() - start) * 1000.0
+    self.assertValuesAlmostEqual(3 * rtt_ms, actual_ms)
+    self.assertEqual(16, congestion_window.cwnd)
+
+  def testWindowRestartsAfterIdle(self):
+    rtt_ms = 20
+    congestion_window = proxyshaper.CongestionWindow(
+        2, proxyshaper.NetworkConditions(rtt_ms / 1000.0))
+    limited_f = proxyshaper.RateLimitedFile(
+        None, StringIO.StringIO(), congestion_window)
+    limited_f.write(' ' * 1460 * 6)
+    self.assertEqual(4, congestion_window.cwnd)
+    time.sleep(rtt_ms / 1000.0 + congestion_window.MIN_RTO_SECONDS)
+    start = proxyshaper.TIMER()
+    limited_f.write(' ' * 1460 * 3)
+    actual_ms = (proxyshaper.TIMER() - start) * 1000.0
+    self.assertValuesAlmostEqual(rtt_ms, actual_ms)
+
+  def testSmallReadsShareAPacket(self):
+    congestion_window = proxyshaper.CongestionWindow(
+        1, proxyshaper.NetworkConditions(60))
+    limited_f = proxyshaper.RateLimitedFile(
+        None, StringIO.StringIO('line\n' * 100), congestion_window)
+    start = proxyshaper.TIMER()
+    for _ in range(100):
+      limited_f.readline()
+    self.assertLess(proxyshaper.TIMER() - start, 1)
+
+
+  def testLostPacketIsRetransmittedAfterRoundTrip(self):
+    rtt_ms = 20
+    conditions = proxyshaper.NetworkConditions(
+        rtt_ms / 1000.0, packet_loss_rate=1)
+    congestion_window = proxyshaper.CongestionWindow(10, conditions)
+    limited_f = proxyshaper.RateLimitedFile(
+        None, StringIO.StringIO(), congestion_window)
+    start = proxyshaper.TIMER()
+    limited_f.write(' ' * 1460)
+    actual_ms = (proxyshaper.TIMER() - start) * 1000.0
+    self.assertValuesAlmostEqual(rtt_ms, actual_ms, tolerance=0.2)
+    self.assertEqual(1, congestion_window.num_lost_packets)
+    self.assertEqual(5, congestion_window.cwnd)
+    self.assertEqual(5, congestion_window.ssthresh)
+
+  def testLossWithSmallWindowWaitsForTimeout(self):
+    rtt_ms = 20
+    conditions = proxyshaper.NetworkConditions(
+        rtt_ms / 1000.0, packet_loss_rate=1)
+    congestion_window = proxyshaper.CongestionWindow(2, conditions)
+    limited_f = proxyshaper.RateLimitedFile(
+        None, StringIO.StringIO(), congestion_window)
+    start = proxyshaper.TIMER()
+    limited_f.write(' ' * 1460)
+    actual_ms = (proxyshaper.TIMER() - start) * 1000.0
+    self.assertValuesAlmostEqual(
+        rtt_ms + congestion_window.MIN_RTO_SECONDS * 1000.0, actual_ms,
+        tolerance=0.1)
+
+
+class NetworkConditionsTest(unittest.TestCase):
+  def testSeedRepeatsJitterAndLoss(self):
+    def Sample(seed):
+      conditions = proxyshaper.NetworkConditions(
+          0.05, jitter_seconds=0.01, packet_loss_rate=0.5, seed=seed)
+      return [(conditions.GetRoundTripTime(), conditions.IsLost(1460))
+              for _ in range(20)]
+    self.assertEqual(Sample(7), Sample(7))
+    self.assertNotEqual(Sample(7), Sample(8))
+
+  def testUniformJitterStaysInRange(self):
+    conditions = proxyshaper.NetworkConditions(
+        0.05, jitter_seconds=0.01, jitter_distribution='uniform', seed=1)
+    for _ in range(100):
+      self.assertTrue(0.04 <= conditions.GetRoundTripTime() <= 0.06)
+
+  def testRoundTripTimeIsNotNegative(self):
+    conditions = proxyshaper.NetworkConditions(
+        0.001, jitter_seconds=1, seed=1)
+    for _ in range(100):
+      self.assertLessEqual(0, conditions.GetRoundTripTime())
+
+  def testNoLossWithoutRate(self):
+    conditions = proxyshaper.NetworkConditions(0.05)
+    self.assertFalse(any(conditions.IsLost(1460) for _ in range(100)))
+
+  def testRaisesOnInvalidValues(self):
+    self.assertRaises(proxyshaper.ProxyShaperError,
+                      proxyshaper.NetworkConditions, 0.05,
+                      jitter_distribution='pareto')
+    self.assertRaises(proxyshaper.ProxyShaperError,
+                      proxyshaper.NetworkConditions, 0.05,
+                      packet_loss_rate=1.5)
+
+
+class BandwidthShaperTest(TimedTestCase):
+  def writeConcurrently(self, shaper, sizes, start_delays=None):
+    """Write |sizes| bytes on concurrent connections.
+
+    Returns:
+      (elapsed seconds, [seconds until each connection finished, ...])
+    """
+    start_delays = start_delays or [0] * len(sizes)
+    finish_times = [None] * len(sizes)
+    def Write(i):
+      time.sleep(start_delays[i])
+      limited_f = proxyshaper.RateLimitedFile(shaper, StringIO.StringIO())
+      limited_f.write(' ' * sizes[i])
+      finish_times[i] = proxyshaper.TIMER()
+    start = proxyshaper.TIMER()
+    threads = [threading.Thread(target=Write, args=(i,))
+               for i in range(len(sizes))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return (max(finish_times) - start,
+            [finish_time - start for finish_time in finish_times])
+
+  def testAggregateThroughputUnderConcurrency(self):
+    bps = 4000000
+    sizes = [1460 * 20, 1460 * 40, 1000 * 35, 1460 * 60, 777 * 50]
+    elapsed, _ = self.writeConcurrently(proxyshaper.BandwidthShaper(bps), sizes)
+    expected_ms = 8.0 * sum(sizes) / bps * 1000.0
+    self.assertValuesAlmostEqual(expected_ms, elapsed * 1000.0, tolerance=0.03)
+
+  def testConnectionsShareBandwidthEqually(self):
+    bps = 4000000
+    num_bytes = 1460 * 30
+    _, finish_times = self.writeConcurrently(
+        proxyshaper.BandwidthShaper(bps), [num_bytes] * 4)
+    expected_ms = 8.0 * 4 * num_bytes / bps * 1000.0
+    for finish_time in finish_times:
+      self.assertValuesAlmostEqual(expected_ms, finish_time * 1000.0)
+
+  def testConnectionJoiningMidTransfer(self):
+    # The first connection has the full rate until the second one joins.
+    bps = 4000000
+    num_bytes = 1460 * 60
+    _, finish_times = self.writeConcurrently(
+        proxyshaper.BandwidthShaper(bps), [num_bytes, num_bytes],
+        start_delays=[0, 0.05])
+    transfer_ms = 8.0 * num_bytes / bps * 1000.0
+    expected_first_ms = 50 + (transfer_ms - 50) * 2
+    self.assertValuesAlmostEqual(expected_first_ms, finish_times[0] * 1000.0)
+    self.assertValuesAlmostEqual(2 * transfer_ms, finish_times[1] * 1000.0,
+                                 tolerance=0.03)
+
+  def testIdleConnectionTakesNoBandwidth(self):
+    bps = 4000000
+    shaper = proxyshaper.BandwidthShaper(bps)
+    # A connection that wrote once and is idle now.
+    proxyshaper.RateLimitedFile(shaper, StringIO.StringIO()).write(' ')
+    num_bytes = 1460 * 30
+    elapsed, _ = self.writeConcurrently(shaper, [num_bytes])
+    expected_ms = 8.0 * num_bytes / bps * 1000.0
+    self.assertValuesAlmostEqual(expected_ms, elapsed * 1000.0)
 
 
 class GetBitsPerSecondTest(unittest.TestCase):
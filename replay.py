@@ -24,6 +24,9 @@ To record web pages:
      clear browser caches before this so that all subresources are requested
      from the network.
   3. Kill the process to stop recording.
+  Responses are also appended to archive.wpr.journal as they are recorded.
+  If the process crashes, resume recording with --append, which loads the
+  journal too.
 
 To replay web pages:
   1. Start the program in replay mode with a previously recorded archive.
@@ -39,6 +42,7 @@ Network simulation examples:
   $ sudo ./replay.py --packet_loss_rate=0.01 archive.wpr
 """
 
+import contextlib
 import json
 import logging
 import optparse
@@ -48,6 +52,7 @@ import sys
 import traceback
 
 import customhandlers
+import daemonserver
 import dnsproxy
 import httparchive
 import httpclient
@@ -58,6 +63,11 @@ import script_injector
 import servermanager
 import trafficshaper
 
+try:
+  import eventloopproxy
+except ImportError:  # requires fcntl and poll (POSIX)
+  eventloopproxy = None
+
 if sys.version < '2.6':
   print 'Need Python 2.6 or greater.'
   sys.exit(1)
@@ -87,6 +97,17 @@ def configure_logging(log_level_name, log_file_name=None):
     logger.addHandler(system_handler)
 
 
+@contextlib.contextmanager
+def Journal(http_archive, journal_filename):
+  """Journal the changes of |http_archive| while the servers run.
+
+  The journal is started by the server manager, so that its writer thread
+  starts after the worker processes are forked. replay() closes it.
+  """
+  http_archive.StartJournal(journal_filename)
+  yield
+
+
 def AddDnsForward(server_manager, host):
   """Forward DNS traffic."""
   server_manager.Append(platformsettings.set_temporary_primary_nameserver, host)
@@ -118,39 +139,72 @@ def AddWebProxy(server_manager, options, host, real_dns_lookup, http_archive):
       inject_script,
       options.diff_unknown_requests, options.record,
       use_closest_match=options.use_closest_match,
-      scramble_images=options.scramble_images)
+      scramble_images=options.scramble_images,
+      inject_cache_bytes=options.inject_cache_mb * 1024 * 1024)
+  if options.prefill_inject_cache and not options.record:
+    archive_fetch.replay_fetch.PrefillInjectCache()
   server_manager.AppendRecordCallback(archive_fetch.SetRecordMode)
   server_manager.AppendReplayCallback(archive_fetch.SetReplayMode)
-  server_manager.Append(
-      httpproxy.HttpProxyServer,
-      archive_fetch, custom_handlers,
-      host=host, port=options.port, use_delays=options.use_server_delay,
-      **options.shaping_http)
+  use_workers = options.workers > 1
+  record_queue = None
+  if use_workers and options.record:
+    # Appended first so that it is closed after the workers stop.
+    record_queue = httpclient.RecordQueue(http_archive)
+    server_manager.Append(lambda: record_queue)
+
+  # Appended before the proxies so that it is closed after they stop.
+  servers = [(lambda: archive_fetch.replay_fetch.unknown_request_logger, (),
+              {})]
+  proxy_kwargs = dict(host=host, use_delays=options.use_server_delay,
+                      reuse_port=use_workers, **options.shaping_http)
+  if options.proxy_backend == 'eventloop':
+    http_server = eventloopproxy.EventLoopHttpProxyServer
+    http_to_https_server = eventloopproxy.EventLoopHttpToHttpsProxyServer
+  else:
+    http_server = httpproxy.HttpProxyServer
+    http_to_https_server = httpproxy.HttpToHttpsProxyServer
+  servers.append((http_server,
+                  (archive_fetch, custom_handlers),
+                  dict(proxy_kwargs, port=options.port)))
   if options.ssl:
     if options.should_generate_certs:
-      server_manager.Append(
-          httpproxy.HttpsProxyServer, archive_fetch, custom_handlers,
-          options.https_root_ca_cert_path, host=host, port=options.ssl_port,
-          use_delays=options.use_server_delay, **options.shaping_http)
+      with open(options.https_root_ca_cert_path) as cert_file:
+        host_certificates = httpproxy.HostCertificates(
+            http_archive, cert_file.read(), options.cert_cache_dir)
+      if options.pregenerate_certs:
+        # Before the workers are forked, so that they inherit the certificates.
+        host_certificates.pregenerate()
+      servers.append((httpproxy.HttpsProxyServer,
+                      (archive_fetch, custom_handlers,
+                       options.https_root_ca_cert_path),
+                      dict(proxy_kwargs, port=options.ssl_port,
+                           host_certificates=host_certificates)))
     else:
-      server_manager.Append(
-          httpproxy.SingleCertHttpsProxyServer, archive_fetch,
-          custom_handlers, options.https_root_ca_cert_path, host=host,
-          port=options.ssl_port, use_delays=options.use_server_delay,
-          **options.shaping_http)
+      servers.append((httpproxy.SingleCertHttpsProxyServer,
+                      (archive_fetch, custom_handlers,
+                       options.https_root_ca_cert_path),
+                      dict(proxy_kwargs, port=options.ssl_port)))
   if options.http_to_https_port:
-    server_manager.Append(
-        httpproxy.HttpToHttpsProxyServer,
-        archive_fetch, custom_handlers,
-        host=host, port=options.http_to_https_port,
-        use_delays=options.use_server_delay,
-        **options.shaping_http)
+    servers.append((http_to_https_server,
+                    (archive_fetch, custom_handlers),
+                    dict(proxy_kwargs, port=options.http_to_https_port)))
+  for initializer, init_args, init_kwargs in servers:
+    server_manager.Append(initializer, *init_args, **init_kwargs)
+
+  if use_workers:
+    def InitWorker():
+      archive_fetch.record_fetch.record_queue = record_queue
+      http_archive.record_queue = record_queue
+    # This process serves too, so fork one less.
+    server_manager.SetWorkerPool(daemonserver.WorkerProcessPool,
+                                 options.workers - 1, servers,
+                                 worker_init=InitWorker)
 
 
 def AddTrafficShaper(server_manager, options, host):
   if options.shaping_dummynet:
     server_manager.AppendTrafficShaper(
-        trafficshaper.TrafficShaper, host=host,
+        trafficshaper.KERNEL_SHAPERS[options.kernel_shaper], host=host,
         use_loopback=not options.server_mode and host == '127.0.0.1',
         **options.shaping_dummynet)
 
@@ -165,13 +219,14 @@ class OptionsWrapper(object):
        [...]
   """
   _TRAFFICSHAPING_OPTIONS = {
-      'down', 'up', 'delay_ms', 'packet_loss_rate', 'init_cwnd', 'net'}
+      'down', 'up', 'delay_ms', 'packet_loss_rate', 'jitter_ms', 'init_cwnd',
+      'net'}
   _CONFLICTING_OPTIONS = (
-      ('record', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'net',
-                  'spdy', 'use_server_delay')),
-      ('append', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'net',
-                  'use_server_delay')),  # same as --record
-      ('net', ('down', 'up', 'delay_ms')),
+      ('record', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'jitter_ms',
+                  'net', 'spdy', 'use_server_delay')),
+      ('append', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'jitter_ms',
+                  'net', 'use_server_delay')),  # same as --record
+      ('net', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'jitter_ms')),
       ('server', ('server_mode',)),
   )
 
@@ -209,6 +264,25 @@ class OptionsWrapper(object):
         not platformsettings.HasSniSupport()):
       self._parser.error('Option --should_generate_certs requires pyOpenSSL '
                          '0.13 or greater for SNI support.')
+    if ((self._options.pregenerate_certs or self._options.cert_cache_dir) and
+        not self._options.should_generate_certs):
+      self._parser.error('Options --pregenerate_certs and --cert_cache_dir '
+                         'require --should_generate_certs.')
+    if self._options.workers > 1 and (
+        not hasattr(os, 'fork') or
+        platformsettings.GetReusePortOption() is None):
+      self._parser.error('Option --workers requires fork() and SO_REUSEPORT.')
+    if self._options.proxy_backend == 'eventloop':
+      if not eventloopproxy:
+        self._parser.error('Option --proxy_backend=eventloop requires fcntl '
+                           'and poll (POSIX).')
+      if (self._options.shaping_type == 'proxy' and
+          self._nondefaults.intersection(
+              ('down', 'up', 'net', 'init_cwnd', 'packet_loss_rate',
+               'jitter_ms'))):
+        self._parser.error('Option --proxy_backend=eventloop does not support '
+                           'bandwidth shaping, --init_cwnd, loss or jitter '
+                           'with --shaping_type=proxy.')
 
   def _ShapingKeywordArgs(self, shaping_key):
     """Return the shaping keyword args for |shaping_key|.
@@ -230,16 +304,15 @@ class OptionsWrapper(object):
       if shaping_key in ('dummynet', 'http'):
         AddItemIfSet(kwargs, 'down_bandwidth', opt_key='down')
         AddItemIfSet(kwargs, 'up_bandwidth', opt_key='up')
-        if shaping_key == 'dummynet':
-          AddItemIfSet(kwargs, 'packet_loss_rate')
-          AddItemIfSet(kwargs, 'init_cwnd')
-        elif self.shaping_type != 'none':
-          if 'packet_loss_rate' in self._nondefaults:
-            logging.warn('Shaping type, %s, ignores --packet_loss_rate=%s',
-                         self.shaping_type, self.packet_loss_rate)
-          if 'init_cwnd' in self._nondefaults:
-            logging.warn('Shaping type, %s, ignores --init_cwnd=%s',
-                         self.shaping_type, self.init_cwnd)
+        AddItemIfSet(kwargs, 'init_cwnd')
+        AddItemIfSet(kwargs, 'packet_loss_rate')
+        if shaping_key == 'http':
+          AddItemIfSet(kwargs, 'jitter_ms')
+          AddItemIfSet(kwargs, 'jitter_distribution')
+          AddItemIfSet(kwargs, 'shaping_seed')
+        elif 'jitter_ms' in self._nondefaults:
+          logging.warn('Shaping type, %s, ignores --jitter_ms=%s',
+                       self.shaping_type, self.jitter_ms)
     return kwargs
 
   def _MassageValues(self):
@@ -247,9 +320,15 @@ class OptionsWrapper(object):
     if self.append and not self.record:
       self._options.record = True
     if self.net:
-      self._options.down, self._options.up, self._options.delay_ms = \
-          net_configs.GetNetConfig(self.net)
+      net_config = net_configs.GetNetConfig(self.net)
+      self._options.down, self._options.up, self._options.delay_ms = (
+          net_config.down, net_config.up, net_config.delay_ms)
       self._nondefaults.update(['down', 'up', 'delay_ms'])
+      net_impairment = net_configs.GetNetImpairment(self.net)
+      for name in net_impairment._fields:
+        if getattr(net_impairment, name) != '0':
+          setattr(self._options, name, getattr(net_impairment, name))
+          self._nondefaults.add(name)
     if not self.ssl:
       self._options.https_root_ca_cert_path = None
     self.shaping_dns = self._ShapingKeywordArgs('dns')
@@ -297,12 +376,23 @@ def replay(options, replay_filename):
         name_servers=[platformsettings.get_original_primary_nameserver()])
     if options.record:
       httparchive.HttpArchive.AssertWritable(replay_filename)
+      journal_filename = httparchive.GetJournalFilename(replay_filename)
       if options.append and os.path.exists(replay_filename):
         http_archive = httparchive.HttpArchive.Load(replay_filename)
         logging.info('Appending to %s (loaded %d existing responses)',
                      replay_filename, len(http_archive))
       else:
         http_archive = httparchive.HttpArchive()
+      if os.path.exists(journal_filename):
+        if not options.append:
+          logging.critical('%s is left from an interrupted recording. Use '
+                           '--append to resume it, or remove it.',
+                           journal_filename)
+          return 1
+        logging.info('Loaded %d records from %s',
+                     http_archive.LoadJournal(journal_filename),
+                     journal_filename)
+      server_manager.Append(Journal, http_archive, journal_filename)
     else:
       http_archive = httparchive.HttpArchive.Load(replay_filename)
       logging.info('Loaded %d responses from %s',
@@ -350,7 +440,11 @@ def replay(options, replay_filename):
     exit_status = 2
 
   if options.record:
+    http_archive.CloseJournal()
     http_archive.Persist(replay_filename)
+    journal_filename = httparchive.GetJournalFilename(replay_filename)
+    if os.path.exists(journal_filename):
+      os.remove(journal_filename)
     logging.info('Saved %d responses to %s', len(http_archive), replay_filename)
   return exit_status
 
@@ -402,11 +496,34 @@ def GetOptionParser():
   network_group.add_option('-p', '--packet_loss_rate', default='0',
       action='store',
       type='string',
-      help='Packet loss rate in range [0..1]. Zero means no loss.')
+      help='Packet loss rate in range [0..1]. Zero means no loss. With '
+           '--shaping_type=proxy, lost packets are retransmitted after a '
+           'round trip or a retransmission timeout.')
+  network_group.add_option('--jitter_ms', default='0',
+      action='store',
+      type='string',
+      help='Variation of the latency in milliseconds (--shaping_type=proxy '
+           'only). Zero means no jitter.')
+  network_group.add_option('--jitter_distribution', default='normal',
+      action='store',
+      type='choice',
+      choices=('normal', 'uniform'),
+      help='Distribution of the jitter: |normal| (default) with --jitter_ms '
+           'as the standard deviation, or |uniform| within +/- --jitter_ms.')
+  network_group.add_option('--random_seed', default=None,
+      action='store',
+      dest='shaping_seed',
+      type='int',
+      help='Random seed for the loss and jitter of --shaping_type=proxy. '
+           'The same seed gives the same loss and jitter for each connection '
+           'in the order they are made.')
   network_group.add_option('-w', '--init_cwnd', default='0',
       action='store',
       type='string',
-      help='Set initial cwnd (linux only, requires kernel patch)')
+      help='Set initial cwnd. With --shaping_type=dummynet, linux only and '
+           'requires kernel patch. With --shaping_type=proxy, the proxy '
+           'emulates TCP slow start from this window (default: 10 packets) '
+           'and the --delay_ms round trip time.')
   network_group.add_option('--net', default=None,
       action='store',
       type='choice',
@@ -418,6 +535,11 @@ def GetOptionParser():
       choices=('dummynet', 'proxy'),
       help='When shaping is configured (i.e. --up, --down, etc.) decides '
            'whether to use |dummynet| (default), or |proxy| servers.')
+  network_group.add_option('--kernel_shaper', default='ipfw',
+      action='store',
+      choices=sorted(trafficshaper.KERNEL_SHAPERS),
+      help='The kernel shaper of --shaping_type=dummynet: |ipfw| (dummynet, '
+           'the default) or |tc| (htb and netem, Linux only).')
   option_parser.add_option_group(network_group)
 
   harness_group = optparse.OptionGroup(option_parser,
@@ -506,6 +628,16 @@ def GetOptionParser():
   harness_group.add_option('--should_generate_certs', default=False,
       action='store_true',
       help='Use OpenSSL to generate certificate files for requested hosts.')
+  harness_group.add_option('--cert_cache_dir', default=None,
+      action='store',
+      type='string',
+      help='With --should_generate_certs, keep the generated certificates in '
+           'this directory so that later runs with the same root certificate '
+           'do not generate them again.')
+  harness_group.add_option('--pregenerate_certs', default=False,
+      action='store_true',
+      help='With --should_generate_certs, generate the certificates of all '
+           'the HTTPS hosts of the archive in parallel before serving.')
   harness_group.add_option('--no-admin-check', default=True,
       action='store_false',
       dest='admin_check',
@@ -514,6 +646,31 @@ def GetOptionParser():
       action='store_true',
       dest='scramble_images',
       help='Scramble image responses.')
+  harness_group.add_option('--inject_cache_mb', default=64,
+      action='store',
+      type='int',
+      help='During replay, cache up to this many megabytes of HTML responses '
+           'with the injected scripts. Zero disables the cache.')
+  harness_group.add_option('--prefill_inject_cache', default=False,
+      action='store_true',
+      help='Inject scripts into all archived HTML responses at startup '
+           '(up to --inject_cache_mb) instead of on the first request.')
+  harness_group.add_option('--workers', default=1,
+      action='store',
+      type='int',
+      help='Number of processes that serve HTTP(S) requests. The processes '
+           'share the proxy ports (SO_REUSEPORT) and the archive. In record '
+           'mode, new responses are saved by the main process. Switching '
+           'between record and replay mode is not supported with workers.')
+  harness_group.add_option('--proxy_backend', default='threaded',
+      action='store',
+      type='choice',
+      choices=('threaded', 'eventloop'),
+      help='How the HTTP proxies serve connections: |threaded| (default) '
+           'uses a thread per connection; |eventloop| serves all connections '
+           'from one thread, which scales to many more connections but does '
+           'not support bandwidth shaping. The HTTPS proxy is always '
+           'threaded.')
   return option_parser
 
 
@@ -19,6 +19,7 @@ Usage:
 $ ./replay_test.py
 """
 
+import net_configs
 import replay
 import unittest
 
@@ -75,13 +76,40 @@ class OptionsWrapperTest(unittest.TestCase):
     options = replay.OptionsWrapper(options, parser)
     self.assertEqual({'packet_loss_rate': '12'}, options.shaping_dummynet)
 
-  def testIgnoredProxyShapingOptions(self):
+  def testLossAndJitterForProxy(self):
     parser = replay.GetOptionParser()
     options, args = parser.parse_args(
-        ['--packet_loss_rate=12', '--init_cwnd=10', '--shaping=proxy'])
+        ['--packet_loss_rate=0.01', '--jitter_ms=20', '--random_seed=3',
+         '--shaping=proxy'])
     options = replay.OptionsWrapper(options, parser)
     self.assertEqual({}, options.shaping_dns)
-    self.assertEqual({}, options.shaping_http)
+    self.assertEqual({'packet_loss_rate': '0.01', 'jitter_ms': '20',
+                      'shaping_seed': 3}, options.shaping_http)
+    self.assertEqual({}, options.shaping_dummynet)
+
+  def testLossyNetOption(self):
+    parser = replay.GetOptionParser()
+    options, args = parser.parse_args(['--net=3g_lossy', '--shaping=proxy'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual({'down_bandwidth': '1638Kbit/s', 'up_bandwidth':
+                      '768Kbit/s', 'delay_ms': '150', 'packet_loss_rate':
+                      '0.02', 'jitter_ms': '40'}, options.shaping_http)
+
+  def testNetConfigsUnpackToBandwidthsAndDelay(self):
+    for name in net_configs.NET_CONFIG_NAMES:
+      down, up, delay_ms = net_configs.GetNetConfig(name)
+      self.assertTrue(down and up and delay_ms)
+    self.assertEqual(net_configs.NO_IMPAIRMENT,
+                     net_configs.GetNetImpairment('3g'))
+
+  def testInitCwndForProxy(self):
+    parser = replay.GetOptionParser()
+    options, args = parser.parse_args(
+        ['--init_cwnd=4', '--delay_ms=100', '--shaping=proxy'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual({'delay_ms': '100'}, options.shaping_dns)
+    self.assertEqual({'delay_ms': '100', 'init_cwnd': '4'},
+                     options.shaping_http)
     self.assertEqual({}, options.shaping_dummynet)
 
 
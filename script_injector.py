@@ -15,6 +15,7 @@
 
 """Inject javascript into html page source code."""
 
+import hashlib
 import logging
 import os
 import re
@@ -59,6 +60,11 @@ def GetInjectScript(scripts):
   return MinifyScript(''.join(lines))
 
 
+def GetInjectScriptHash(script):
+  """Returns a hex digest that identifies |script| (e.g. for cache keys)."""
+  return hashlib.sha1(script).hexdigest()
+
+
 def InjectScript(content, content_type, script_to_inject):
   """Inject |script_to_inject| into |content| if |content_type| is 'text/html'.
 
@@ -99,6 +99,13 @@ class ScriptInjectorTest(unittest.TestCase):
     self._assert_successful_injection_with_comment(
         LONG_COMMENT, LONG_COMMENT, LONG_COMMENT)
 
+  def test_inject_script_hash(self):
+    script_hash = script_injector.GetInjectScriptHash(SCRIPT_TO_INJECT)
+    self.assertEqual(
+        script_hash, script_injector.GetInjectScriptHash(SCRIPT_TO_INJECT))
+    self.assertNotEqual(
+        script_hash, script_injector.GetInjectScriptHash('var flag = 1;'))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -34,6 +34,7 @@ class ServerManager(object):
     self.record_callbacks = []
     self.replay_callbacks = []
     self.traffic_shapers = []
+    self.worker_pool = None
     self.is_record_mode = is_record_mode
     self.should_exit = False
 
@@ -62,6 +63,22 @@ class ServerManager(object):
     """
     self.traffic_shapers.append((initializer, init_args, init_kwargs))
 
+  def SetWorkerPool(self, initializer, *init_args, **init_kwargs):
+    """Set the pool of worker processes to run.
+
+    The workers are forked before any server starts (and maybe starts a
+    thread), since a lock held by another thread at fork time (e.g. of a
+    logging handler) would stay locked in the workers. They stop before the
+    servers, so servers that collect their results (e.g. a
+    httpclient.RecordQueue) get all of them.
+
+    Args:
+      initializer: a function that returns a daemonserver.WorkerProcessPool.
+      init_args: positional arguments for the initializer.
+      init_args: keyword arguments for the initializer.
+    """
+    self.worker_pool = (initializer, init_args, init_kwargs)
+
   def AppendRecordCallback(self, func):
     """Append a function to the list to call when switching to record mode.
 
@@ -104,8 +121,14 @@ class ServerManager(object):
     """
     server_exits = []
     server_ports = []
+    worker_pool_exit = None
     exception_info = (None, None, None)
     try:
+      if self.worker_pool:
+        initializer, init_args, init_kwargs = self.worker_pool
+        worker_pool = initializer(*init_args, **init_kwargs)
+        worker_pool_exit = worker_pool.__exit__
+        worker_pool.__enter__()
       for initializer, init_args, init_kwargs in self.initializers:
         server = initializer(*init_args, **init_kwargs)
         if server:
@@ -126,6 +149,8 @@ class ServerManager(object):
     except Exception:
       exception_info = sys.exc_info()
     finally:
+      if worker_pool_exit:
+        server_exits.insert(0, worker_pool_exit)
       for server_exit in server_exits:
         try:
           if server_exit(*exception_info):
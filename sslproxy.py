@@ -14,12 +14,96 @@
 
 """Extends BaseHTTPRequestHandler with SSL certificate generation."""
 
+import collections
 import logging
 import socket
+import threading
 
 import certutils
 
 
+# The number of hosts whose SSL contexts are kept by a SslContextCache.
+DEFAULT_CONTEXT_CACHE_SIZE = 1000
+
+# Clients may only resume sessions that were created by this proxy.
+SESSION_ID_CONTEXT = 'web-page-replay'
+
+
+class SslContextCache(object):
+  """An LRU cache of SSL server contexts, one per SNI host.
+
+  Each context has the generated certificate of its host and the private key
+  of the root CA, so a handshake with a cached host does not generate, parse
+  or read anything. The initial context of all connections keeps the session
+  cache and the session ticket keys, so clients may also resume sessions.
+  """
+
+  def __init__(self, max_size=DEFAULT_CONTEXT_CACHE_SIZE):
+    self.max_size = max_size
+    self._contexts = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._private_key = None
+    # Connections start with this context and switch to the context of
+    # their host in the SNI callback.
+    self.default_context = _NewServerContext()
+    self.default_context.set_tlsext_servername_callback(_HandleServerName)
+
+  def __len__(self):
+    return len(self._contexts)
+
+  def get(self, server, host):
+    """Return the context of |host|, preferably from the cache.
+
+    Args:
+      server: the server with get_certificate(host) and ca_cert_path.
+      host: the SNI host name.
+    Returns:
+      a certutils SSL context.
+    """
+    with self._lock:
+      context = self._contexts.pop(host, None)
+      if context is not None:
+        self._contexts[host] = context  # Mark as most recently used.
+        return context
+    # Certificate generation is slow, so it is done without the lock. Two
+    # connections may create the same context; the last one wins.
+    cert = certutils.load_cert(server.get_certificate(host))
+    context = _NewServerContext()
+    context.use_certificate(cert)
+    context.use_privatekey(self._get_private_key(server.ca_cert_path))
+    with self._lock:
+      self._contexts[host] = context
+      while len(self._contexts) > self.max_size:
+        self._contexts.popitem(last=False)
+    return context
+
+  def _get_private_key(self, ca_cert_path):
+    if self._private_key is None:
+      with open(ca_cert_path, 'r') as ca_file:
+        self._private_key = certutils.load_privatekey(ca_file.read())
+    return self._private_key
+
+
+def _NewServerContext():
+  context = certutils.get_ssl_context()
+  context.set_session_id(SESSION_ID_CONTEXT)
+  context.set_session_cache_mode(certutils.SESS_CACHE_SERVER)
+  return context
+
+
+def _HandleServerName(connection):
+  """A SNI callback that happens during do_handshake()."""
+  try:
+    host = connection.get_servername()
+    if host:
+      handler = connection.get_app_data()
+      connection.set_context(
+          handler.context_cache.get(handler.server, host))
+    # else: fail with 'no shared cipher'
+  except Exception, e:
+    # Do not leak any exceptions or else openssl crashes.
+    logging.error('Exception in SNI handler: %s', e)
+
 
 def _SetUpUsingDummyCert(handler):
   """Sets up connection providing the certificate to the client.
@@ -28,30 +112,14 @@ def _SetUpUsingDummyCert(handler):
 
   Args:
     handler: an instance of BaseHTTPServer.BaseHTTPRequestHandler that is used
-      by some instance of  BaseHTTPServer.HTTPServer.
+      by some instance of  BaseHTTPServer.HTTPServer. The contexts of hosts
+      are kept in its context_cache (a SslContextCache), if it has one.
   """
-  # One of: One of SSLv2_METHOD, SSLv3_METHOD, SSLv23_METHOD, or TLSv1_METHOD
-  context = certutils.get_ssl_context()
-  def handle_servername(connection):
-    """A SNI callback that happens during do_handshake()."""
-    try:
-      host = connection.get_servername()
-      if host:
-        cert_str = (
-            handler.server.get_certificate(host))
-        new_context = certutils.get_ssl_context()
-        cert = certutils.load_cert(cert_str)
-        new_context.use_certificate(cert)
-        new_context.use_privatekey_file(handler.server.ca_cert_path)
-        connection.set_context(new_context)
-        return new_context
-      # else: fail with 'no shared cipher'
-    except Exception, e:
-      # Do not leak any exceptions or else openssl crashes.
-      logging.error('Exception in SNI handler: %s', e)
-
-  context.set_tlsext_servername_callback(handle_servername)
-  handler.connection = certutils.get_ssl_connection(context, handler.connection)
+  if getattr(handler, 'context_cache', None) is None:
+    handler.context_cache = SslContextCache()
+  handler.connection = certutils.get_ssl_connection(
+      handler.context_cache.default_context, handler.connection)
+  handler.connection.set_app_data(handler)
   handler.connection.set_accept_state()
   try:
     handler.connection.do_handshake()
@@ -76,6 +144,8 @@ def wrap_handler(handler_class):
     raise certutils.openssl_import_error
 
   class WrappedHandler(handler_class):
+    # Shared by all connections to the server that uses this class.
+    context_cache = SslContextCache()
 
     def setup(self):
       handler_class.setup(self)
@@ -102,6 +102,7 @@ class Server(BaseHTTPServer.HTTPServer):
     with open(ca_cert_path, 'r') as ca_file:
       self.ca_cert_str = ca_file.read()
     self.http_archive_fetch = DummyFetch()
+    self.certificate_hosts = []
     if use_error_handler:
       self.HANDLER = WrappedErrorHandler
     else:
@@ -128,6 +129,7 @@ class Server(BaseHTTPServer.HTTPServer):
     self.cleanup()
 
   def get_certificate(self, host):
+    self.certificate_hosts.append(host)
     return certutils.generate_cert(self.ca_cert_str, '', host)
 
 
@@ -182,6 +184,28 @@ class TestClient(unittest.TestCase):
                  'random.host')
       c.run_request()
 
+  def test_caches_contexts(self):
+    with Server(self.ca_cert_path) as server:
+      for host_name in ['foo.com', 'bar.com', 'foo.com', 'foo.com']:
+        c = Client(self.cert_path, self.verify_cb, server.server_port,
+                   host_name)
+        c.run_request()
+      self.assertEqual(['foo.com', 'bar.com'], server.certificate_hosts)
+      self.assertEqual(2, len(server.HANDLER.context_cache))
+
+  def test_context_cache_evicts_least_recently_used(self):
+    with Server(self.ca_cert_path) as server:
+      cache = sslproxy.SslContextCache(max_size=2)
+      foo_context = cache.get(server, 'foo.com')
+      cache.get(server, 'bar.com')
+      self.assertIs(foo_context, cache.get(server, 'foo.com'))
+      cache.get(server, 'baz.com')  # Evicts bar.com.
+      self.assertEqual(2, len(cache))
+      self.assertIs(foo_context, cache.get(server, 'foo.com'))
+      cache.get(server, 'bar.com')
+      self.assertEqual(['foo.com', 'bar.com', 'baz.com', 'bar.com'],
+                       server.certificate_hosts)
+
   def test_wrong_cert(self):
     with Server(self.ca_cert_path, True) as server:
       c = Client(self.wrong_cert_path, self.verify_cb, server.server_port,
@@ -14,8 +14,10 @@
 # limitations under the License.
 
 import logging
+import math
 import platformsettings
 import re
+import socket
 
 
 # Mac has broken bandwitdh parsing, so double check the values.
@@ -37,7 +39,7 @@ class BandwidthValueError(TrafficShaperException):
 
 
 class TrafficShaper(object):
-  """Manages network traffic shaping."""
+  """Manages network traffic shaping with ipfw and dummynet."""
 
   # Pick webpagetest-compatible values (details: http://goo.gl/oghTg).
   _UPLOAD_PIPE = '10'      # Enforces overall upload bandwidth.
@@ -93,13 +95,7 @@ class TrafficShaper(object):
       platformsettings.setup_temporary_loopback_config()
     if self.init_cwnd != '0':
       platformsettings.set_temporary_tcp_init_cwnd(self.init_cwnd)
-    try:
-      ipfw_list = platformsettings.ipfw('list')
-      if not ipfw_list.startswith('65535 '):
-        logging.warn('ipfw has existing rules:\n%s', ipfw_list)
-        self._delete_rules(ipfw_list)
-    except Exception:
-      pass
+    self._delete_existing_rules()
     if (self.up_bandwidth == '0' and self.down_bandwidth == '0' and
         self.delay_ms == '0' and self.packet_loss_rate == '0'):
       logging.info('Skipped shaping traffic.')
@@ -107,60 +103,8 @@ class TrafficShaper(object):
     if not self.ports:
       raise TrafficShaperException('No ports on which to shape traffic.')
 
-    ports = ','.join(str(p) for p in self.ports)
-    half_delay_ms = int(self.delay_ms) / 2  # split over up/down links
-
     try:
-      # Configure upload shaping.
-      platformsettings.ipfw(
-          'pipe', self._UPLOAD_PIPE,
-          'config',
-          'bw', self.up_bandwidth,
-          'delay', half_delay_ms,
-          )
-      platformsettings.ipfw(
-          'queue', self._UPLOAD_QUEUE,
-          'config',
-          'pipe', self._UPLOAD_PIPE,
-          'plr', self.packet_loss_rate,
-          'queue', self._QUEUE_SLOTS,
-          'mask', 'src-port', '0xffff',
-          )
-      platformsettings.ipfw(
-          'add', self._UPLOAD_RULE,
-          'queue', self._UPLOAD_QUEUE,
-          'ip',
-          'from', 'any',
-          'to', self.host,
-          self.use_loopback and 'out' or 'in',
-          'dst-port', ports,
-          )
-      self.is_shaping = True
-
-      # Configure download shaping.
-      platformsettings.ipfw(
-          'pipe', self._DOWNLOAD_PIPE,
-          'config',
-          'bw', self.down_bandwidth,
-          'delay', half_delay_ms,
-          )
-      platformsettings.ipfw(
-          'queue', self._DOWNLOAD_QUEUE,
-          'config',
-          'pipe', self._DOWNLOAD_PIPE,
-          'plr', self.packet_loss_rate,
-          'queue', self._QUEUE_SLOTS,
-          'mask', 'dst-port', '0xffff',
-          )
-      platformsettings.ipfw(
-          'add', self._DOWNLOAD_RULE,
-          'queue', self._DOWNLOAD_QUEUE,
-          'ip',
-          'from', self.host,
-          'to', 'any',
-          'out',
-          'src-port', ports,
-          )
+      self._add_rules()
       logging.info('Started shaping traffic')
     except Exception:
       logging.error('Unable to shape traffic.')
@@ -175,6 +119,70 @@ class TrafficShaper(object):
         logging.error('Unable to stop shaping traffic.')
         raise
 
+  def _delete_existing_rules(self):
+    try:
+      ipfw_list = platformsettings.ipfw('list')
+      if not ipfw_list.startswith('65535 '):
+        logging.warn('ipfw has existing rules:\n%s', ipfw_list)
+        self._delete_rules(ipfw_list)
+    except Exception:
+      pass
+
+  def _add_rules(self):
+    ports = ','.join(str(p) for p in self.ports)
+    half_delay_ms = int(self.delay_ms) / 2  # split over up/down links
+
+    # Configure upload shaping.
+    platformsettings.ipfw(
+        'pipe', self._UPLOAD_PIPE,
+        'config',
+        'bw', self.up_bandwidth,
+        'delay', half_delay_ms,
+        )
+    platformsettings.ipfw(
+        'queue', self._UPLOAD_QUEUE,
+        'config',
+        'pipe', self._UPLOAD_PIPE,
+        'plr', self.packet_loss_rate,
+        'queue', self._QUEUE_SLOTS,
+        'mask', 'src-port', '0xffff',
+        )
+    platformsettings.ipfw(
+        'add', self._UPLOAD_RULE,
+        'queue', self._UPLOAD_QUEUE,
+        'ip',
+        'from', 'any',
+        'to', self.host,
+        self.use_loopback and 'out' or 'in',
+        'dst-port', ports,
+        )
+    self.is_shaping = True
+
+    # Configure download shaping.
+    platformsettings.ipfw(
+        'pipe', self._DOWNLOAD_PIPE,
+        'config',
+        'bw', self.down_bandwidth,
+        'delay', half_delay_ms,
+        )
+    platformsettings.ipfw(
+        'queue', self._DOWNLOAD_QUEUE,
+        'config',
+        'pipe', self._DOWNLOAD_PIPE,
+        'plr', self.packet_loss_rate,
+        'queue', self._QUEUE_SLOTS,
+        'mask', 'dst-port', '0xffff',
+        )
+    platformsettings.ipfw(
+        'add', self._DOWNLOAD_RULE,
+        'queue', self._DOWNLOAD_QUEUE,
+        'ip',
+        'from', self.host,
+        'to', 'any',
+        'out',
+        'src-port', ports,
+        )
+
   def _delete_rules(self, ipfw_list=None):
     if ipfw_list is None:
       ipfw_list = platformsettings.ipfw('list')
@@ -184,3 +192,168 @@ class TrafficShaper(object):
                     if r in existing_rules]
     if delete_rules:
       platformsettings.ipfw('delete', *delete_rules)
+
+
+class TcTrafficShaper(TrafficShaper):
+  """Manages network traffic shaping with Linux tc (htb and netem).
+
+  The rules mirror the dummynet ones: each direction gets an htb class for
+  its bandwidth and a netem qdisc for half of the delay and the packet loss.
+  u32 filters send the packets to and from |host| and |ports| to the classes;
+  other traffic is not shaped. The connections of a direction share its
+  queue, unlike the per-port queues of dummynet.
+
+  On the loopback interface, both directions leave through 'lo'. Otherwise,
+  download is shaped as it leaves the primary interface and upload is
+  redirected from its ingress to an ifb device to be shaped there.
+
+  All of the rules are applied with one tc process.
+  """
+  _ROOT_HANDLE = '1:'
+  _UPLOAD_CLASS = '1:10'
+  _UPLOAD_NETEM = '10:'
+  _DOWNLOAD_CLASS = '1:11'
+  _DOWNLOAD_NETEM = '11:'
+  _INGRESS_HANDLE = 'ffff:'
+  _IFB_DEVICE = 'ifb0'
+  _LOOPBACK_DEVICE = 'lo'
+  _UNLIMITED_RATE = '10gbit'
+  _UNLIMITED_BYTES_PER_SEC = 10 ** 10 / 8
+  _PACKET_SIZE = 1500  # Bytes, an Ethernet MTU.
+
+  _TC_UNITS = {'bit': 'bit', 'Byte': 'bps'}
+  _PREFIX_FACTORS = {'': 1, 'K': 1000, 'M': 1000 * 1000}
+
+  def __init__(self, *args, **kwargs):
+    super(TcTrafficShaper, self).__init__(*args, **kwargs)
+    self.device = None
+
+  def _get_device(self):
+    if self.device is None:
+      if self.use_loopback:
+        self.device = self._LOOPBACK_DEVICE
+      else:
+        self.device = platformsettings.get_primary_interface()
+    return self.device
+
+  def _get_rate(self, bandwidth):
+    """Return |bandwidth| in tc units, e.g. '1536Kbit/s' -> '1536kbit'."""
+    if bandwidth == '0':
+      return self._UNLIMITED_RATE
+    m = re.match(r'(\d+)([KM]?)(bit|Byte)/s', bandwidth)
+    value, prefix, unit = m.groups()
+    return '%s%s%s' % (value, prefix.lower(), self._TC_UNITS[unit])
+
+  def _get_netem_limit(self, bandwidth, half_delay_ms):
+    """Return the number of packets that netem may hold.
+
+    Unlike a dummynet queue, the netem limit also counts the packets in its
+    delay line, so it has room for a bandwidth-delay product of full-size
+    packets on top of the queue slots.
+    """
+    if bandwidth == '0':
+      bytes_per_sec = self._UNLIMITED_BYTES_PER_SEC
+    else:
+      m = re.match(r'(\d+)([KM]?)(bit|Byte)/s', bandwidth)
+      value, prefix, unit = m.groups()
+      bytes_per_sec = int(value) * self._PREFIX_FACTORS[prefix]
+      if unit == 'bit':
+        bytes_per_sec /= 8.0
+    bytes_in_flight = bytes_per_sec * half_delay_ms / 1000.0
+    packets_in_flight = int(math.ceil(bytes_in_flight / self._PACKET_SIZE))
+    return self._QUEUE_SLOTS + packets_in_flight
+
+  def _get_direction_commands(self, device, classid, netem_handle,
+                              bandwidth, half_delay_ms, match_args_list):
+    rate = self._get_rate(bandwidth)
+    netem_args = ['delay', '%dms' % half_delay_ms,
+                  'limit', self._get_netem_limit(bandwidth, half_delay_ms)]
+    if self.packet_loss_rate != '0':
+      netem_args += ['loss', '%g%%' % (float(self.packet_loss_rate) * 100)]
+    commands = [
+        ['class', 'add', 'dev', device, 'parent', self._ROOT_HANDLE,
+         'classid', classid, 'htb', 'rate', rate, 'ceil', rate],
+        ['qdisc', 'add', 'dev', device, 'parent', classid,
+         'handle', netem_handle, 'netem'] + netem_args,
+        ]
+    for match_args in match_args_list:
+      commands.append(
+          ['filter', 'add', 'dev', device, 'parent', self._ROOT_HANDLE,
+           'protocol', 'ip', 'prio', '1', 'u32'] + match_args +
+          ['flowid', classid])
+    return commands
+
+  def _get_add_commands(self):
+    """Return the tc commands that start shaping."""
+    device = self._get_device()
+    host = '%s/32' % socket.gethostbyname(self.host)
+    half_delay_ms = int(self.delay_ms) / 2  # split over up/down links
+    upload_matches = [
+        ['match', 'ip', 'dst', host, 'match', 'ip', 'dport', port, '0xffff']
+        for port in self.ports]
+    download_matches = [
+        ['match', 'ip', 'src', host, 'match', 'ip', 'sport', port, '0xffff']
+        for port in self.ports]
+
+    commands = [['qdisc', 'add', 'dev', device, 'root',
+                 'handle', self._ROOT_HANDLE, 'htb']]
+    if self.use_loopback:
+      upload_device = device
+    else:
+      upload_device = self._IFB_DEVICE
+      commands.append(['qdisc', 'add', 'dev', device,
+                       'handle', self._INGRESS_HANDLE, 'ingress'])
+      for match_args in upload_matches:
+        commands.append(
+            ['filter', 'add', 'dev', device, 'parent', self._INGRESS_HANDLE,
+             'protocol', 'ip', 'prio', '1', 'u32'] + match_args +
+            ['action', 'mirred', 'egress', 'redirect',
+             'dev', self._IFB_DEVICE])
+      commands.append(['qdisc', 'add', 'dev', upload_device, 'root',
+                       'handle', self._ROOT_HANDLE, 'htb'])
+    commands += self._get_direction_commands(
+        upload_device, self._UPLOAD_CLASS, self._UPLOAD_NETEM,
+        self.up_bandwidth, half_delay_ms, upload_matches)
+    commands += self._get_direction_commands(
+        device, self._DOWNLOAD_CLASS, self._DOWNLOAD_NETEM,
+        self.down_bandwidth, half_delay_ms, download_matches)
+    return commands
+
+  def _get_delete_commands(self):
+    """Return the tc commands that stop shaping."""
+    device = self._get_device()
+    commands = [['qdisc', 'del', 'dev', device, 'root']]
+    if not self.use_loopback:
+      commands += [['qdisc', 'del', 'dev', device, 'ingress'],
+                   ['qdisc', 'del', 'dev', self._IFB_DEVICE, 'root']]
+    return commands
+
+  def _delete_existing_rules(self):
+    try:
+      qdiscs = platformsettings.tc_batch(
+          [['qdisc', 'show', 'dev', self._get_device()]])
+      if 'htb %s root' % self._ROOT_HANDLE in qdiscs:
+        logging.warn('tc has existing rules:\n%s', qdiscs)
+        self._delete_rules()
+    except Exception:
+      pass
+
+  def _add_rules(self):
+    if not self.use_loopback:
+      try:
+        platformsettings.ip_link('add', self._IFB_DEVICE, 'type', 'ifb')
+      except platformsettings.CalledProcessError:
+        pass  # it exists already
+      platformsettings.ip_link('set', 'dev', self._IFB_DEVICE, 'up')
+    self.is_shaping = True
+    platformsettings.tc_batch(self._get_add_commands())
+
+  def _delete_rules(self):
+    platformsettings.tc_batch(self._get_delete_commands())
+
+
+# The kernel shapers by name (see the --kernel_shaper option of replay.py).
+KERNEL_SHAPERS = {
+    'ipfw': TrafficShaper,
+    'tc': TcTrafficShaper,
+    }
@@ -53,6 +53,56 @@ class TrafficShaperTest(unittest.TestCase):
                       down_bandwidth='1KBit/s')
 
 
+class TcTrafficShaperTest(unittest.TestCase):
+
+  def testLoopbackCommands(self):
+    shaper = trafficshaper.TcTrafficShaper(
+        host='127.0.0.1', ports=(80, 443), up_bandwidth='384Kbit/s',
+        down_bandwidth='2MByte/s', delay_ms='100', packet_loss_rate='0.01')
+    commands = [' '.join(str(a) for a in c)
+                for c in shaper._get_add_commands()]
+    self.assertEqual('qdisc add dev lo root handle 1: htb', commands[0])
+    self.assertIn('class add dev lo parent 1: classid 1:10 htb '
+                  'rate 384kbit ceil 384kbit', commands)
+    self.assertIn('class add dev lo parent 1: classid 1:11 htb '
+                  'rate 2mbps ceil 2mbps', commands)
+    self.assertIn('qdisc add dev lo parent 1:11 handle 11: netem '
+                  'delay 50ms limit 167 loss 1%', commands)
+    self.assertIn('filter add dev lo parent 1: protocol ip prio 1 u32 '
+                  'match ip dst 127.0.0.1/32 match ip dport 443 0xffff '
+                  'flowid 1:10', commands)
+    self.assertIn('filter add dev lo parent 1: protocol ip prio 1 u32 '
+                  'match ip src 127.0.0.1/32 match ip sport 80 0xffff '
+                  'flowid 1:11', commands)
+    self.assertEqual(9, len(commands))
+
+  def testNetemLimitHoldsBandwidthDelayProduct(self):
+    shaper = trafficshaper.TcTrafficShaper()
+    # 2MByte/s * 50ms is 100000 bytes, about 67 full-size packets.
+    self.assertEqual(167, shaper._get_netem_limit('2MByte/s', 50))
+    self.assertEqual(100, shaper._get_netem_limit('384Kbit/s', 0))
+    self.assertEqual(10100, shaper._get_netem_limit('1200Mbit/s', 100))
+    self.assertEqual(83434, shaper._get_netem_limit('0', 100))
+
+  def testUploadIsRedirectedWithoutLoopback(self):
+    shaper = trafficshaper.TcTrafficShaper(
+        host='127.0.0.1', ports=(80,), up_bandwidth='1Mbit/s',
+        use_loopback=False)
+    shaper.device = 'eth0'
+    commands = [' '.join(str(a) for a in c)
+                for c in shaper._get_add_commands()]
+    self.assertIn('filter add dev eth0 parent ffff: protocol ip prio 1 u32 '
+                  'match ip dst 127.0.0.1/32 match ip dport 80 0xffff '
+                  'action mirred egress redirect dev ifb0', commands)
+    self.assertIn('class add dev ifb0 parent 1: classid 1:10 htb '
+                  'rate 1mbit ceil 1mbit', commands)
+    self.assertIn('class add dev eth0 parent 1: classid 1:11 htb '
+                  'rate 10gbit ceil 10gbit', commands)
+    self.assertEqual(['qdisc del dev eth0 root', 'qdisc del dev eth0 ingress',
+                      'qdisc del dev ifb0 root'],
+                     [' '.join(c) for c in shaper._get_delete_commands()])
+
+
 class TimedUdpHandler(SocketServer.DatagramRequestHandler):
   """UDP handler that returns the time when the request was handled."""
 